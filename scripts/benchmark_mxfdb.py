@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+"""
+benchmark_mxfdb.py
+
+Benchmarks mxfdb indexing and lookups on synthetic Avid MediaFiles/MXF
+trees of 1k, 10k and 100k OP-Atom files. One video and one audio
+template are rendered with ffmpeg's lavfi sources, then stamped out
+with unique umids and clip names, so that large trees are quick to
+build and every file has a real ffmpeg header. Trees are built under
+workdir and reused between runs.
+
+The size of the database is reported as a whole and, where SQLite has
+the dbstat table, for each table and index.
+
+Each result is appended as a JSON line to results_file, labelled with
+the current git commit, and compared with the last result for the same
+number of files.
+
+Usage: benchmark_mxfdb.py [sizes] [results_file] [workdir]
+
+sizes is a comma separated list of file counts, defaulting to
+1000,10000,100000. results_file defaults to mxfdb_benchmark.jsonl in
+the current directory.
+"""
+
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from turnovertools import mxfdb
+from turnovertools import mxfmetrics
+from turnovertools import probecache
+from turnovertools import thumbnailcache
+
+SIZES = (1000, 10000, 100000)
+RESULTS_FILE = 'mxfdb_benchmark.jsonl'
+
+# Avid starts a new numbered folder long before this, but smaller
+# folders give the incremental rescan some folders to skip
+FILES_PER_FOLDER = 1000
+
+# clip names are stamped over this name in the templates, so must have
+# the same length
+TEMPLATE_NAME = 'BENCH00000000'
+
+TEMPLATES = {
+    'V1': ['-f', 'lavfi', '-i', 'testsrc=size=320x180:rate=24000/1001',
+           '-frames:v', '1', '-c:v', 'dnxhd', '-profile:v', 'dnxhr_lb',
+           '-pix_fmt', 'yuv422p', '-timecode', '01:00:00:00'],
+    'A1': ['-f', 'lavfi', '-i', 'sine=frequency=1000:sample_rate=48000',
+           '-t', '0.0417', '-c:a', 'pcm_s24le', '-ac', '1'],
+}
+
+LOOKUPS = 1000
+
+def render_template(track, path):
+    """Renders a one frame OP-Atom file for track with ffmpeg."""
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y'] +
+                   TEMPLATES[track] +
+                   ['-metadata', f'material_package_name={TEMPLATE_NAME}',
+                    '-f', 'mxf_opatom', path], check=True)
+
+def read_template(path):
+    """Returns the bytes of a template, the length of its header
+    partition and the UIDs of its packages."""
+    with io.open(path, 'rb') as fh:
+        header = mxfdb.MXFHeader(mxfdb.parse_local_sets(
+            mxfdb.read_header_partition(fh)))
+        header_end = fh.tell()
+        fh.seek(0)
+        data = fh.read()
+    uids = list(items[mxfdb.TAG_PACKAGE_UID] for _, items in header.sets.values()
+                if mxfdb.TAG_PACKAGE_UID in items)
+    return data, header_end, uids
+
+def stamp(template, name, key):
+    """Returns the bytes of a template with its name and package UIDs
+    replaced by name and UIDs unique to key."""
+    data, header_end, uids = template
+    header = data[:header_end].replace(TEMPLATE_NAME.encode('utf-16-be'),
+                                       name.encode('utf-16-be'))
+    for uid in uids:
+        material = hashlib.blake2b(f'{key}:{uid.hex()}'.encode(),
+                                   digest_size=16).digest()
+        header = header.replace(uid, uid[:16] + material)
+    return header + data[header_end:]
+
+def build_tree(workdir, size):
+    """Builds a volume of size synthetic OP-Atom files under workdir,
+    unless one was already built, and returns the path of the
+    volume."""
+    volume = os.path.join(workdir, f'Bench_{size}')
+    marker = os.path.join(volume, 'complete')
+    if os.path.exists(marker):
+        return volume
+    templates = dict()
+    for track in TEMPLATES:
+        path = os.path.join(workdir, f'template.{track}.mxf')
+        if not os.path.exists(path):
+            render_template(track, path)
+        templates[track] = read_template(path)
+    mxfdir = os.path.join(volume, 'Avid MediaFiles', 'MXF')
+    for number in range(size):
+        folder = os.path.join(mxfdir, str(number // FILES_PER_FOLDER + 1))
+        if number % FILES_PER_FOLDER == 0:
+            os.makedirs(folder, exist_ok=True)
+        track = 'V1' if number % 2 == 0 else 'A1'
+        name = f'B{number // 2:012}'
+        path = os.path.join(folder, f'{name}.{track}.mxf')
+        with open(path, 'wb') as filehandle:
+            filehandle.write(stamp(templates[track], name, number))
+    with open(marker, 'w'):
+        pass
+    return volume
+
+def latency(calls):
+    """Times each of a list of calls, returning the median and 99th
+    percentile in microseconds."""
+    times = list()
+    for call in calls:
+        started = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - started)
+    times.sort()
+    return dict(p50_us=round(times[len(times) // 2] * 1e6, 1),
+                p99_us=round(times[int(len(times) * 0.99)] * 1e6, 1))
+
+def timed_index(db):
+    """Indexes all volumes of db, returning the wall time and the
+    metrics of the run."""
+    started = time.perf_counter()
+    db.index_all()
+    return time.perf_counter() - started, db.metrics.last_run
+
+def touch(paths):
+    """Moves the modification time of paths forward by a second."""
+    for path in paths:
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+def table_bytes(db_file):
+    """Returns the bytes used by each table and index of a database, or
+    None if SQLite was built without the dbstat table."""
+    conn = sqlite3.connect(db_file)
+    try:
+        rows = conn.execute('SELECT name, SUM(pgsize) FROM dbstat ' +
+                            'GROUP BY name').fetchall()
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        conn.close()
+    return dict(rows)
+
+def benchmark(volume, size, workdir):
+    """Runs every benchmark on a volume, returning the results."""
+    db_file = os.path.join(workdir, f'bench_{size}.db')
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    db = mxfdb.MediaDatabase(sqlite3.connect(db_file), volumes=[volume],
+                             quiet=True, metrics=mxfmetrics.IndexMetrics())
+    results = dict(files=size)
+
+    seconds, run = timed_index(db)
+    header = run.latency['header'].as_dict()
+    results['index'] = dict(seconds=round(seconds, 3),
+                            files_per_second=round(run.probed / seconds, 1),
+                            probed=run.probed, failed=run.failed,
+                            probe_p50_ms=header['p50_ms'],
+                            probe_p99_ms=header['p99_ms'])
+
+    seconds, run = timed_index(db)
+    results['rescan'] = dict(seconds=round(seconds, 3), probed=run.probed)
+
+    paths = sorted(os.path.join(folder, file) for folder, _, files in
+                   os.walk(volume) for file in files if file.endswith('.mxf'))
+    random.seed(size)
+    touch(random.sample(paths, max(size // 100, 1)))
+    seconds, run = timed_index(db)
+    results['rescan_1pct'] = dict(seconds=round(seconds, 3), probed=run.probed)
+
+    umids = list(mxfdb.decode_umid(row[0]) for row in
+                 db.conn.execute('SELECT umid FROM Media'))
+    names = list(row[0] for row in db.conn.execute('SELECT DISTINCT name FROM Media'))
+    umids = random.sample(umids, min(LOOKUPS, len(umids)))
+    names = random.sample(names, min(LOOKUPS, len(names)))
+    results['getitem'] = latency(list(lambda umid=umid: db[umid]
+                                      for umid in umids))
+    results['get_umids'] = latency(list(lambda name=name: list(db.get_umids(name))
+                                        for name in names))
+    started = time.perf_counter()
+    db.get_umids_many(names)
+    results['get_umids_many'] = dict(
+        seconds=round(time.perf_counter() - started, 6), reels=len(names))
+    started = time.perf_counter()
+    db.lookup_many(umids)
+    results['lookup_many'] = dict(
+        seconds=round(time.perf_counter() - started, 6), umids=len(umids))
+    # opening an index lazily and looking up one reel, against the
+    # rescan an eager open makes
+    started = time.perf_counter()
+    lazy = mxfdb.open(db_file, volumes=[volume], quiet=True, service=False,
+                      lazy=True)
+    list(lazy.get_umids(names[0]))
+    results['lazy_open'] = dict(seconds=round(time.perf_counter() - started, 6))
+    lazy.close()
+    # closing checkpoints the WAL, so the file holds every page
+    db.close()
+    results['db_bytes'] = os.path.getsize(db_file)
+    tables = table_bytes(db_file)
+    if tables is not None:
+        results['db_tables'] = tables
+    return results
+
+def git_commit():
+    """Returns the commit being benchmarked, or None outside git."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def previous_results(results_file):
+    """Returns the last saved result for each number of files."""
+    previous = dict()
+    if os.path.exists(results_file):
+        with open(results_file) as filehandle:
+            for line in filehandle:
+                record = json.loads(line)
+                previous[record['files']] = record
+    return previous
+
+def compare(record, previous):
+    """Prints a record beside the previous record for the same number
+    of files."""
+    before = previous.get(record['files'])
+    print(f"{record['files']} files at {record['commit']}" +
+          (f" (against {before['commit']})" if before else ''))
+    for bench, values in record.items():
+        if not isinstance(values, dict):
+            continue
+        for key, value in values.items():
+            line = f'  {bench}.{key}: {value}'
+            old = before.get(bench, {}).get(key) if before else None
+            if isinstance(old, (int, float)) and old and value is not None:
+                line += f' (was {old}, {(value - old) / old:+.1%})'
+            print(line)
+
+def main(sizes=None, results_file=RESULTS_FILE, workdir=None):
+    """Benchmarks each size, saving and comparing the results."""
+    sizes = SIZES if sizes is None else tuple(int(size) for size in sizes.split(','))
+    if workdir is None:
+        workdir = os.path.join(tempfile.gettempdir(), 'mxfdb_benchmark')
+    os.makedirs(workdir, exist_ok=True)
+    # measure indexing itself, not the caches shared with other tools
+    probecache.set_cache(False)
+    thumbnailcache.set_cache(False)
+    previous = previous_results(results_file)
+    for size in sizes:
+        volume = build_tree(workdir, size)
+        record = dict(commit=git_commit(), time=time.time(),
+                      python=platform.python_version(),
+                      sqlite=sqlite3.sqlite_version, workers=os.cpu_count(),
+                      **benchmark(volume, size, workdir))
+        with open(results_file, 'a') as filehandle:
+            filehandle.write(json.dumps(record) + '\n')
+        compare(record, previous)
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
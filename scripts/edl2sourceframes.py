@@ -32,14 +32,24 @@ def sort_by_tc(events):
     events.sort(key=lambda e: (e.rec_start_tc.frames, e.track))
     return events
 
-def get_thumbnail(reel, mediadb):
+def get_thumbnail(reel, mediadb, found=None):
     """Queries mediadb for a mediafile matching reel, returning a
     corresponding thumbnail, or None if no matching mediafile is
-    found."""
-    umids = list(mediadb.get_umids(reel, 'video'))
-    if not umids:
+    found or reel matches several clips equally well, none of them
+    exactly. found can be a
+    dictionary of reels to video mediafiles already fetched with
+    mediadb.resolve_reels."""
+    if found is None:
+        found = mediadb.resolve_reels([reel], 'video')
+    matches = mxfdb.best_matches(reel, found.get(reel))
+    if len(matches) > 1:
+        names = ', '.join(media.name for media in matches)
+        print(f'{reel} matches several clips ({names}); skipping')
         return None
-    mediafile = mobs.MediaFile.probe(umids[0].path)
+    if not matches:
+        return None
+    # files indexed with their technical metadata need no second probe
+    mediafile = matches[0].to_mob() or mobs.MediaFile.probe(matches[0].path)
     return mediafile.thumbnail()
 
 def main(inputfile, outputdir, mediadb=None):
@@ -66,15 +76,14 @@ def main(inputfile, outputdir, mediadb=None):
     events = edl.events_from_edl(inputfile)
     remove_filler(events)
     sort_by_tc(events)
+    # resolve every reel in one batch, ignoring case and extensions
+    found = mediadb.resolve_reels(set(event.reel for event in events), 'video')
     for i, event in enumerate(events):
         reel = event.reel
-        frame = get_thumbnail(reel, mediadb)
+        frame = get_thumbnail(reel, mediadb, found)
         if frame is None:
-            reel = reel.rsplit('.', 1)[0]
-            frame = get_thumbnail(reel, mediadb)
-            if frame is None:
-                print(f'No image found for {reel}')
-                continue
+            print(f'No image found for {reel}')
+            continue
         outname = f'{i:03}_{reel}.jpg'
         with open(os.path.join(outputdir, outname), 'wb') as outfile:
             outfile.write(frame)
@@ -16,13 +16,20 @@ from turnovertools import sourcedb
 from turnovertools import mxfdb
 from turnovertools.config import Config
 
-def insert_umid(reel, primary_key, table, sourcetable, mediadb):
-    umids = list(mediadb.get_umids(reel, 'video'))
-    if not umids:
+def insert_umid(reel, primary_key, table, sourcetable, mediadb, found=None):
+    if found is None:
+        found = mediadb.resolve_reels([reel], 'video')
+    matches = mxfdb.best_matches(reel, found.get(reel))
+    if len(matches) > 1:
+        names = ', '.join(media.name for media in matches)
+        print(f'{reel} matches several clips ({names}); skipping')
+        return
+    if not matches:
         return
 
-    # get mxf file path
-    mediafile = mobs.MediaFile.probe(umids[0].path)
+    # get mxf file, without probing it again if it was indexed with
+    # its technical metadata
+    mediafile = matches[0].to_mob() or mobs.MediaFile.probe(matches[0].path)
     mediafile.poster_frame = sourcetable.get_pk(primary_key)['poster_frame']
     thumbnail = mediafile.thumbnail()
     sourcetable.update_container(primary_key, 'image', thumbnail,
@@ -52,9 +59,10 @@ def main(reel, primary_key, table, sourcetable, mediadb=None):
     else:
         sources = [(reel, primary_key)]
 
+    found = mediadb.resolve_reels(set(source[0] for source in sources), 'video')
     for source in sources:
         print(source)
-        insert_umid(source[0], source[1], table, sourcetable, mediadb)
+        insert_umid(source[0], source[1], table, sourcetable, mediadb, found)
 
 if __name__ == '__main__':
     main(*sys.argv[1:])
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+"""
+mediaindex.py
+
+Run a resident media index service for the mxf database, which keeps
+the index warm, reindexes volumes in the background, and answers
+lookups from scripts such as insert_umid.py over a local socket.
+Indexing metrics are appended as JSON lines to metrics_file, if given.
+
+Usage: mediaindex.py [db_file] [interval|watch] [metrics_file]
+"""
+
+import sys
+
+from turnovertools import mxfdbservice
+from turnovertools import mxfmetrics
+from turnovertools.config import Config
+
+def main(db_file=Config.MXFDB, interval=300, metrics_file=None):
+    """Serves db_file, reindexing every interval seconds, or watching
+    MXF folders for changes if interval is 'watch'."""
+    watch = interval == 'watch'
+    metrics = mxfmetrics.IndexMetrics(metrics_file) if metrics_file else None
+    service = mxfdbservice.MediaIndexService(
+        db_file, interval=300 if watch else int(interval), watch=watch,
+        metrics=metrics)
+    print(f'Serving {db_file} on {service.path}')
+    service.serve_forever()
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+"""
+mxfdbquarantine.py
+
+Lists the files in the mxf database index that failed to probe, with
+the error raised and when. These files are skipped when their volume
+is indexed until they are modified or replaced.
+
+Usage: mxfdbquarantine.py [volume ...]
+"""
+
+import datetime
+import sqlite3
+import sys
+
+from turnovertools import mxfdb
+from turnovertools.config import Config
+
+def main(*volumes):
+    """Prints the quarantined files of volumes, or of every volume if
+    none are given."""
+    volumes = list(mxfdb.clean_tablename(volume) for volume in volumes) or None
+    db = mxfdb.MediaDatabase(sqlite3.connect(Config.MXFDB))
+    try:
+        quarantined = db.quarantined(volumes)
+    finally:
+        db.close()
+    for source, volume, error, failed in quarantined:
+        failed = datetime.datetime.fromtimestamp(failed).strftime('%Y-%m-%d %H:%M')
+        print(f'{failed}  {volume}  {source}\n    {error}')
+    print(f'{len(quarantined)} quarantined files')
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
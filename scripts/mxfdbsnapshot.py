@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+"""
+mxfdbsnapshot.py
+
+Exports the mxf database index of selected volumes to a snapshot file,
+or imports a snapshot exported on another workstation sharing the same
+storage. Imported media whose files have changed since the snapshot
+was taken are probed again; everything else is used as is.
+
+Usage: mxfdbsnapshot.py export|import snapshot_file [volume ...]
+"""
+
+import sqlite3
+import sys
+
+from turnovertools import mxfdb
+from turnovertools import mxfsnapshot
+from turnovertools.config import Config
+
+def main(command, snapshot_file, *volumes):
+    """Exports or imports snapshot_file for volumes, or for every
+    volume if none are given."""
+    volumes = list(mxfdb.clean_tablename(volume) for volume in volumes) or None
+    db = mxfdb.MediaDatabase(sqlite3.connect(Config.MXFDB))
+    try:
+        if command == 'export':
+            count = mxfsnapshot.export_snapshot(db, snapshot_file, volumes)
+            print(f'Exported {count} folders to {snapshot_file}')
+        elif command == 'import':
+            counts = mxfsnapshot.import_snapshot(db, snapshot_file, volumes)
+            print(f"Imported {counts['imported']} files in {counts['folders']} " +
+                  f"folders; {counts['current']} already current, " +
+                  f"{counts['stale']} changed since the snapshot")
+        else:
+            print(__doc__)
+    finally:
+        db.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    main(*sys.argv[1:])
@@ -26,6 +26,8 @@ setuptools.setup(
              'scripts/dbplay.py', 'scripts/watermark.py',
              'scripts/vfxreference2.py', 'scripts/csv2markers.py',
              'scripts/csv2ale.py', 'scripts/prepsubmission.py',
+             'scripts/mediaindex.py', 'scripts/mxfdbsnapshot.py',
+             'scripts/mxfdbquarantine.py',
              'quick/files2csv.py',
              'quick/simedl.py',
              'quick/email2submission.py',
@@ -1,15 +1,42 @@
 """Tests the mxfdb component."""
 
+import gzip
+import io
+import json
 import os
+import shutil
 import sqlite3
-import tempfile
+import subprocess
+import sys
+import threading
+import time
 import unittest
+from unittest import mock
+import zipfile
 from zipfile import ZipFile
-import zlib
 
 from tests.shared_test_setup import AcceptanceCase
 
+from turnovertools.mediaobjects import mediafile as mediafile_module
 from turnovertools import mxfdb
+from turnovertools import mxfdbservice
+from turnovertools import mxflease
+from turnovertools import mxfmetrics
+from turnovertools import mxfsnapshot
+from turnovertools import mxfwatch
+from turnovertools import probecache
+from turnovertools import thumbnailcache
+import turnovertools.mediaobjects as mobs
+
+def setUpModule():
+    # keep probes and thumbnails made by tests out of the caches in the
+    # user's index
+    probecache.set_cache(False)
+    thumbnailcache.set_cache(False)
+
+def tearDownModule():
+    probecache.set_cache(None)
+    thumbnailcache.set_cache(None)
 
 def get_test_file(*args):
     """Returns args as a path, joined to the base test_files path."""
@@ -30,10 +57,1694 @@ def chunks(sequence, length):
     for i in range(0, len(sequence), length):
         yield sequence[i:i+length]
 
+class FakeProbe:
+    """Stands in for mxfdb.Probe, deriving metadata from the filename
+    instead of running ffprobe. Files named 'nostream' behave like MXF
+    files without a media stream, and 'slow' files take longer to
+    probe than the others."""
+
+    def __init__(self, filepath):
+        self.file = os.path.basename(filepath)
+        if self.file.startswith('nostream'):
+            raise TypeError("'NoneType' object is not subscriptable")
+        if self.file.startswith('slow'):
+            time.sleep(0.2)
+        self.umid = self.file
+        self.name = self.file
+        self.type = self.mediatype = 'video'
+        self.path = filepath
+
+    def set_altpath(self, altpath):
+        """Mirrors Probe.set_altpath."""
+        self.file = os.path.basename(altpath)
+        self.path = altpath
+
+class TestProbeFiles(unittest.TestCase):
+    """Indexing should be able to probe many files at once, without
+    losing files or changing how failures are reported."""
+
+    def test_parallel_matches_serial(self):
+        """Index the same files with one worker and with several, and
+        expect the same results, in completion order for the pool."""
+        files = [('slow.mxf', None)] + [(f'{i}.mxf', None) for i in range(20)]
+        files.append(('nostream.mxf', None))
+        with mock.patch.object(mxfdb, 'Probe', FakeProbe):
+            with self.assertWarns(UserWarning):
+                serial = mxfdb.MediaDatabase.index_files(iter(files))
+            with self.assertWarns(UserWarning):
+                parallel = mxfdb.MediaDatabase.index_files(iter(files),
+                                                           workers=4)
+        self.assertEqual(set(serial), set(parallel))
+        self.assertNotIn('nostream.mxf', parallel)
+        self.assertEqual(list(serial)[0], 'slow.mxf')
+        self.assertEqual(list(parallel)[-1], 'slow.mxf')
+
+    def test_progress_counts_every_file(self):
+        """Progress should be incremented once per file, including
+        failures."""
+        files = [(f'{i}.mxf', None) for i in range(10)]
+        files.append(('nostream.mxf', None))
+        progress = mxfdb.Progress(quiet=True)
+        progress.set_length(len(files))
+        with mock.patch.object(mxfdb, 'Probe', FakeProbe):
+            with self.assertWarns(UserWarning):
+                mxfdb.MediaDatabase.index_files(iter(files), progress,
+                                                workers=3)
+        self.assertAlmostEqual(progress.progress,
+                               progress.progress_bar_length, delta=1)
+
+def klv(key, value):
+    """Encodes a KLV packet with a 4-byte BER length."""
+    return key + b'\x83' + len(value).to_bytes(3, 'big') + value
+
+def local_set(settype, uid, **items):
+    """Encodes an MXF local set of settype, with items given as
+    tag_XXXX=value keyword arguments."""
+    value = (0x3c0a).to_bytes(2, 'big') + (16).to_bytes(2, 'big') + uid
+    for tag, item in items.items():
+        value += bytes.fromhex(tag[4:]) + len(item).to_bytes(2, 'big') + item
+    return klv(bytes.fromhex('060e2b34025301010d0101010101') +
+               bytes((settype, 0)), value)
+
+def batch(*items):
+    """Encodes an MXF batch of equally sized items."""
+    return (len(items).to_bytes(4, 'big') + len(items[0]).to_bytes(4, 'big') +
+            b''.join(items))
+
+def make_opatom(umid, name, mediatype, essence=b'', reel='A001',
+                material=None, tracks=None):
+    """Returns the bytes of a minimal OP-Atom MXF file, consisting of a
+    header partition with enough metadata to identify its media, and
+    the technical metadata of 48 frames of 1080p23.976 DNxHD or 24 bit
+    audio, starting at 01:00:00:00, made from a tape named reel. The
+    material package has the given umid and a track for each (umid,
+    mediatype) in tracks, by default just the file's own."""
+    picture, sound = '0103020201', '0103020202'
+    definition = lambda kind: bytes.fromhex('060e2b3404010101' +
+                                            (picture if kind == 'video' else sound) +
+                                            '000000')
+    data_definition = definition(mediatype)
+    uid = lambda n: bytes(15) + bytes((n,))
+    if material is None:
+        material = '0x' + umid[2:-2] + '00'
+    if tracks is None:
+        tracks = [(umid, mediatype)]
+    material_tracks = b''.join(
+        local_set(0x3b, uid(20 + i), tag_4801=(i + 1).to_bytes(4, 'big'),
+                  tag_4802=f'{kind[0].upper()}{i + 1}'.encode('utf-16-be'),
+                  tag_4803=uid(40 + i))
+        + local_set(0x11, uid(40 + i), tag_0201=definition(kind),
+                    tag_1101=bytes.fromhex(track[2:]))
+        for i, (track, kind) in enumerate(tracks))
+    tape_umid = bytes.fromhex(umid[2:])[:-1] + b'\xff'
+    edit_rate = (24000).to_bytes(4, 'big') + (1001).to_bytes(4, 'big')
+    if mediatype == 'video':
+        descriptor = local_set(
+            0x28, uid(7), tag_3001=edit_rate, tag_3002=(48).to_bytes(8, 'big'),
+            tag_3203=(1920).to_bytes(4, 'big'), tag_3202=(1080).to_bytes(4, 'big'),
+            tag_320c=b'\x00', tag_3301=(10).to_bytes(4, 'big'),
+            tag_3302=(2).to_bytes(4, 'big'), tag_3308=(1).to_bytes(4, 'big'),
+            tag_3201=bytes.fromhex('060e2b340401010a0401020271280000'))
+    else:
+        descriptor = local_set(0x48, uid(7), tag_3001=edit_rate,
+                               tag_3002=(48).to_bytes(8, 'big'),
+                               tag_3d01=(24).to_bytes(4, 'big'))
+    metadata = (
+        klv(bytes.fromhex('060e2b34020501010d01020101050100'), batch(bytes(18)))
+        + local_set(0x36, uid(1), tag_4401=bytes.fromhex(material[2:]),
+                    tag_4402=name.encode('utf-16-be') + b'\x00\x00',
+                    tag_4403=batch(*(uid(20 + i) for i in range(len(tracks)))))
+        + material_tracks
+        + local_set(0x37, uid(4), tag_4401=bytes.fromhex(umid[2:]),
+                    tag_4403=batch(uid(9), uid(5)), tag_4701=uid(7))
+        + local_set(0x3b, uid(9), tag_4b01=edit_rate, tag_4803=uid(10))
+        + local_set(0x14, uid(10), tag_1501=(86400).to_bytes(8, 'big'),
+                    tag_1502=(24).to_bytes(2, 'big'), tag_1503=b'\x00')
+        + local_set(0x3b, uid(5), tag_4b01=edit_rate, tag_4803=uid(6))
+        + local_set(0x0f, uid(6), tag_0201=data_definition,
+                    tag_0202=(48).to_bytes(8, 'big'), tag_1001=batch(uid(11)))
+        + local_set(0x11, uid(11), tag_0201=data_definition,
+                    tag_1101=tape_umid)
+        + descriptor
+        + local_set(0x37, uid(12), tag_4401=tape_umid,
+                    tag_4402=reel.encode('utf-16-be'))
+        + local_set(0x23, uid(8), tag_2701=bytes.fromhex(umid[2:])))
+    pack = bytes(32) + len(metadata).to_bytes(8, 'big') + bytes(48)
+    partition = klv(bytes.fromhex('060e2b34020501010d01020101020400'), pack)
+    fill = klv(bytes.fromhex('060e2b34010101020301021001000000'), bytes(64))
+    return partition + fill + metadata + essence
+
+class TestHeaderProbe(unittest.TestCase, AcceptanceCase):
+    """We should be able to read the umid, mediatype and name of an
+    OP-Atom MXF file without running ffprobe."""
+
+    umid = '0x060a2b340101010501010d00133c5edc52947134b13c5edc0052947134b13c01'
+
+    def setUp(self):
+        self.make_tempdir()
+
+    def tearDown(self):
+        self.cleanup_tempdir()
+
+    def write_file(self, fname, data):
+        """Writes data to fname in the tempdir and returns its path."""
+        path = self.get_temp_file(fname)
+        with open(path, 'wb') as filehandle:
+            filehandle.write(data)
+        return path
+
+    def test_header_probe(self):
+        """Parse video and audio headers and expect the same values
+        Probe would report."""
+        for mediatype in ('video', 'audio'):
+            path = self.write_file(f'{mediatype}.mxf',
+                                   make_opatom(self.umid, 'A001C001', mediatype))
+            probe = mxfdb.HeaderProbe(path)
+            self.assertEqual(probe.umid, self.umid)
+            self.assertEqual(probe.name, 'A001C001')
+            self.assertEqual(probe.mediatype, mediatype)
+            self.assertEqual(probe.type, mediatype)
+            self.assertEqual(probe.file, f'{mediatype}.mxf')
+
+    def test_technical_metadata(self):
+        """Read timing, picture and reel metadata from the header, as
+        ffprobe would report it, and drop frame timecode."""
+        data = make_opatom(self.umid, 'A001C001', 'video')
+        path = self.write_file('video.mxf', data)
+        self.assertEqual(mxfdb.HeaderProbe(path).technical,
+                         dict(framerate='24000/1001', start_tc='01:00:00:00',
+                              duration=2.002, width=1920, height=1080,
+                              pix_fmt='yuv422p10le', codec='dnxhd',
+                              bitrate=int(len(data) * 8 / 2.002),
+                              size=len(data), reel_name='A001',
+                              reel_umid=self.umid[:-2] + 'ff',
+                              track_name='V1', format_name='mxf'))
+        path = self.write_file('audio.mxf', make_opatom(self.umid, 'A001C001',
+                                                       'audio'))
+        technical = mxfdb.HeaderProbe(path).technical
+        self.assertEqual(technical['codec'], 'pcm_s24le')
+        self.assertIsNone(technical['width'])
+        # ffprobe gives sound streams no frame rate
+        self.assertEqual(technical['framerate'], '0/0')
+        self.assertIsNotNone(technical['duration'])
+        self.assertEqual(mxfdb.format_timecode(17982 * 6 + 1800, 30, True),
+                         '01:01:00;02')
+
+    def test_reads_only_header(self):
+        """Reading the header should stop at the end of the header
+        metadata, without touching the essence."""
+        header = make_opatom(self.umid, 'A001C001', 'video')
+        filehandle = io.BytesIO(header + b'\xff' * 100000)
+        mxfdb.MXFHeader.read(filehandle)
+        self.assertEqual(filehandle.tell(), len(header))
+
+    def test_zipped_members(self):
+        """Zipped MXF files should be identified from their leading
+        bytes alone, whether stored or compressed."""
+        essence = bytes(range(256)) * 4000
+        zippath = self.get_temp_file('media.zip')
+        with ZipFile(zippath, 'w') as ziphandle:
+            for mediatype, compression in (('video', zipfile.ZIP_STORED),
+                                           ('audio', zipfile.ZIP_DEFLATED)):
+                data = make_opatom(self.umid, 'A001C001', mediatype, essence)
+                ziphandle.writestr(f'{mediatype}.mxf', data,
+                                   compress_type=compression)
+        members = list(mxfdb.MediaDatabase.get_zipped(zippath))
+        self.assertEqual(len(members), 2)
+        for (member, altpath), mediatype in zip(members, ('video', 'audio')):
+            self.assertEqual(altpath, os.path.join(zippath, f'{mediatype}.mxf'))
+            self.assertLess(len(member.data), len(essence))
+            probe = mxfdb.probe_mediafile(member)
+            self.assertEqual(probe.mediatype, mediatype)
+            self.assertEqual(probe.umid, self.umid)
+
+    def test_fallback_to_ffprobe(self):
+        """Files that can't be parsed should be probed with ffprobe."""
+        path = self.write_file('notmxf.mxf', b'not an mxf file')
+        with self.assertRaises(mxfdb.MXFHeaderError):
+            mxfdb.HeaderProbe(path)
+        with mock.patch.object(mxfdb, 'Probe', FakeProbe):
+            probe = mxfdb.probe_mediafile(path)
+        self.assertIsInstance(probe, FakeProbe)
+
+def make_umid(number):
+    """Returns a distinct umid string for a test file."""
+    return '0x060a2b340101010501010d0013' + f'{number:038x}'
+
+class MediaFolderCase(unittest.TestCase, AcceptanceCase):
+    """Sets up an MXF folder on a temporary volume to write synthetic
+    OP-Atom files into."""
+
+    def setUp(self):
+        self.make_tempdir()
+        self.mxfdir = self.get_temp_file('Test Volume', 'Avid MediaFiles',
+                                         'MXF', '1')
+        os.makedirs(self.mxfdir)
+        self.connection = sqlite3.connect(':memory:')
+        self.db = mxfdb.MediaDatabase(self.connection, quiet=True, workers=1,
+                                      volumes=[self.get_temp_file('Test Volume')])
+        self.probed = list()
+
+    def tearDown(self):
+        self.cleanup_tempdir()
+
+    def write_media(self, number, mediatype='video'):
+        """Writes a synthetic OP-Atom file to the MXF folder and returns
+        its umid."""
+        umid = make_umid(number)
+        path = os.path.join(self.mxfdir, f'A001C{number:03}.{mediatype}.mxf')
+        with open(path, 'wb') as filehandle:
+            filehandle.write(make_opatom(umid, f'A001C{number:03}', mediatype))
+        return umid
+
+class TestIncrementalIndex(MediaFolderCase):
+    """Rescanning a volume should only probe files that were added or
+    changed, and forget files that were removed."""
+
+    def index(self):
+        """Indexes the test volume, recording every file probed."""
+        probe_mediafile = mxfdb.probe_mediafile
+        def counting_probe(file):
+            self.probed.append(os.path.basename(str(file)))
+            return probe_mediafile(file)
+        self.probed = list()
+        with mock.patch.object(mxfdb, 'probe_mediafile', counting_probe):
+            self.db.index_all()
+
+    def test_rescan_probes_changes_only(self):
+        """Add, change and remove files between scans and expect only
+        the new and changed files to be probed."""
+        umids = list(self.write_media(i) for i in range(5))
+        self.index()
+        self.assertEqual(len(self.probed), 5)
+        self.index()
+        self.assertEqual(self.probed, [])
+
+        new_umid = self.write_media(5, 'audio')
+        os.remove(os.path.join(self.mxfdir, 'A001C000.video.mxf'))
+        changed = os.path.join(self.mxfdir, 'A001C001.video.mxf')
+        stat = os.stat(changed)
+        os.utime(changed, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.index()
+        self.assertEqual(sorted(self.probed),
+                         ['A001C001.video.mxf', 'A001C005.audio.mxf'])
+        self.assertIn(new_umid, self.db)
+        self.assertNotIn(umids[0], self.db)
+        for umid in umids[1:]:
+            self.assertIn(umid, self.db)
+
+    def test_copies_in_one_folder_keep_rows(self):
+        """Copies of a file in one folder should each keep a row."""
+        umid = self.write_media(0)
+        original = os.path.join(self.mxfdir, 'A001C000.video.mxf')
+        copy = os.path.join(self.mxfdir, 'A001C000.copy.mxf')
+        with open(original, 'rb') as source, open(copy, 'wb') as filehandle:
+            filehandle.write(source.read())
+        self.index()
+        paths = lambda: list(row[0] for row in self.connection.execute(
+            'SELECT path FROM Media WHERE umid=? ORDER BY path',
+            (mxfdb.encode_umid(umid),)))
+        self.assertEqual(paths(), [copy, original])
+        self.index()
+        self.assertEqual(self.probed, [])
+        # removing one copy leaves the other indexed
+        os.remove(original)
+        self.index()
+        self.assertEqual(self.probed, [])
+        self.assertEqual(paths(), [copy])
+
+    def test_interrupted_index_resumes(self):
+        """Batches committed before an interruption should not be probed
+        again."""
+        umids = list(self.write_media(i) for i in range(7))
+        probe_mediafile = mxfdb.probe_mediafile
+        def interrupted_probe(file):
+            if len(self.probed) == 5:
+                raise KeyboardInterrupt
+            self.probed.append(os.path.basename(str(file)))
+            return probe_mediafile(file)
+        with mock.patch.object(mxfdb, 'INSERT_BATCH', 2), \
+             mock.patch.object(mxfdb, 'probe_mediafile', interrupted_probe):
+            with self.assertRaises(KeyboardInterrupt):
+                self.db.index_all()
+        self.assertEqual(len(self.probed), 5)
+        first_run = set(self.probed)
+        self.assertEqual(sum(umid in self.db for umid in umids), 4)
+        self.index()
+        self.assertEqual(len(self.probed), 3)
+        self.assertEqual(len(first_run & set(self.probed)), 1)
+        for umid in umids:
+            self.assertIn(umid, self.db)
+
+    def test_failed_probes_are_quarantined(self):
+        """Files that fail to index should be quarantined, and not
+        probed again until they change."""
+        self.write_media(0)
+        broken = os.path.join(self.mxfdir, 'nostream.mxf')
+        with open(broken, 'wb') as filehandle:
+            filehandle.write(b'not an mxf file')
+        with mock.patch.object(mxfdb, 'Probe', FakeProbe):
+            with self.assertWarns(UserWarning):
+                self.index()
+            self.assertEqual(sorted(self.probed), ['A001C000.video.mxf',
+                                                   'nostream.mxf'])
+            self.index()
+            self.assertEqual(self.probed, [])
+            (source, volume, error, _), = self.db.quarantined()
+            self.assertEqual((source, volume), (broken, 'Test_Volume'))
+            self.assertTrue(error.startswith('TypeError: '))
+            self.assertEqual(self.db.quarantined(['Other_Volume']), [])
+
+            stat = os.stat(broken)
+            os.utime(broken, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            with self.assertWarns(UserWarning):
+                self.index()
+            self.assertEqual(self.probed, ['nostream.mxf'])
+
+        # once it can be probed, it is indexed and released
+        os.rename(broken, os.path.join(self.mxfdir, 'A001C001.video.mxf'))
+        self.write_media(1)
+        self.index()
+        self.assertEqual(self.probed, ['A001C001.video.mxf'])
+        self.assertEqual(self.db.quarantined(), [])
+        self.assertIn(make_umid(1), self.db)
+
+    def test_ffprobe_timeouts_are_quarantined(self):
+        """A file that makes ffprobe hang should be quarantined once
+        ffprobe times out."""
+        broken = os.path.join(self.mxfdir, 'hangs.mxf')
+        with open(broken, 'wb') as filehandle:
+            filehandle.write(b'not an mxf file')
+        def hang(args, **kwargs):
+            self.assertEqual(kwargs['timeout'], mxfdb.FFPROBE_TIMEOUT)
+            raise subprocess.TimeoutExpired(args, kwargs['timeout'])
+        with mock.patch.object(mxfdb.subprocess, 'run', hang), \
+             mock.patch.object(probecache, 'get_cache', lambda: None), \
+             self.assertWarns(UserWarning):
+            self.index()
+        self.assertEqual(self.probed, ['hangs.mxf'])
+        (source, _, error, _), = self.db.quarantined()
+        self.assertEqual(source, broken)
+        self.assertTrue(error.startswith('TimeoutExpired: '))
+        self.index()
+        self.assertEqual(self.probed, [])
+
+    def test_mediafiles_from_index(self):
+        """Lookups should return the technical metadata stored when
+        files were indexed, as mobs.MediaFile objects, but not for rows
+        indexed without it."""
+        umid = self.write_media(0)
+        self.index()
+        mediafile = next(self.db.get_umids('A001C000', 'video')).to_mob()
+        self.assertEqual(mediafile.umid, umid)
+        self.assertEqual(mediafile.clip_name, 'A001C000')
+        self.assertEqual(mediafile.src_start_tc, '01:00:00:00')
+        self.assertEqual(mediafile.src_end_tc, '01:00:02:00')
+        self.assertEqual(mediafile.source_size, (1920, 1080))
+        self.assertEqual(mediafile.pix_fmt, 'yuv422p10le')
+        self.assertEqual(mediafile.tape, 'A001')
+        self.connection.execute('UPDATE Media SET framerate=NULL')
+        self.assertIsNone(self.db[umid].to_mob())
+
+    def test_mob_from_index_matches_probe(self):
+        """A mob built from the index, whether the file was read from
+        its header or with ffprobe, should be the same as one probed
+        from the file."""
+        umid = self.write_media(0)
+        path = os.path.join(self.mxfdir, 'A001C000.video.mxf')
+        size = os.path.getsize(path)
+        output = dict(
+            streams=[dict(index=0, codec_type='video', codec_name='dnxhd',
+                          width=1920, height=1080, pix_fmt='yuv422p10le',
+                          r_frame_rate='24000/1001', duration='2.002000',
+                          tags=dict(file_package_umid=umid,
+                                    reel_umid=umid[:-2] + 'ff',
+                                    reel_name='A001', track_name='V1',
+                                    timecode='01:00:00:00'))],
+            format=dict(format_name='mxf', size=str(size),
+                        bit_rate=str(int(size * 8 / 2.002)),
+                        tags=dict(material_package_name='A001C000',
+                                  material_package_umid=umid[:-2] + '00')))
+        def ffprobe(filepath, data=None):
+            return output
+        with mock.patch.object(mediafile_module, 'run_ffprobe', ffprobe), \
+             mock.patch.object(mxfdb, 'ffprobe', ffprobe):
+            probed = vars(mobs.MediaFile.probe(path))
+            self.index()
+            self.assertEqual(vars(self.db[umid].to_mob()), probed)
+            stat = os.stat(path)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            with mock.patch.object(mxfdb.MXFHeader, 'read',
+                                   side_effect=mxfdb.MXFHeaderError):
+                self.index()
+            self.assertEqual(self.probed, ['A001C000.video.mxf'])
+            self.assertEqual(vars(self.db[umid].to_mob()), probed)
+
+    def test_adopt_folder_indexed_by_earlier_version(self):
+        """Rows indexed before files were tracked individually should
+        be kept without probing, as long as the folder is unchanged."""
+        umid = self.write_media(0)
+        self.index()
+        self.connection.execute('DELETE FROM Sources')
+        self.connection.execute('UPDATE Media SET source=NULL')
+        self.index()
+        self.assertEqual(self.probed, [])
+        self.assertIn(umid, self.db)
+        self.index()
+        self.assertEqual(self.probed, [])
+
+class TestIndexMetrics(MediaFolderCase):
+    """Indexing should report counters and probe latencies for each
+    folder, volume and run."""
+
+    def setUp(self):
+        super().setUp()
+        self.metrics_file = self.get_temp_file('metrics.jsonl')
+        self.records = list()
+        self.db.metrics = mxfmetrics.IndexMetrics(self.metrics_file,
+                                                  self.records.append)
+
+    def test_folder_volume_and_run_records(self):
+        for i in range(3):
+            self.write_media(i)
+        with open(os.path.join(self.mxfdir, 'nostream.mxf'), 'wb') as filehandle:
+            filehandle.write(b'not an mxf file')
+        with mock.patch.object(mxfdb, 'Probe', FakeProbe):
+            with self.assertWarns(UserWarning):
+                self.db.index_all()
+        self.assertEqual([record['event'] for record in self.records],
+                         ['folder', 'volume', 'run'])
+        folder, volume, run = self.records
+        self.assertEqual(folder['path'], self.mxfdir)
+        self.assertEqual(folder['volume'], 'Test_Volume')
+        self.assertEqual((folder['files'], folder['changed'], folder['probed'],
+                          folder['header'], folder['failed']), (4, 4, 4, 3, 1))
+        self.assertEqual(folder['latency']['header']['count'], 3)
+        self.assertEqual(len(folder['changed_sample']), 4)
+        self.assertIsNone(folder['changed_sample'][0]['was'])
+        for record in (volume, run):
+            self.assertEqual((record['folders'], record['probed']), (1, 4))
+            self.assertEqual(record['bytes'], folder['bytes'])
+        self.assertEqual(self.db.metrics.last_run.probed, 4)
+        with open(self.metrics_file) as filehandle:
+            self.assertEqual(len(filehandle.readlines()), 3)
+
+    def test_rescan_reports_unchanged(self):
+        self.write_media(0)
+        self.db.index_all()
+        self.records.clear()
+        self.db.index_all()
+        folder = self.records[0]
+        self.assertEqual((folder['files'], folder['unchanged'],
+                          folder['probed']), (1, 1, 0))
+        self.assertNotIn('changed_sample', folder)
+
+    def test_latency_histogram(self):
+        histogram = mxfmetrics.LatencyHistogram()
+        for seconds in (0.0005, 0.003, 0.003, 0.04, 12):
+            histogram.add(seconds)
+        summary = histogram.as_dict()
+        self.assertEqual(summary['buckets'],
+                         {'<=1': 1, '<=5': 2, '<=50': 1, '>10000': 1})
+        self.assertEqual(summary['p50_ms'], 5)
+        self.assertEqual(summary['p99_ms'], 12000)
+
+class TestScanTree(MediaFolderCase):
+    """Repository volumes should be walked in parallel, with files
+    probed as soon as they are found."""
+
+    def make_tree(self):
+        """Writes a nested tree of media and other files, returning the
+        paths of the media."""
+        paths = list()
+        for depth in range(4):
+            folder = self.get_temp_file('repo', *(f'd{i}' for i in range(depth)))
+            for branch in range(3):
+                os.makedirs(os.path.join(folder, f'b{branch}'), exist_ok=True)
+                for name in ('clip.mxf', 'notes.txt', 'media.zip'):
+                    path = os.path.join(folder, f'b{branch}', name)
+                    with open(path, 'wb') as filehandle:
+                        filehandle.write(b'x')
+                    if not path.endswith('.txt'):
+                        paths.append(path)
+        return paths
+
+    def test_parallel_matches_serial(self):
+        paths = self.make_tree()
+        repo = self.get_temp_file('repo')
+        serial = dict(mxfdb.MediaDatabase.get_dir_recursive(repo, workers=1))
+        parallel = dict(mxfdb.MediaDatabase.get_dir_recursive(repo, workers=4))
+        self.assertEqual(sorted(serial), sorted(paths))
+        self.assertEqual(parallel, serial)
+        self.assertEqual(serial[paths[0]].size, 1)
+        no_zips = mxfdb.MediaDatabase.get_dir_recursive(repo, False, workers=4)
+        self.assertEqual(sorted(path for path, _ in no_zips),
+                         sorted(path for path in paths if path.endswith('.mxf')))
+
+    def test_unreadable_directories_are_skipped(self):
+        """A directory that can't be listed should be warned about and
+        yielded without a FileStat, and system folders not walked."""
+        paths = self.make_tree()
+        repo = self.get_temp_file('repo')
+        unreadable = os.path.join(repo, 'b1')
+        os.makedirs(os.path.join(repo, '.Trashes', 'b0'))
+        scandir = os.scandir
+        def failing_scandir(path):
+            if path == unreadable or os.path.basename(path) == '.Trashes':
+                raise PermissionError(13, 'Permission denied', path)
+            return scandir(path)
+        for workers in (1, 4):
+            with mock.patch.object(mxfdb.os, 'scandir', failing_scandir), \
+                 self.assertWarns(UserWarning):
+                listed = dict(mxfdb.scan_tree(repo, mxfdb.is_mediafile,
+                                              workers=workers))
+            self.assertIsNone(listed.pop(unreadable))
+            self.assertEqual(sorted(listed), sorted(
+                path for path in paths if path.endswith('.mxf') and
+                not path.startswith(unreadable + os.sep)))
+
+    def test_unreadable_directories_keep_rows(self):
+        """Files indexed in a directory that can't be listed any more
+        should keep their rows, and the rest of the volume be indexed."""
+        repo = self.get_temp_file('Repo')
+        folder = os.path.join(repo, 'folder')
+        unreadable = os.path.join(folder, 'old')
+        os.makedirs(unreadable)
+        os.makedirs(os.path.join(repo, '.Trashes'))
+        umids = list(self.write_media(i) for i in range(3))
+        def move(number, target):
+            shutil.move(os.path.join(self.mxfdir, f'A001C{number:03}.video.mxf'),
+                        target)
+        move(0, unreadable)
+        move(1, folder)
+        db = mxfdb.MediaDatabase(sqlite3.connect(':memory:'), quiet=True,
+                                 workers=1, volumes=[], repo_volumes=[repo])
+        db.index_all()
+        move(2, folder)
+        scandir = os.scandir
+        def failing_scandir(path):
+            if path == unreadable or os.path.basename(path) == '.Trashes':
+                raise PermissionError(13, 'Permission denied', path)
+            return scandir(path)
+        with mock.patch.object(mxfdb.os, 'scandir', failing_scandir), \
+             self.assertWarns(UserWarning):
+            self.assertTrue(db.index_all())
+        for umid in umids:
+            self.assertIn(umid, db)
+        self.assertEqual(db.conn.execute('SELECT COUNT(*) FROM Directory')
+                         .fetchone()[0], 1)
+        db.close()
+
+    def test_files_probed_as_listed(self):
+        for i in range(3):
+            self.write_media(i)
+        events = list()
+        def listing(path):
+            for source, stat in mxfdb.MediaDatabase.get_dir(path):
+                events.append('listed')
+                yield source, stat
+        probe_mediafile = mxfdb.probe_mediafile
+        def probe(file):
+            events.append('probed')
+            return probe_mediafile(file)
+        with mock.patch.object(mxfdb, 'probe_mediafile', probe):
+            self.db.index_folder('Test_Volume', self.mxfdir, listing)
+        self.assertEqual(events, ['listed', 'probed'] * 3)
+        found = self.db.lookup_many([make_umid(i) for i in range(3)])
+        self.assertTrue(all(found.values()))
+
+class TestShards(MediaFolderCase):
+    """With a shard directory, each volume should be indexed into a
+    shard database of its own, attached for lookups while the volume
+    is mounted."""
+
+    def setUp(self):
+        super().setUp()
+        self.shard_dir = self.get_temp_file('shards')
+        self.volumes = [self.get_temp_file('Test Volume'),
+                        self.get_temp_file('Other Volume')]
+        self.otherdir = os.path.join(self.volumes[1], 'Avid MediaFiles',
+                                     'MXF', '1')
+        os.makedirs(self.otherdir)
+
+    def write_other(self, number):
+        """Writes a synthetic OP-Atom file to the second volume."""
+        umid = make_umid(number)
+        path = os.path.join(self.otherdir, f'B001C{number:03}.video.mxf')
+        with open(path, 'wb') as filehandle:
+            filehandle.write(make_opatom(umid, f'B001C{number:03}', 'video'))
+        return umid
+
+    def open_sharded(self, **kwargs):
+        return mxfdb.MediaDatabase(sqlite3.connect(':memory:'), quiet=True,
+                                   workers=1, volumes=self.volumes,
+                                   shard_dir=self.shard_dir, **kwargs)
+
+    def test_volumes_indexed_into_shards(self):
+        umid = self.write_media(0)
+        other = self.write_other(100)
+        db = self.open_sharded()
+        db.index_all()
+        self.assertEqual(sorted(name for name in os.listdir(self.shard_dir)
+                                if name.endswith(mxfdb.SHARD_SUFFIX)),
+                         ['Other_Volume.mxfdb', 'Test_Volume.mxfdb'])
+        self.assertEqual(db.conn.execute('SELECT COUNT(*) FROM main.Media')
+                         .fetchone()[0], 0)
+        self.assertEqual(db[umid].name, 'A001C000')
+        self.assertEqual(db[other].name, 'B001C100')
+        found = db.get_umids_many(['A001C000', 'B001C100'])
+        self.assertEqual([media.umid for media in found['B001C100']], [other])
+        self.assertEqual(db.search('b001c10')[0].name, 'B001C100')
+        self.assertEqual(len(list(db.directory.folders())), 2)
+
+        # an unmounted volume is detached, and attached again on return
+        os.rename(self.volumes[1], self.volumes[1] + ' offline')
+        self.assertEqual(db.attach_shards(), ['Test_Volume'])
+        self.assertNotIn(other, db)
+        self.assertIn(umid, db)
+        os.rename(self.volumes[1] + ' offline', self.volumes[1])
+        db.attach_shards()
+        self.assertIn(other, db)
+        db.close()
+
+    def test_rows_move_into_new_shard(self):
+        umid = self.write_media(0)
+        connection = sqlite3.connect(':memory:')
+        db = mxfdb.MediaDatabase(connection, quiet=True, workers=1,
+                                 volumes=self.volumes[:1])
+        db.index_all()
+        db.shard_dir = self.shard_dir
+        os.makedirs(self.shard_dir)
+        with mock.patch.object(mxfdb, 'probe_mediafile') as probe:
+            db.index_all()
+        probe.assert_not_called()
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM main.Media')
+                         .fetchone()[0], 0)
+        self.assertEqual(db.shards, {'Test_Volume': 'shard_Test_Volume'})
+        self.assertIn(umid, db)
+
+    def test_parallel_processes(self):
+        umids = [self.write_media(0), self.write_other(100)]
+        records = list()
+        db = self.open_sharded(processes=2,
+                               metrics=mxfmetrics.IndexMetrics(
+                                   callback=records.append))
+        db.index_all()
+        for umid in umids:
+            self.assertIn(umid, db)
+        self.assertEqual(sorted(record['event'] for record in records),
+                         ['folder', 'folder', 'run', 'volume', 'volume'])
+        self.assertEqual(db.metrics.last_run.probed, 2)
+        db.close()
+
+class TestSnapshots(MediaFolderCase):
+    """A snapshot exported from one index should import into another
+    without probing media that hasn't changed since."""
+
+    def setUp(self):
+        super().setUp()
+        self.snapshot = self.get_temp_file('index.mxfdb.gz')
+
+    def import_counting(self, db, **kwargs):
+        """Imports the snapshot into db, recording every file probed."""
+        probe_mediafile = mxfdb.probe_mediafile
+        def counting_probe(file):
+            self.probed.append(os.path.basename(str(file)))
+            return probe_mediafile(file)
+        with mock.patch.object(mxfdb, 'probe_mediafile', counting_probe):
+            return mxfsnapshot.import_snapshot(db, self.snapshot, **kwargs)
+
+    def test_import_reprobes_changed_only(self):
+        umids = list(self.write_media(i) for i in range(3))
+        self.db.index_all()
+        self.assertEqual(mxfsnapshot.export_snapshot(self.db, self.snapshot), 1)
+
+        changed = os.path.join(self.mxfdir, 'A001C001.video.mxf')
+        stat = os.stat(changed)
+        os.utime(changed, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        umids.append(self.write_media(3))
+        db = mxfdb.MediaDatabase(sqlite3.connect(':memory:'), quiet=True,
+                                 workers=1)
+        counts = self.import_counting(db)
+        self.assertEqual(counts, dict(folders=1, imported=2, current=0, stale=1))
+        self.assertEqual(sorted(self.probed),
+                         ['A001C001.video.mxf', 'A001C003.video.mxf'])
+        for umid in umids:
+            self.assertIn(umid, db)
+        self.assertEqual(db[umids[0]].framerate, '24000/1001')
+        self.assertEqual(db.resolve_reels(['a001c000'])['a001c000'][0].umid,
+                         umids[0])
+
+        self.probed = list()
+        counts = self.import_counting(db)
+        self.assertEqual((counts['imported'], counts['current']), (0, 2))
+        self.assertEqual(self.probed, [])
+
+    def test_import_into_shard(self):
+        umid = self.write_media(0)
+        self.db.index_all()
+        mxfsnapshot.export_snapshot(self.db, self.snapshot,
+                                    volumes=['Test_Volume'])
+        shard_dir = self.get_temp_file('shards')
+        db = mxfdb.MediaDatabase(sqlite3.connect(':memory:'), quiet=True,
+                                 workers=1, shard_dir=shard_dir)
+        self.import_counting(db)
+        self.assertEqual(self.probed, [])
+        self.assertTrue(os.path.exists(db.shard_file('Test_Volume')))
+        self.assertIn(umid, db)
+        db.close()
+
+    def test_unknown_versions_are_refused(self):
+        with gzip.open(self.snapshot, 'wt') as filehandle:
+            filehandle.write(json.dumps(dict(format=mxfsnapshot.FORMAT,
+                                             version=mxfsnapshot.VERSION + 1)))
+        with self.assertRaises(ValueError):
+            mxfsnapshot.import_snapshot(self.db, self.snapshot)
+
+class TestClips(MediaFolderCase):
+    """The video and audio files of a clip should be found together,
+    through the tracks of its material package."""
+
+    material = '0x060a2b340101010501010d00130000000000000000000000000000000000aa00'
+
+    def write_clip(self, name, numbers):
+        """Writes a video file and audio files for a clip named name,
+        each listing every track of the clip. Returns their umids."""
+        kinds = ['video'] + ['audio'] * (len(numbers) - 1)
+        tracks = list((make_umid(number), kind)
+                      for number, kind in zip(numbers, kinds))
+        for i, (umid, kind) in enumerate(tracks):
+            path = os.path.join(self.mxfdir, f'{name}.{kind[0].upper()}{i}.mxf')
+            with open(path, 'wb') as filehandle:
+                filehandle.write(make_opatom(umid, name, kind,
+                                             material=self.material,
+                                             tracks=tracks))
+        return list(umid for umid, _ in tracks)
+
+    def test_get_clip(self):
+        umids = self.write_clip('A001C001', [1, 2, 3])
+        self.write_media(4)
+        self.db.index_all()
+        clip = self.db.get_clip('A001C001')
+        self.assertEqual(list(media.umid for media in clip), umids)
+        self.assertEqual(list(media.mediatype for media in clip),
+                         ['video', 'audio', 'audio'])
+        self.assertEqual(clip[0].material, self.material)
+        self.assertEqual(self.db.get_clip('missing'), [])
+        self.assertEqual(len(self.db.get_clip('A001C004')), 1)
+
+    def test_tracks_of_missing_files_are_kept(self):
+        umids = self.write_clip('A001C001', [1, 2, 3])
+        os.remove(os.path.join(self.mxfdir, 'A001C001.A2.mxf'))
+        self.db.index_all()
+        self.assertEqual(list(media.umid for media in
+                              self.db.get_clip('A001C001')), umids[:2])
+        tracks = self.connection.execute('SELECT umid, mediatype, track FROM ' +
+                                         'Tracks ORDER BY track').fetchall()
+        tracks = list((mxfdb.decode_umid(umid), *track) for umid, *track in tracks)
+        self.assertEqual(tracks, [(umids[0], 'video', 1), (umids[1], 'audio', 2),
+                                  (umids[2], 'audio', 3)])
+        for filename in os.listdir(self.mxfdir):
+            os.remove(os.path.join(self.mxfdir, filename))
+        self.db.index_all()
+        self.assertEqual(self.connection.execute(
+            'SELECT COUNT(*) FROM Tracks').fetchone()[0], 0)
+
+    def test_ffprobe_tracks(self):
+        """Data streams describing related files should give the same
+        tracks as the header."""
+        umids = list(make_umid(number) for number in range(3))
+        streams = [dict(id='0x1', codec_type='video',
+                        tags=dict(file_package_umid=umids[0].upper())),
+                   dict(id='0x2', codec_type='data',
+                        tags=dict(file_package_umid=umids[1], data_type='audio')),
+                   dict(id='0x3', codec_type='data', tags=dict())]
+        self.assertEqual(mxfdb.get_clip_tracks(streams),
+                         [(umids[0], 'video', 1), (umids[1], 'audio', 2)])
+
+    def test_missing_track_ids_are_filled_in(self):
+        """A file probed with ffprobe, which may report no track ids,
+        shouldn't lose the ids read from the header of a sibling."""
+        mxftable = mxfdb.MXFTable('Test_Volume_1', self.connection)
+        umid = make_umid(1)
+        mxftable.add_tracks([(self.material, umid, 'video', 1)])
+        mxftable.add_tracks([(self.material, umid, 'video', None),
+                             (self.material, make_umid(2), 'audio', None)])
+        mxftable.add_tracks([(self.material, make_umid(2), 'audio', 2)])
+        self.assertEqual(self.connection.execute(
+            'SELECT track FROM Tracks ORDER BY umid').fetchall(), [(1,), (2,)])
+
+class TestVolumeIdentity(MediaFolderCase):
+    """A renamed or remounted volume should keep its index, found by
+    the id in its marker file, without probing its files again."""
+
+    def rename_volume(self, name):
+        """Renames the test volume, returning its new path."""
+        path = self.get_temp_file(name)
+        os.rename(self.get_temp_file('Test Volume'), path)
+        self.mxfdir = os.path.join(path, 'Avid MediaFiles', 'MXF', '1')
+        return path
+
+    def index_counting(self, db):
+        """Indexes db, recording every file probed."""
+        probe_mediafile = mxfdb.probe_mediafile
+        def counting_probe(file):
+            self.probed.append(os.path.basename(str(file)))
+            return probe_mediafile(file)
+        with mock.patch.object(mxfdb, 'probe_mediafile', counting_probe):
+            db.index_all()
+
+    def test_marker_is_written_once(self):
+        vol = self.get_temp_file('Test Volume')
+        found = mxfdb.volume_id(vol)
+        self.assertIsNotNone(found)
+        self.assertTrue(os.path.isfile(os.path.join(vol, mxfdb.VOLUME_MARKER)))
+        self.assertEqual(mxfdb.volume_id(vol), found)
+
+    def test_ids_are_resolved_once(self):
+        """Each mounted volume's id should be looked up once per call,
+        however the volumes are then identified."""
+        self.write_media(0)
+        vol = self.get_temp_file('Test Volume')
+        mirror = self.get_temp_file('Mirror')
+        shutil.copytree(vol, mirror)
+        resolved = list()
+        def filesystem_uuid(path):
+            resolved.append(path)
+            return 'uuid-' + os.path.basename(path)
+        db = mxfdb.MediaDatabase(self.connection, quiet=True, workers=1,
+                                 volumes=[vol, mirror])
+        with mock.patch.object(mxfdb, 'filesystem_uuid', filesystem_uuid):
+            for _ in range(2):
+                resolved.clear()
+                db.identify_volumes()
+                self.assertEqual(sorted(resolved), sorted([vol, mirror]))
+        self.assertEqual(db.volume_ids.get('uuid-Mirror'), ('Mirror', mirror))
+
+    def test_renamed_volume_keeps_index(self):
+        umids = list(self.write_media(i) for i in range(3))
+        self.db.index_all()
+        vol = self.rename_volume('RAID 1')
+        db = mxfdb.MediaDatabase(self.connection, quiet=True, workers=1,
+                                 volumes=[vol])
+        self.index_counting(db)
+        self.assertEqual(self.probed, [])
+        self.assertEqual(db[umids[0]].path,
+                         os.path.join(self.mxfdir, 'A001C000.video.mxf'))
+        folders = self.connection.execute(
+            'SELECT DISTINCT volume, folder FROM Media').fetchall()
+        self.assertEqual(folders, [('RAID_1', 'RAID_1_1')])
+        self.assertIn('RAID_1_1', db.directory)
+        self.assertNotIn('Test_Volume_1', db.directory)
+
+        # changes made while renamed are still picked up
+        umids.append(self.write_media(3))
+        self.index_counting(db)
+        self.assertEqual(self.probed, ['A001C003.video.mxf'])
+
+    def test_mirrored_volumes_keep_their_own_index(self):
+        """A mirror copied file by file, marker included, should get an
+        id of its own rather than taking over the index of the original
+        while both are mounted."""
+        self.write_media(0)
+        vol = self.get_temp_file('Test Volume')
+        self.db.index_all()
+        mirror = self.get_temp_file('Mirror')
+        shutil.copytree(vol, mirror)
+        db = mxfdb.MediaDatabase(self.connection, quiet=True, workers=1,
+                                 volumes=[mirror, vol])
+        probed = list()
+        for _ in range(3):
+            self.probed = list()
+            self.index_counting(db)
+            probed.append(len(self.probed))
+        self.assertEqual(probed, [1, 0, 0])
+        self.assertNotEqual(mxfdb.volume_id(mirror), mxfdb.volume_id(vol))
+        volumes = self.connection.execute(
+            'SELECT DISTINCT volume FROM Media ORDER BY volume').fetchall()
+        self.assertEqual(volumes, [('Mirror',), ('Test_Volume',)])
+
+    def test_renamed_volume_keeps_shard(self):
+        shard_dir = self.get_temp_file('shards')
+        umid = self.write_media(0)
+        db = mxfdb.MediaDatabase(sqlite3.connect(':memory:'), quiet=True,
+                                 workers=1, shard_dir=shard_dir,
+                                 volumes=[self.get_temp_file('Test Volume')])
+        db.index_all()
+        vol = self.rename_volume('RAID 1')
+        db.volumes = [vol]
+        self.index_counting(db)
+        self.assertEqual(self.probed, [])
+        self.assertFalse(os.path.exists(db.shard_file('Test_Volume')))
+        self.assertTrue(os.path.exists(db.shard_file('RAID_1')))
+        self.assertEqual(db[umid].path,
+                         os.path.join(self.mxfdir, 'A001C000.video.mxf'))
+        db.close()
+
+class TestLazyIndex(MediaFolderCase):
+    """In lazy mode, lookups should be answered from the index as it
+    is, indexing only on a miss, and only folders not indexed
+    recently, most likely first."""
+
+    def lookup_counting(self, lookup):
+        """Runs lookup, recording every file probed, and returns its
+        result."""
+        probe_mediafile = mxfdb.probe_mediafile
+        def counting_probe(file):
+            self.probed.append(os.path.basename(str(file)))
+            return probe_mediafile(file)
+        self.probed = list()
+        with mock.patch.object(mxfdb, 'probe_mediafile', counting_probe):
+            return lookup()
+
+    def lazy_db(self):
+        """Returns a lazy MediaDatabase on the test connection."""
+        return mxfdb.MediaDatabase(self.connection, quiet=True, workers=1,
+                                   volumes=[self.get_temp_file('Test Volume')],
+                                   lazy=True)
+
+    def write_folder_media(self, folder, number):
+        """Writes a file to another numbered MXF folder, returning its
+        umid."""
+        mxfdir, self.mxfdir = self.mxfdir, os.path.join(
+            os.path.dirname(self.mxfdir), folder)
+        os.makedirs(self.mxfdir, exist_ok=True)
+        try:
+            return self.write_media(number)
+        finally:
+            self.mxfdir = mxfdir
+
+    def test_open_does_not_index(self):
+        db_file = self.get_temp_file('mxfdb.db')
+        umid = self.write_media(0)
+        db = self.lookup_counting(lambda: mxfdb.open(
+            db_file, volumes=[self.get_temp_file('Test Volume')], quiet=True,
+            workers=1, service=False, lazy=True))
+        self.assertEqual(self.probed, [])
+        self.assertEqual(self.lookup_counting(lambda: db[umid]).name, 'A001C000')
+        self.assertEqual(self.probed, ['A001C000.video.mxf'])
+        self.assertEqual(self.lookup_counting(lambda: db.get_clip('A001C000'))[0].umid,
+                         umid)
+        self.assertEqual(self.probed, [])
+        db.close()
+
+    def test_recent_folders_are_not_rescanned(self):
+        self.write_media(0)
+        self.db.index_all()
+        umid = self.write_media(1)
+        db = self.lazy_db()
+        self.assertNotIn(umid, db)
+        self.assertEqual(self.lookup_counting(lambda: db.get_umids_many(
+            ['A001C000', 'A001C001'])['A001C001']), [])
+        self.assertEqual(self.probed, [])
+
+    def test_miss_scans_likely_folders_first(self):
+        self.write_media(0)
+        self.write_folder_media('2', 1)
+        self.db.index_all()
+        indexed = self.db.directory.indexed('Test_Volume_1')[0]
+        umid = self.write_folder_media('2', 2)
+        db = self.lazy_db()
+        with mock.patch.object(mxfdb, 'LAZY_REFRESH', 0):
+            found = self.lookup_counting(lambda: db.lookup_many([umid]))
+        self.assertEqual(found[umid][0].name, 'A001C002')
+        self.assertEqual(self.probed, ['A001C002.video.mxf'])
+        # the folder without changes was never reached
+        self.assertEqual(db.directory.indexed('Test_Volume_1')[0], indexed)
+
+class TestWriterLease(MediaFolderCase):
+    """Only the process holding the writer lease on a database should
+    index it, while every thread and process goes on reading."""
+
+    def setUp(self):
+        super().setUp()
+        self.db_file = self.get_temp_file('mxfdb.db')
+        self.volumes = [self.get_temp_file('Test Volume')]
+
+    def hold_lease(self):
+        """Starts another process holding the writer lease on the test
+        database until its stdin is closed."""
+        code = ('import sys\n' +
+                'from turnovertools import mxflease\n' +
+                'mxflease.WriterLease.for_database(sys.argv[1]).acquire()\n' +
+                'print("held", flush=True)\n' +
+                'sys.stdin.read()\n')
+        root = os.path.dirname(os.path.dirname(mxflease.__file__))
+        process = subprocess.Popen([sys.executable, '-c', code, self.db_file],
+                                   cwd=root, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, text=True)
+        self.assertEqual(process.stdout.readline().strip(), 'held')
+        return process
+
+    def test_index_all_skips_while_lease_is_held(self):
+        umid = self.write_media(0)
+        holder = self.hold_lease()
+        try:
+            db = mxfdb.open(self.db_file, self.volumes, quiet=True,
+                            workers=1, service=False)
+            self.assertEqual(db.lease.holder(), holder.pid)
+            self.assertNotIn(umid, db)
+            self.assertFalse(db.index_all())
+        finally:
+            holder.stdin.close()
+            holder.wait()
+        self.assertIsNone(db.lease.holder())
+        self.assertTrue(db.index_all())
+        self.assertIn(umid, db)
+        db.close()
+
+    def test_lease_is_reentrant(self):
+        lease = mxflease.WriterLease.for_database(self.db_file)
+        self.assertIs(lease, mxflease.WriterLease.for_database(self.db_file))
+        with lease.holding() as outer:
+            with lease.holding(blocking=False) as inner:
+                self.assertTrue(outer and inner)
+            self.assertEqual(lease.holder(), os.getpid())
+        self.assertIsNone(lease.holder())
+
+    def test_lease_is_held_by_one_thread(self):
+        lease = mxflease.WriterLease.for_database(self.db_file)
+        acquired = list()
+        def acquire(blocking):
+            acquired.append(lease.acquire(blocking))
+            if acquired[-1]:
+                lease.release()
+        with lease.holding():
+            thread = threading.Thread(target=acquire, args=(False,))
+            thread.start()
+            thread.join()
+            thread = threading.Thread(target=acquire, args=(True,))
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+        thread.join(10)
+        self.assertEqual(acquired, [False, True])
+        self.assertIsNone(lease.holder())
+
+    def test_lease_waiting_on_another_process_doesnt_block_threads(self):
+        lease = mxflease.WriterLease.for_database(self.db_file)
+        holder = self.hold_lease()
+        acquired = list()
+        def acquire():
+            acquired.append(lease.acquire())
+            lease.release()
+        waiting = threading.Thread(target=acquire)
+        try:
+            waiting.start()
+            waiting.join(0.2)
+            started = time.perf_counter()
+            self.assertFalse(lease.acquire(blocking=False))
+            self.assertLess(time.perf_counter() - started, 1)
+        finally:
+            holder.stdin.close()
+            holder.wait()
+        waiting.join(10)
+        self.assertEqual(acquired, [True])
+
+    def test_lazy_miss_identifies_volumes_under_lease(self):
+        self.write_media(0)
+        marker = os.path.join(self.volumes[0], mxfdb.VOLUME_MARKER)
+        db = mxfdb.open(self.db_file, self.volumes, quiet=True,
+                        workers=1, service=False, lazy=True)
+        self.assertFalse(os.path.exists(marker))
+        holder = self.hold_lease()
+        try:
+            self.assertFalse(db.index_on_miss(lambda: False))
+            self.assertFalse(os.path.exists(marker))
+        finally:
+            holder.stdin.close()
+            holder.wait()
+        self.assertTrue(db.index_on_miss(lambda: False))
+        self.assertTrue(os.path.exists(marker))
+        db.close()
+
+    def test_import_snapshot_waits_for_lease(self):
+        umid = self.write_media(0)
+        self.db.index_all()
+        snapshot = self.get_temp_file('index.mxfdb.gz')
+        mxfsnapshot.export_snapshot(self.db, snapshot)
+        connection = sqlite3.connect(self.db_file, check_same_thread=False)
+        db = mxfdb.MediaDatabase(connection, quiet=True, workers=1,
+                                 volumes=self.volumes)
+        counts = list()
+        importing = threading.Thread(target=lambda: counts.append(
+            mxfsnapshot.import_snapshot(db, snapshot, reindex=False)))
+        holder = self.hold_lease()
+        try:
+            importing.start()
+            importing.join(0.2)
+            self.assertTrue(importing.is_alive())
+        finally:
+            holder.stdin.close()
+            holder.wait()
+        importing.join(10)
+        self.assertEqual(counts[0]['imported'], 1)
+        self.assertIn(umid, db)
+        db.close()
+
+    def test_readers_are_per_thread(self):
+        umid = self.write_media(0)
+        connections = mxfdb.ConnectionManager(self.db_file, quiet=True,
+                                              workers=1, volumes=self.volumes)
+        with connections.writer() as db:
+            self.assertTrue(db.index_all())
+        readers = list()
+        barrier = threading.Barrier(2, timeout=10)
+        def lookup():
+            with connections.reader() as db:
+                barrier.wait()
+                with connections.reader() as nested:
+                    self.assertIs(nested, db)
+                readers.append((db, db[umid].name))
+        threads = list(threading.Thread(target=lookup) for _ in range(2))
+        for thread in threads:
+            thread.start()
+        # a writer holding the lease doesn't block readers
+        with connections.writer() as db:
+            for thread in threads:
+                thread.join()
+        self.assertEqual(list(name for _, name in readers), ['A001C000'] * 2)
+        self.assertIsNot(readers[0][0], readers[1][0])
+        with connections.reader() as db:
+            self.assertIn(db, (reader for reader, _ in readers))
+        connections.close()
+
+class TestIndexService(MediaFolderCase):
+    """mxfdb.open should answer lookups through a running index service
+    instead of indexing, and index in-process when none is running."""
+
+    def setUp(self):
+        super().setUp()
+        self.db_file = self.get_temp_file('mxfdb.db')
+        self.volumes = [self.get_temp_file('Test Volume')]
+
+    def test_open_uses_running_service(self):
+        umid = self.write_media(0)
+        service = mxfdbservice.MediaIndexService(self.db_file, self.volumes,
+                                                 workers=1)
+        service.start()
+        try:
+            self.assertTrue(service.indexed.wait(10))
+            db = mxfdb.open(self.db_file, self.volumes, quiet=True)
+            self.assertIsInstance(db, mxfdbservice.MediaIndexClient)
+            self.assertIn(umid, db)
+            self.assertEqual(db[umid].name, 'A001C000')
+            self.assertEqual([media.umid for media in db.get_umids('A001C000')],
+                             [umid])
+            found = db.get_umids_many(['A001C000', 'missing'], 'video')
+            self.assertEqual([media.umid for media in found['A001C000']],
+                             [umid])
+            self.assertEqual(found['missing'], [])
+            with self.assertRaises(KeyError):
+                db[make_umid(1)]
+            db.close()
+        finally:
+            service.stop()
+        self.assertFalse(os.path.exists(service.path))
+
+    def test_open_falls_back_without_service(self):
+        umid = self.write_media(0)
+        with open(mxfdbservice.socket_path(self.db_file), 'w'):
+            pass
+        db = mxfdb.open(self.db_file, self.volumes, quiet=True, workers=1)
+        self.assertIsInstance(db, mxfdb.MediaDatabase)
+        self.assertIn(umid, db)
+
+    def test_reindex_failures_are_logged(self):
+        service = mxfdbservice.MediaIndexService(self.db_file, self.volumes,
+                                                 workers=1)
+        def fail():
+            service.stopped.set()
+            raise OSError('volume went away')
+        with mock.patch.object(service, 'reindex', fail), \
+             self.assertLogs(mxfdbservice.logger, 'ERROR') as logs:
+            service._index_loop()
+        self.assertIn('volume went away', logs.output[0])
+        self.assertIn('Traceback', logs.output[0])
+        service.connections.close()
+
+    def test_watcher_failures_fall_back_to_reindexing(self):
+        """If the watcher fails, the service should log it and go on
+        reindexing every interval instead."""
+        service = mxfdbservice.MediaIndexService(self.db_file, self.volumes,
+                                                 workers=1, watch=True,
+                                                 interval=0)
+        reindexed = list()
+        def reindex():
+            reindexed.append(True)
+            if len(reindexed) == 2:
+                service.stopped.set()
+        def fail(watcher, stopped):
+            raise OSError('inotify read failed')
+        with mock.patch.object(service, 'reindex', reindex), \
+             mock.patch.object(mxfwatch.MediaWatcher, 'run', fail), \
+             self.assertLogs(mxfdbservice.logger, 'ERROR') as logs:
+            service._index_loop()
+        self.assertIn('inotify read failed', logs.output[0])
+        self.assertEqual(len(reindexed), 2)
+        service.connections.close()
+
+class TestMediaWatcher(MediaFolderCase):
+    """A watcher should keep registered MXF folders indexed as files
+    are added and removed, without rescanning volumes."""
+
+    def test_poll_registered_folders(self):
+        umids = list(self.write_media(i) for i in range(2))
+        self.db.index_all()
+        self.assertEqual(list(self.db.directory.folders('get_dir')),
+                         [('Test_Volume_1', self.mxfdir, 'Test_Volume', 'get_dir')])
+        new_umid = self.write_media(2)
+        os.remove(os.path.join(self.mxfdir, 'A001C000.video.mxf'))
+        mxfwatch.MediaWatcher(self.db, use_inotify=False).poll()
+        self.assertIn(new_umid, self.db)
+        self.assertIn(umids[1], self.db)
+        self.assertNotIn(umids[0], self.db)
+
+    def test_failing_folder_is_logged(self):
+        """A folder that fails to index should be logged, without
+        stopping the others from being indexed."""
+        self.write_media(0)
+        self.db.index_all()
+        newdir = os.path.join(os.path.dirname(self.mxfdir), '2')
+        os.makedirs(newdir)
+        self.mxfdir = newdir
+        umid = self.write_media(1)
+        self.db.index_all()
+        os.remove(os.path.join(newdir, 'A001C001.video.mxf'))
+        index_folder = self.db.index_folder
+        def failing(volname, subdir, file_getter):
+            if subdir != newdir:
+                raise OSError(5, 'Input/output error', subdir)
+            return index_folder(volname, subdir, file_getter)
+        watcher = mxfwatch.MediaWatcher(self.db, use_inotify=False)
+        with mock.patch.object(self.db, 'index_folder', failing), \
+             self.assertLogs(mxfwatch.logger, 'ERROR') as logs:
+            watcher.poll()
+        self.assertEqual(len(logs.records), 1)
+        self.assertNotIn(umid, self.db)
+
+    def test_inotify_indexes_new_media(self):
+        """Files written to a watched folder, or to a new numbered
+        folder beside it, are indexed, and deleted files removed."""
+        try:
+            mxfwatch.Inotify().close()
+        except OSError:
+            self.skipTest('inotify is not available')
+        db_file = self.get_temp_file('mxfdb.db')
+        volumes = [self.get_temp_file('Test Volume')]
+        self.write_media(0)
+        mxfdb.MediaDatabase(sqlite3.connect(db_file), volumes=volumes,
+                            quiet=True, workers=1).index_all()
+        stopped = threading.Event()
+        watching = threading.Event()
+        def watch():
+            db = mxfdb.MediaDatabase(sqlite3.connect(db_file), quiet=True,
+                                     workers=1)
+            watcher = mxfwatch.MediaWatcher(db, interval=0.1, settle=0.1)
+            original = watcher.watch
+            def watch_folder(path):
+                original(path)
+                watching.set()
+            watcher.watch = watch_folder
+            watcher.run(stopped)
+        thread = threading.Thread(target=watch)
+        thread.start()
+        try:
+            self.assertTrue(watching.wait(5))
+            new_umid = self.write_media(1)
+            newdir = os.path.join(os.path.dirname(self.mxfdir), '2')
+            os.makedirs(newdir)
+            self.mxfdir = newdir
+            time.sleep(0.5)
+            newer_umid = self.write_media(2)
+            os.remove(os.path.join(os.path.dirname(newdir), '1',
+                                   'A001C000.video.mxf'))
+            db = mxfdb.MediaDatabase(sqlite3.connect(db_file), quiet=True)
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline:
+                if new_umid in db and newer_umid in db and \
+                   make_umid(0) not in db:
+                    break
+                time.sleep(0.1)
+            self.assertIn(new_umid, db)
+            self.assertIn(newer_umid, db)
+            self.assertNotIn(make_umid(0), db)
+        finally:
+            stopped.set()
+            thread.join()
+
+class TestProbeCache(unittest.TestCase, AcceptanceCase):
+    """Copies of a file should only be probed once, wherever they are
+    found, while any change to a file should probe it again."""
+
+    def setUp(self):
+        self.make_tempdir()
+        self.cache = probecache.ProbeCache(self.get_temp_file('cache.db'))
+        self.probed = list()
+
+    def tearDown(self):
+        self.cache.conn.close()
+        self.cleanup_tempdir()
+
+    def run_probe(self, filepath):
+        self.probed.append(filepath)
+        return dict(streams=[dict(codec_type='video')], format=dict())
+
+    def write(self, name, data):
+        path = self.get_temp_file(name)
+        with open(path, 'wb') as filehandle:
+            filehandle.write(data)
+        return path
+
+    def test_copies_are_probed_once(self):
+        data = make_opatom(make_umid(0), 'A001C000', 'video',
+                           essence=os.urandom(200 * 1024))
+        original = self.write('original.mxf', data)
+        copy = self.write('copy.mxf', data)
+        self.assertEqual(self.cache.probe(original, self.run_probe),
+                         self.cache.probe(copy, self.run_probe))
+        self.assertEqual(self.probed, [original])
+
+        # a change to either end of the file changes its fingerprint
+        changed = bytearray(data)
+        changed[-1] ^= 0xff
+        changed = self.write('changed.mxf', changed)
+        self.cache.probe(changed, self.run_probe)
+        self.assertEqual(self.probed, [original, changed])
+
+    def test_failed_probes_are_not_cached(self):
+        path = self.write('broken.mxf', b'not an mxf file')
+        for _ in range(2):
+            self.cache.probe(path, lambda filepath: self.probed.append(filepath) or {})
+        self.assertEqual(self.probed, [path, path])
+
+    def test_hits_are_reads(self):
+        path = self.write('original.mxf', b'mxf data')
+        self.cache.probe(path, self.run_probe)
+        changes = self.cache.conn.total_changes
+        self.cache.probe(path, self.run_probe)
+        self.assertEqual(self.cache.conn.total_changes, changes)
+        self.assertEqual(list(self.cache.touched), [probecache.fingerprint(path)])
+        # times of use are written with the next result stored
+        self.cache.probe(self.write('other.mxf', b'other data'), self.run_probe)
+        self.assertEqual(self.cache.touched, dict())
+        self.assertEqual(self.cache.conn.total_changes, changes + 2)
+
+    def test_cache_is_bound_to_opened_index(self):
+        db_file = self.get_temp_file('mxfdb.db')
+        probecache.set_cache(None)
+        try:
+            db = mxfdb.open(db_file, volumes=[], quiet=True, service=False)
+            self.assertEqual(probecache.get_cache().db_file, db_file)
+            probecache.get_cache().conn.close()
+            db.close()
+            # a cache set explicitly is kept
+            probecache.set_cache(self.cache)
+            probecache.bind(db_file)
+            self.assertIs(probecache.get_cache(), self.cache)
+        finally:
+            probecache.set_cache(False)
+
+class TestThumbnailCache(unittest.TestCase, AcceptanceCase):
+    """Thumbnails should be extracted once per umid, frame and scale,
+    with the least recently used evicted beyond the size cap."""
+
+    def setUp(self):
+        self.make_tempdir()
+        self.cache = thumbnailcache.ThumbnailCache(self.get_temp_file('cache.db'),
+                                                   max_bytes=3000)
+
+    def tearDown(self):
+        self.cache.conn.close()
+        self.cleanup_tempdir()
+
+    def test_lru_eviction(self):
+        for frame in range(3):
+            self.cache.put('umid', frame, (320, 180), 1, bytes(1000))
+        self.assertIsNotNone(self.cache.get('umid', 0, (320, 180)))
+        self.assertIsNone(self.cache.get('umid', 0, (160, 90)))
+        self.cache.put('umid', 3, (320, 180), 1, bytes(1000))
+        self.assertIsNone(self.cache.get('umid', 1, (320, 180)))
+        for frame in (0, 2, 3):
+            self.assertEqual(self.cache.get('umid', frame, (320, 180)),
+                             bytes(1000))
+
+    def test_hits_are_reads(self):
+        self.cache.put('umid', 0, (320, 180), 1, bytes(1000))
+        changes = self.cache.conn.total_changes
+        self.assertEqual(self.cache.get('umid', 0, (320, 180)), bytes(1000))
+        self.assertEqual(self.cache.conn.total_changes, changes)
+        self.cache.put('umid', 1, (320, 180), 1, bytes(1000))
+        self.assertEqual(self.cache.touched, dict())
+
+    def test_cache_is_bound_to_opened_index(self):
+        db_file = self.get_temp_file('mxfdb.db')
+        thumbnailcache.set_cache(None)
+        try:
+            db = mxfdb.open(db_file, volumes=[], quiet=True, service=False)
+            self.assertEqual(thumbnailcache.get_cache().db_file, db_file)
+            thumbnailcache.get_cache().conn.close()
+            db.close()
+        finally:
+            thumbnailcache.set_cache(False)
+
+    def test_mediafile_thumbnail(self):
+        """MediaFile.thumbnail should only run ffmpeg on a miss."""
+        mediafile = mobs.MediaFile.from_metadata(
+            '/media/A001C001.mxf', mediatype='video', name='A001C001',
+            framerate='24000/1001', start_tc='01:00:00:00', duration=10.01,
+            bitrate=1, size=1, reel_name='A001', file_package_umid=make_umid(1))
+        extracted = list()
+        def thumbnails(**kwargs):
+            extracted.append(kwargs)
+            yield b'\xff\xd8jpeg\xff\xd9'
+        thumbnailcache.set_cache(self.cache)
+        try:
+            with mock.patch.object(mediafile, 'thumbnails', thumbnails):
+                images = list(mediafile.thumbnail() for _ in range(2))
+                mediafile.thumbnail(scale=(160, 90))
+        finally:
+            thumbnailcache.set_cache(False)
+        self.assertEqual(images, [b'\xff\xd8jpeg\xff\xd9'] * 2)
+        self.assertEqual(len(extracted), 2)
+
 class TestFindMedia(unittest.TestCase):
     """We should be able to find media in the database through a variety
     of identifiers, and return information about that media."""
 
+class TestMediaTable(unittest.TestCase):
+    """All indexed media should live in a single, indexed table."""
+
+    def test_migrate_tables(self):
+        """Open a database with per-folder tables from an earlier
+        version and expect their rows to be moved into the Media table."""
+        connection = sqlite3.connect(':memory:')
+        connection.execute('CREATE TABLE Test_Volume_1 ( umid TEXT PRIMARY KEY, ' +
+                           'file TEXT, path TEXT, name TEXT, mediatype TEXT );')
+        path = '/Volumes/Test Volume/Avid MediaFiles/MXF/1/A001C001.V1.mxf'
+        connection.execute('INSERT INTO Test_Volume_1 VALUES (?, ?, ?, ?, ?)',
+                           ('0xabc', 'A001C001.V1.mxf', path, 'A001C001', 'video'))
+        connection.execute('CREATE TABLE Directory (mxftable TEXT PRIMARY KEY, ' +
+                           'mtime INT);')
+        connection.execute("INSERT INTO Directory VALUES ('Test_Volume_1', 1)")
+        connection.commit()
+
+        db = mxfdb.MediaDatabase(connection, quiet=True)
+        self.assertIn('0xabc', db)
+        self.assertEqual(db['0xabc'].path, path)
+        self.assertEqual([m.umid for m in db.get_umids('A001C001', 'video')],
+                         ['0xabc'])
+        self.assertEqual(list(db.get_umids('A001C001', 'audio')), [])
+        row = connection.execute('SELECT volume, folder FROM Media').fetchone()
+        self.assertEqual(row, ('Test_Volume', 'Test_Volume_1'))
+        tables = [row[0] for row in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'")]
+        self.assertNotIn('Test_Volume_1', tables)
+        self.assertIn('Test_Volume_1', db.directory)
+        self.assertEqual(list(db.resolve_reels(['a001c001.MOV'])['a001c001.MOV'])[0].umid,
+                         '0xabc')
+
+    def test_migrate_umids(self):
+        """Open a database keeping umids as hex TEXT and expect it
+        rebuilt to keep them as BLOBs, without losing rows, indexes or
+        search names."""
+        connection = sqlite3.connect(':memory:')
+        fields = ', '.join(f'{field} TEXT' for field, _ in mxfdb.MXFTable.FIELDS)
+        connection.execute(f'CREATE TABLE Media ({fields}, PRIMARY KEY (folder, umid))')
+        connection.execute('CREATE INDEX Media_umid ON Media (umid)')
+        connection.execute('CREATE TABLE Tracks (material TEXT, umid TEXT, ' +
+                           'mediatype TEXT, track INT, PRIMARY KEY (material, umid))')
+        umid, material = make_umid(1), make_umid(2)
+        connection.execute('INSERT INTO Media (umid, name, normname, folder, ' +
+                           'material) VALUES (?, ?, ?, ?, ?)',
+                           (umid, 'A001C001', 'a001c001', 'Test_Volume_1', material))
+        connection.execute('INSERT INTO Tracks VALUES (?, ?, ?, ?)',
+                           (material, umid, 'video', 1))
+        connection.commit()
+
+        db = mxfdb.MediaDatabase(connection, quiet=True)
+        self.assertEqual(db[umid].name, 'A001C001')
+        self.assertEqual(db[umid].material, material)
+        self.assertEqual([media.umid for media in db.get_clip('A001C001')], [umid])
+        self.assertEqual(db.search('A001C001')[0].umid, umid)
+        self.assertEqual(connection.execute('SELECT typeof(umid), typeof(material), ' +
+                                            'length(umid) FROM Media').fetchone(),
+                         ('blob', 'blob', 32))
+        key = list(row[1] for row in sorted(connection.execute(
+            'PRAGMA table_info(Media)'), key=lambda row: row[5]) if row[5])
+        self.assertEqual(key, ['folder', 'umid', 'path'])
+        sql = connection.execute("SELECT sql FROM sqlite_master WHERE " +
+                                 "name='Tracks'").fetchone()[0]
+        self.assertIn('WITHOUT ROWID', sql)
+        names = [row[0] for row in connection.execute(
+            "SELECT name FROM sqlite_master WHERE tbl_name='Media'")]
+        self.assertIn('Media_umid', names)
+        self.assertIn('Media_search', names)
+
+    def test_lookup_uses_index(self):
+        """Lookups should be answered from the umid and name indexes."""
+        connection = sqlite3.connect(':memory:')
+        mxfdb.MediaDatabase(connection, quiet=True)
+        for query, param in (('umid', '0xabc'), ('name', 'A001C001'),
+                             ('normname', 'a001c001')):
+            plan = connection.execute(
+                f'EXPLAIN QUERY PLAN SELECT * FROM Media WHERE {query}=?',
+                (param,)).fetchall()
+            self.assertIn('USING INDEX', ' '.join(row[-1] for row in plan))
+
+    def test_tables_are_created_once_per_connection(self):
+        """Flushing a batch of files shouldn't create or migrate the
+        tables again on a connection that already did."""
+        connection = sqlite3.connect(':memory:')
+        mxftable = mxfdb.MXFTable('Test_Volume_1', connection)
+        mxftable.create()
+        statements = list()
+        connection.set_trace_callback(statements.append)
+        umid = make_umid(1)
+        mediafiles = {umid: mxfdb.MediaFile(umid, '1.mxf', '/1.mxf',
+                                            'A001C001', 'video')}
+        mediafiles[umid].type = 'video'
+        mxftable.create_with(mediafiles)
+        connection.set_trace_callback(None)
+        self.assertFalse([statement for statement in statements if
+                          statement.split()[0] in ('CREATE', 'ALTER', 'PRAGMA')])
+        self.assertEqual(len(mxftable.rows()), 1)
+
+    def test_functions_fall_back_without_deterministic(self):
+        """Where Python is too old for deterministic functions, they
+        should be registered as plain ones."""
+        conn = mock.Mock()
+        conn.create_function.side_effect = [TypeError, None]
+        mxfdb.create_function(conn, 'encode_umid', 1, mxfdb.encode_umid)
+        conn.create_function.assert_called_with('encode_umid', 1,
+                                                mxfdb.encode_umid)
+
+    def test_lookup_many(self):
+        """Resolve many umids and reels at once, and expect the same
+        results as looking each up in turn."""
+        connection = sqlite3.connect(':memory:')
+        db = mxfdb.MediaDatabase(connection, quiet=True)
+        mediafiles = dict()
+        for i in range(20):
+            mediatype = 'video' if i % 2 else 'audio'
+            umid = make_umid(i)
+            mediafiles[umid] = mxfdb.MediaFile(umid, f'{i}.mxf', f'/{i}.mxf',
+                                               f'A001C{i//2:03}', mediatype)
+            mediafiles[umid].type = mediatype
+        mxfdb.MXFTable('Test_Volume_1', connection).create_with(mediafiles)
+
+        umids = [make_umid(i) for i in range(0, 30, 3)]
+        found = db.lookup_many(umids)
+        self.assertEqual(set(found), set(umids))
+        for umid in umids:
+            expected = [db[umid].path] if umid in db else []
+            self.assertEqual([media.path for media in found[umid]], expected)
+
+        reels = [f'A001C{i:03}' for i in range(12)]
+        for mediatype in (None, 'video'):
+            found = db.get_umids_many(reels, mediatype)
+            for reel in reels:
+                expected = sorted(media.umid for media in
+                                  db.get_umids(reel, mediatype))
+                self.assertEqual(sorted(media.umid for media in found[reel]),
+                                 expected)
+
+    def make_db(self, names):
+        """Returns a MediaDatabase indexing a video file of each name."""
+        connection = sqlite3.connect(':memory:')
+        db = mxfdb.MediaDatabase(connection, quiet=True)
+        mediafiles = dict()
+        for i, name in enumerate(names):
+            umid = make_umid(i)
+            mediafiles[umid] = mxfdb.MediaFile(umid, f'{i}.mxf', f'/{i}.mxf',
+                                               name, 'video')
+            mediafiles[umid].type = 'video'
+        mxfdb.MXFTable('Test_Volume_1', connection).create_with(mediafiles)
+        return db
+
+    def test_normalize_name(self):
+        for name, expected in (('A001C002', 'a001c002'),
+                               ('A001C002.MOV', 'a001c002'),
+                               ('A001C002.mov.new.01', 'a001c002'),
+                               ('A001C002.sub.02.mxf', 'a001c002'),
+                               ('A001C002 (2)', 'a001c002'),
+                               ('A001C002_200101_R1AB', 'a001c002_200101_r1ab'),
+                               ('Interview.Take.3', 'interview.take.3')):
+            self.assertEqual(mxfdb.normalize_name(name), expected)
+
+    def test_resolve_reels(self):
+        """Messy reel names should resolve in one query, preferring
+        exact matches over normalized ones."""
+        db = self.make_db(['A001C001', 'A001C002.mov', 'a001c002',
+                           'B002C003.new.01'])
+        found = db.resolve_reels(['A001C001.MOV', 'A001C002.mov', 'a001c002.MXF',
+                                  'b002c003', 'C003C001'], 'video')
+        names = dict((reel, sorted(media.name for media in mediafiles))
+                     for reel, mediafiles in found.items())
+        self.assertEqual(names, {'A001C001.MOV': ['A001C001'],
+                                 'A001C002.mov': ['A001C002.mov'],
+                                 'a001c002.MXF': ['A001C002.mov', 'a001c002'],
+                                 'b002c003': ['B002C003.new.01'],
+                                 'C003C001': []})
+
+    def test_best_matches(self):
+        """Normalized matches should come back in a fixed order, best
+        first, with clips ranked equally best reported as ambiguous."""
+        db = self.make_db(['X (2)', 'x.new.01', 'X.mov', 'x'])
+        found = db.resolve_reels(['X', 'X.MXF'], 'video')
+        self.assertEqual([media.name for media in found['X']],
+                         ['x', 'X.mov', 'X (2)', 'x.new.01'])
+        self.assertEqual([media.name for media in
+                          mxfdb.best_matches('X', found['X'])], ['x'])
+        # 'X.mov' and 'x' both match but for case and extension
+        self.assertEqual([media.name for media in
+                          mxfdb.best_matches('X.MXF', found['X.MXF'])],
+                         ['X.mov', 'x'])
+        self.assertEqual(mxfdb.best_matches('C003C001', []), [])
+        # clips with the exact name, as when imported twice, aren't
+        db = self.make_db(['X', 'x', 'X'])
+        found = db.resolve_reels(['X'], 'video')['X']
+        self.assertEqual([media.path for media in
+                          mxfdb.best_matches('X', found)], ['/0.mxf'])
+
+    def test_search(self):
+        """Search should rank exact, then prefix, then fuzzy matches,
+        and forget names of media that are no longer indexed."""
+        db = self.make_db(['A001C001', 'A001C0012', 'A001C011', 'Interview_Jane',
+                           'Interveiw_Jane_2'])
+        names = [media.name for media in db.search('a001c001')]
+        self.assertEqual(names[:2], ['A001C001', 'A001C0012'])
+        self.assertIn('A001C011', names)
+        self.assertNotIn('Interview_Jane', names)
+        names = [media.name for media in db.search('interview jane')]
+        self.assertEqual(set(names), {'Interview_Jane', 'Interveiw_Jane_2'})
+        self.assertEqual([media.name for media in db.search('A001C001', limit=1)],
+                         ['A001C001'])
+
+        db.conn.execute('DELETE FROM Media WHERE name=?', ('A001C001',))
+        mxfdb.MXFTable.prune_search(db.conn)
+        self.assertNotIn('a001c001', db._fuzzy_names('a001c001'))
+
 class TestIndexMedia(unittest.TestCase, AcceptanceCase):
     """We should be able to build and maintain an index of all
     Avid MediaFiles directories available. The index should be accurate
@@ -61,23 +1772,21 @@ class TestIndexMedia(unittest.TestCase, AcceptanceCase):
         return dirs
 
     def query_umid(self, umid, connection):
-        """Queries the MXF database for a path, indexed by umid, by
-        performing a union on all of the MXF subdirs."""
-        union_buffer = list()
-        params = list()
-        for mxfdir in self.get_temp_files('Test Volume', 'Avid MediaFiles', 'MXF'):
-            table = f'Test_Volume_{mxfdir}'
-            union_buffer.append(f'SELECT path FROM {table} WHERE umid=?')
-            params.append(umid)
-        query = ' UNION '.join(union_buffer)
-        result = connection.execute(query, params).fetchone()
+        """Queries the MXF database for a path, indexed by umid, in any
+        of the MXF subdirs."""
+        folders = list(f'Test_Volume_{mxfdir}' for mxfdir in
+                       self.get_temp_files('Test Volume', 'Avid MediaFiles', 'MXF'))
+        query = ('SELECT path FROM Media WHERE umid=? AND folder IN ' +
+                 f'({", ".join("?" * len(folders))})')
+        result = connection.execute(query, [mxfdb.encode_umid(umid)] +
+                                    folders).fetchone()
         if result:
             return result[0]
         return None
 
     def test_index_volume(self):
         """Inputs a volume and expects a populated database, with
-        a table for each mxf directory."""
+        rows for each mxf directory."""
         test_files = list(get_test_files('test_media_volume', suffix='mxf'))
 
         for i, batch in enumerate(chunks(test_files, 3), 1):
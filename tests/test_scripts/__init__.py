@@ -1,4 +1,5 @@
 """Test suites for the various scripts that interface with the
 turnovertools libraries."""
 
+from .test_edl2sourceframes import *
 from .test_insert_umid import *
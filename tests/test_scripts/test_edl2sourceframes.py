@@ -0,0 +1,54 @@
+"""Tests the edl2sourceframes script."""
+
+import sqlite3
+import unittest
+from unittest import mock
+
+from scripts import edl2sourceframes
+from turnovertools import mxfdb
+from turnovertools import mediaobjects as mobs
+
+class FakeMediaFile:
+    """Stands in for a probed mobs.MediaFile, returning its path as its
+    thumbnail."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def thumbnail(self):
+        """Returns the path the media file was probed from."""
+        return self.path
+
+def make_db(names):
+    """Returns a MediaDatabase indexing a video clip of each name, with
+    the paths /0.mxf, /1.mxf and so on."""
+    connection = sqlite3.connect(':memory:')
+    db = mxfdb.MediaDatabase(connection, quiet=True)
+    mediafiles = dict()
+    for i, name in enumerate(names):
+        umid = '0x' + f'{i:064x}'
+        mediafiles[umid] = mxfdb.MediaFile(umid, f'{i}.mxf', f'/{i}.mxf',
+                                           name, 'video')
+        mediafiles[umid].type = 'video'
+    mxfdb.MXFTable('Test_Volume_1', connection).create_with(mediafiles)
+    return db
+
+class TestGetThumbnail(unittest.TestCase):
+    """Reels should be matched to one clip, skipping those that match
+    several clips equally well but none exactly."""
+
+    def get_thumbnail(self, reel, db):
+        """Returns the path get_thumbnail probed for reel, or None."""
+        with mock.patch.object(mobs.MediaFile, 'probe', FakeMediaFile):
+            return edl2sourceframes.get_thumbnail(reel, db)
+
+    def test_exact_duplicates_use_first(self):
+        """Clips imported twice under the reel's name are not skipped."""
+        db = make_db(['A001C001', 'a001c001', 'A001C001'])
+        self.assertEqual(self.get_thumbnail('A001C001', db), '/0.mxf')
+
+    def test_ambiguous_matches_are_skipped(self):
+        """Clips matching but for case and extension are ambiguous."""
+        db = make_db(['a001c001.mov', 'A001C001.mxf'])
+        self.assertIsNone(self.get_thumbnail('A001C001', db))
+        self.assertEqual(self.get_thumbnail('a001c001.mov', db), '/0.mxf')
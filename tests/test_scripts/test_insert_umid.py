@@ -3,11 +3,13 @@
 import os
 import sqlite3
 import unittest
+from unittest import mock
 
 from tests.shared_test_setup import AcceptanceCase
 from scripts import insert_umid
 from turnovertools import mxfdb, sourcedb
 from turnovertools import mediaobjects as mobs
+from .test_edl2sourceframes import FakeMediaFile, make_db
 
 # insert_umid accepts a reel, a record id, and a table name
 # if possible, it will update the given record with a umid and a
@@ -120,3 +122,38 @@ class TestAcceptance(unittest.TestCase, AcceptanceCase):
         # check contents of umid field
         clip = self.source_table[self.test_file.inputs[1]]
         self.assertIsNotNone(clip['umid'])
+
+class FakeSourceTable:
+    """Records the updates insert_umid makes to a source table."""
+
+    def __init__(self):
+        self.updates = list()
+
+    def get_pk(self, primary_key):
+        """Returns a record with no poster frame."""
+        return dict(poster_frame=None)
+
+    def update_container(self, primary_key, field, data, filename, pk=False):
+        """Records the container field written."""
+        self.updates.append((primary_key, field, data))
+
+    def update(self, primary_key, field, value, pk=False):
+        """Records the field written."""
+        self.updates.append((primary_key, field, value))
+
+class TestDuplicateReels(unittest.TestCase):
+    """A reel matching several clips by the exact name should still be
+    inserted, from the first of them."""
+
+    def test_exact_duplicates_use_first(self):
+        db = make_db(['A001C001', 'a001c001', 'A001C001'])
+        sourcetable = FakeSourceTable()
+        def probe(path):
+            mediafile = FakeMediaFile(path)
+            mediafile.clip_name = 'A001C001'
+            mediafile.umid = path
+            return mediafile
+        with mock.patch.object(mobs.MediaFile, 'probe', probe):
+            insert_umid.insert_umid('A001C001', 1, 'Source', sourcetable, db)
+        self.assertEqual(sourcetable.updates,
+                         [(1, 'image', '/0.mxf'), (1, 'umid', '/0.mxf')])
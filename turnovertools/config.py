@@ -8,3 +8,4 @@ class Config(object):
     DEFAULT_HANDLES = 8
     FILEMAKER_APPLICATION = 'FileMaker Pro 18 Advanced'
     MXFDB = os.path.join(os.path.expanduser("~"), '.mxfdb.db')
+    THUMBNAIL_CACHE_BYTES = 512 * 1024 * 1024
@@ -17,6 +17,7 @@ import ffmpeg
 from timecode import Timecode
 
 from turnovertools import fftools
+from turnovertools import probecache
 
 ##
 # Close any asynchronous subprocesses on sigint
@@ -119,7 +120,7 @@ def probe_clip(video):
     metadata."""
     clip = lambda: None
     clip.mediapath = video
-    probe = ffmpeg.probe(video)
+    probe = probecache.probe(video, ffmpeg.probe)
     vid_stream = next(stream for stream in probe['streams'] if
                       stream['codec_type'] == 'video')
     clip.framerate = vid_stream['r_frame_rate']
@@ -5,6 +5,8 @@ import os
 import subprocess
 
 from turnovertools.mediaobjects import SourceClip, Timecode
+from turnovertools import probecache
+from turnovertools import thumbnailcache
 
 FFMPEG = '/usr/local/bin/ffmpeg'
 FFPROBE = '/usr/local/bin/ffprobe'
@@ -25,6 +27,47 @@ def get_media_stream(streams):
         found = stream
     return found
 
+def run_ffprobe(filepath):
+    """Runs ffprobe on filepath, returning its parsed output."""
+    args = [FFPROBE, '-of', 'json', '-show_format', '-show_streams', filepath]
+    probe = subprocess.run(args, capture_output=True, check=False)
+    return json.loads(probe.stdout.decode('utf8'))
+
+def lower(umid):
+    """Returns umid in lowercase, or None if it is missing."""
+    if umid is None:
+        return None
+    return umid.lower()
+
+def probe_metadata(data, stream=None):
+    """Returns the metadata used by MediaFile.from_metadata from parsed
+    ffprobe output, for stream or else the file's video stream."""
+    mformat = data['format']
+    tags = mformat.get('tags', {})
+    if stream is None:
+        stream = get_media_stream(data['streams'])
+    stream_tags = stream.get('tags', {})
+    duration = stream.get('duration')
+    return dict(mediatype=stream.get('codec_type'),
+                name=tags.get('material_package_name'),
+                framerate=stream.get('r_frame_rate'),
+                start_tc=stream_tags.get('timecode') or tags.get('timecode'),
+                duration=None if duration is None else float(duration),
+                width=stream.get('width'),
+                height=stream.get('height'),
+                pix_fmt=stream.get('pix_fmt'),
+                codec=stream.get('codec_name'),
+                bitrate=mformat.get('bit_rate'),
+                size=mformat.get('size'),
+                reel_name=stream_tags.get('reel_name'),
+                file_package_umid=lower(stream_tags.get('file_package_umid')),
+                reel_umid=lower(stream_tags.get('reel_umid')),
+                material_package_umid=lower(
+                    stream_tags.get('material_package_umid') or
+                    tags.get('material_package_umid')),
+                track_name=stream_tags.get('track_name'),
+                format_name=mformat.get('format_name'))
+
 def stream_jpeg(stream):
     """Given a jpeg image string, yield individual jpegs."""
     buffer = []
@@ -116,13 +159,29 @@ class MediaFile(SourceClip):
                 start_tc = (self.mark_start_tc or self.src_start_tc)
                 interval = self.mark_duration.frames
             start_second = self.real_seconds(start_tc)
-        # return the thumbnail, raising an exception if necessary
+        # return the cached thumbnail, or extract it, raising an
+        # exception if necessary
+        def extract():
+            try:
+                return next(self.thumbnails(frames=1, start_second=start_second,
+                                            interval=interval, scale=scale))
+            except StopIteration as err:
+                msg = f'No image yielded at {start_second} with interval {interval}.'
+                raise Exception(msg) from err
+        frame = round(float(start_second) * self.src_start_tc.f_framerate)
+        return thumbnailcache.thumbnail(self.cache_key(), frame, scale,
+                                        interval, extract)
+
+    def cache_key(self):
+        """Identifies the media in the thumbnail cache by umid, or by a
+        fingerprint of files without one. Returns None if the file
+        can't be read."""
+        if self.umid:
+            return self.umid
         try:
-            return next(self.thumbnails(frames=1, start_second=start_second,
-                                        interval=interval, scale=scale))
-        except StopIteration as err:
-            msg = f'No image yielded at {start_second} with interval {interval}.'
-            raise Exception(msg) from err
+            return probecache.fingerprint(self.filepath)
+        except OSError:
+            return None
 
     def thumbnails(self, frames=None, start_second=None,
                    interval=100, scale=(320, 180)):
@@ -141,24 +200,27 @@ class MediaFile(SourceClip):
         ffmpeg = subprocess.run(args, capture_output=True, check=True)
         yield from stream_jpeg(ffmpeg.stdout)
 
-    # pylint: disable=R0914
     @classmethod
     def probe(cls, filepath):
-        """Creates a MediaFile object by probing a videofile."""
-        args = [FFPROBE, '-of', 'json', '-show_format', '-show_streams', filepath]
-        probe = subprocess.run(args, capture_output=True, check=False)
-        data = json.loads(probe.stdout.decode('utf8'))
-        mformat = data['format']
-        tags = mformat['tags']
-        stream = get_media_stream(data['streams'])
-        stream_tags = stream['tags']
+        """Creates a MediaFile object by probing a videofile, or from
+        the probe cache if a file with the same contents was probed."""
+        data = probecache.probe(filepath, run_ffprobe)
+        return cls.from_metadata(filepath, **probe_metadata(data))
 
+    # pylint: disable=R0913,R0914
+    @classmethod
+    def from_metadata(cls, filepath, mediatype=None, name=None,
+                      framerate=None, start_tc=None, duration=None,
+                      width=None, height=None, pix_fmt=None, codec=None,
+                      bitrate=None, size=None, reel_name=None,
+                      file_package_umid=None, reel_umid=None,
+                      material_package_umid=None, track_name=None,
+                      format_name=None):
+        """Creates a MediaFile object from technical metadata, as
+        returned by probe_metadata or stored in the mxf database."""
         # calculate src_end_timecode based on framerate and seconds
-        framerate = stream.get('r_frame_rate')
-        seconds = float(stream.get('duration'))
-        timecode = (stream_tags.get('timecode') or tags.get('timecode') or
-                    '00:00:00:00')
-        src_start_tc = Timecode(framerate, timecode)
+        seconds = float(duration)
+        src_start_tc = Timecode(framerate, start_tc or '00:00:00:00')
         try:
             framerate = float(framerate)
         except ValueError:
@@ -168,42 +230,29 @@ class MediaFile(SourceClip):
         src_end_tc.f_framerate = src_start_tc.f_framerate
 
         # guess source_file vs tape
-        reel = stream_tags.get('reel_name')
         tape = None
         source_file = None
-        if reel and '.' in reel:
-            source_file = reel
-        else:
-            tape = reel
-        if stream_tags.get('file_package_umid') is not None:
-            file_package_umid = stream_tags.get('file_package_umid').lower()
-        else:
-            file_package_umid = None
-        if stream_tags.get('reel_umid') is not None:
-            reel_umid = stream_tags.get('reel_umid').lower()
+        if reel_name and '.' in reel_name:
+            source_file = reel_name
         else:
-            reel_umid = None
-            
-        if stream_tags.get('material_package_umid') is not None:
-            material_package_umid = tags.get('material_package_umid').lower()
-        else:
-            material_package_umid = None
-
-        return MediaFile(mediatype=stream.get('codec_type'),
-                         clip_name=tags.get('material_package_name'),
-                         pix_fmt=stream.get('pix_fmt'),
-                         source_size=(stream.get('width'), stream.get('height')),
-                         seconds=seconds,
-                         src_framerate=framerate,
-                         src_start_tc=str(src_start_tc),
-                         src_end_tc=str(src_end_tc),
-                         file_package_umid=file_package_umid,
-                         reel_umid=reel_umid,
-                         material_package_umid=material_package_umid,
-                         track_name=stream_tags.get('track_name'),
-                         format_name=mformat.get('format_name'),
-                         bitrate=mformat.get('bit_rate'),
-                         size=mformat.get('size'),
-                         filepath=filepath,
-                         source_file=source_file,
-                         tape=tape)
+            tape = reel_name
+
+        return cls(mediatype=mediatype,
+                   clip_name=name,
+                   pix_fmt=pix_fmt,
+                   source_size=(width, height),
+                   source_codec=codec,
+                   seconds=seconds,
+                   src_framerate=framerate,
+                   src_start_tc=str(src_start_tc),
+                   src_end_tc=str(src_end_tc),
+                   file_package_umid=file_package_umid,
+                   reel_umid=reel_umid,
+                   material_package_umid=material_package_umid,
+                   track_name=track_name,
+                   format_name=format_name,
+                   bitrate=bitrate,
+                   size=size,
+                   filepath=filepath,
+                   source_file=source_file,
+                   tape=tape)
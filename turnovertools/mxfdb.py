@@ -1,17 +1,74 @@
 """Database for indexing MXF files by umid."""
 
+from collections import namedtuple
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                FIRST_COMPLETED, as_completed, wait)
+from contextlib import contextmanager
+import difflib
+import io
 import json
 import os
+import plistlib
+import queue
+import re
 import subprocess
 import string
 import sqlite3
-import tempfile
+import struct
+import sys
+import threading
+import time
+import uuid
 import warnings
-from zipfile import ZipFile, BadZipFile
+from zipfile import ZipFile, BadZipFile, ZIP_STORED
 import zlib
 
-# TO-DO: Why do we keep trying to re-index AS12/MXF/1?
-# TO-DO: Fix mxf files that don't index
+from turnovertools import mediaobjects as mobs
+from turnovertools.mediaobjects.mediafile import probe_metadata
+from turnovertools import mxflease
+from turnovertools import mxfmetrics
+from turnovertools import probecache
+from turnovertools import thumbnailcache
+
+# stat signature used to tell whether an indexed file has changed
+FileStat = namedtuple('FileStat', 'size mtime_ns inode')
+# technical metadata stored with each file, named as for
+# mobs.MediaFile.from_metadata
+TECHNICAL_FIELDS = ('framerate', 'start_tc', 'duration', 'width', 'height',
+                    'pix_fmt', 'codec', 'bitrate', 'size', 'reel_name',
+                    'reel_umid', 'track_name', 'format_name')
+# rows inserted and committed at a time while indexing a folder
+INSERT_BATCH = 500
+# applied to every database connection. WAL lets lookups read while a
+# folder is being indexed; in WAL mode, synchronous=NORMAL is safe
+# against corruption and only risks the last commits on power loss,
+# which are probed again
+PRAGMAS = ('PRAGMA journal_mode=WAL', 'PRAGMA synchronous=NORMAL',
+           'PRAGMA temp_store=MEMORY', 'PRAGMA cache_size=-65536')
+# extension of the per-volume shard databases kept in a shard directory
+SHARD_SUFFIX = '.mxfdb'
+# directories listed at once when walking repository volumes. Listing
+# is bound by filesystem latency, not CPU, so this is independent of
+# the number of probe workers
+SCAN_WORKERS = 8
+# hidden folders macOS keeps at the root of a volume, which are never
+# walked for media, and are often unreadable
+SYSTEM_FOLDERS = ('.Trashes', '.Spotlight-V100', '.fseventsd',
+                  '.TemporaryItems', '.DocumentRevisions-V100')
+# file at the root of a volume holding the id it is known by, so that
+# its index follows it when it is renamed or mounted elsewhere
+VOLUME_MARKER = '.mxfdb_volume'
+# seconds ffprobe may run on one file before it is killed. Corrupt
+# files can make it hang, and are quarantined like other failures
+FFPROBE_TIMEOUT = 120
+# errors raised probing files that are not valid media, rather than
+# files that couldn't be read, which are recorded in the Quarantine
+# table and not probed again until they change
+PROBE_ERRORS = (TypeError, KeyError, ValueError, UserWarning,
+                subprocess.TimeoutExpired)
+# seconds for which a folder indexed by any process is taken to be up
+# to date by lookups in lazy mode
+LAZY_REFRESH = 3600
 
 def get_media_stream(streams):
     """Returns the metadata for the media stream in an MXF file,
@@ -26,6 +83,26 @@ def get_media_stream(streams):
         found = stream
     return found
 
+def get_clip_tracks(streams):
+    """Returns the file package umid, mediatype and material package
+    track id of every track of the clip an MXF file belongs to, read
+    from its media stream and the data streams describing related MXF
+    files. The track id is None for streams ffprobe reports without
+    an id."""
+    tracks = list()
+    for stream in streams:
+        umid = stream.get('tags', {}).get('file_package_umid')
+        if umid is None:
+            continue
+        mediatype = stream['codec_type']
+        if mediatype == 'data':
+            mediatype = stream['tags'].get('data_type')
+        track = stream.get('id')
+        if isinstance(track, str):
+            track = int(track, 16) if track.startswith('0x') else None
+        tracks.append((umid.lower(), mediatype, track))
+    return tracks
+
 def updir(path, count):
     """Returns the path count directories above path."""
     for _ in range(count):
@@ -56,17 +133,175 @@ def get_tablename(vol, subdir):
     subdir = clean_tablename(os.path.basename(subdir))
     return f'{vol}_{subdir}'
 
+def volume_from_tablename(table, path):
+    """Guesses the cleaned volume name of a Volume_Subfolder table name
+    from the path of one of its files, by finding the pair of path
+    components that the table name was built from. Returns None if no
+    pair matches."""
+    parts = [clean_tablename(part) for part in path.split(os.sep) if part]
+    for i, vol in enumerate(parts):
+        for subdir in parts[i+1:]:
+            if get_tablename(vol, subdir) == table:
+                return vol
+    return None
+
 def get_mxfdir(vol):
     """Returns the path to an Avid MediaFiles MXF top-level dir for a
     given volume."""
     return os.path.join(vol, 'Avid MediaFiles', 'MXF')
 
+def filesystem_uuid(vol):
+    """Returns the UUID of the filesystem mounted at vol, or None if vol
+    is not a mount point or the UUID can't be found."""
+    if not os.path.ismount(vol):
+        return None
+    if sys.platform == 'darwin':
+        info = subprocess.run(['diskutil', 'info', '-plist', vol],
+                              capture_output=True, check=False)
+        try:
+            return plistlib.loads(info.stdout).get('VolumeUUID')
+        except plistlib.InvalidFileException:
+            return None
+    try:
+        device = os.stat(vol).st_dev
+        for entry in os.scandir('/dev/disk/by-uuid'):
+            if os.stat(entry.path).st_rdev == device:
+                return entry.name
+    except OSError:
+        pass
+    return None
+
+def volume_id(vol, create=True):
+    """Returns the id a volume is known by whatever it is named: the one
+    in the marker file at its root, or else the UUID of its filesystem,
+    or else, if create is True, a new id written to a marker file.
+    Returns None if the volume has neither and is read only."""
+    marker = os.path.join(vol, VOLUME_MARKER)
+    try:
+        with io.open(marker) as filehandle:
+            found = filehandle.read().strip()
+        if found:
+            return found
+    except OSError:
+        pass
+    found = filesystem_uuid(vol)
+    if found is not None or not create:
+        return found
+    found = str(uuid.uuid4())
+    try:
+        with io.open(marker, 'x') as filehandle:
+            filehandle.write(found + '\n')
+    except OSError:
+        return None
+    return found
+
+def new_volume_id(vol):
+    """Writes a new id to the marker file at the root of vol, replacing
+    one copied from another volume along with its files, or shadowing
+    the UUID of a cloned filesystem. Returns the new id, or None if the
+    volume is read only."""
+    found = str(uuid.uuid4())
+    try:
+        with io.open(os.path.join(vol, VOLUME_MARKER), 'w') as filehandle:
+            filehandle.write(found + '\n')
+    except OSError:
+        return None
+    return found
+
 def get_subdirs(path, index_zips=False):
     for entry in os.listdir(path):
+        if entry in SYSTEM_FOLDERS:
+            continue
         subdir = os.path.join(path, entry)
         if os.path.isdir(subdir) or (subdir.endswith('.zip') and index_zips):
             yield subdir
 
+def scan_tree(path, accept, workers=SCAN_WORKERS):
+    """Yields the path and FileStat of every file in path and its
+    subdirectories whose name is accepted by accept, as they are found.
+    Up to workers directories are listed at once with os.scandir,
+    reusing the stat data it gathers, so files are yielded in no
+    particular order. SYSTEM_FOLDERS are not walked. A directory that
+    can't be listed is warned about and yielded with a FileStat of
+    None, so that files indexed in it are kept rather than removed."""
+    if workers <= 1:
+        yield from _scan_serial(path, accept)
+        return
+    found = queue.Queue()
+    def scan(dirpath):
+        try:
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in SYSTEM_FOLDERS:
+                            found.put(('dir', entry.path))
+                    elif accept(entry.name):
+                        found.put(('file', (entry.path, file_signature(entry))))
+        except OSError as err:
+            found.put(('error', (dirpath, err)))
+        found.put(('done', dirpath))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pool.submit(scan, path)
+        scanning = 1
+        while scanning:
+            kind, item = found.get()
+            if kind == 'file':
+                yield item
+            elif kind == 'dir':
+                pool.submit(scan, item)
+                scanning += 1
+            elif kind == 'done':
+                scanning -= 1
+            else:
+                yield unreadable(*item)
+
+def _scan_serial(path, accept):
+    try:
+        with os.scandir(path) as entries:
+            entries = list(entries)
+    except OSError as err:
+        yield unreadable(path, err)
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if entry.name not in SYSTEM_FOLDERS:
+                yield from _scan_serial(entry.path, accept)
+        elif accept(entry.name):
+            yield entry.path, file_signature(entry)
+
+def unreadable(path, err):
+    """Warns that the directory at path couldn't be listed, returning
+    it with a FileStat of None as scan_tree yields it."""
+    warnings.warn(f'Could not list {path}: {err}; keeping its indexed files')
+    return path, None
+
+def is_zipfile(fname):
+    """Returns True if a filename is a zip archive that may contain MXF
+    files."""
+    return fname.endswith('.zip')
+
+def file_signature(entry):
+    """Returns the FileStat of an os.DirEntry, reusing the stat data
+    cached by os.scandir where the platform provides it."""
+    stat = entry.stat()
+    return FileStat(stat.st_size, stat.st_mtime_ns, entry.inode())
+
+def path_signature(path):
+    """Returns the FileStat of a path."""
+    stat = os.stat(path)
+    return FileStat(stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+def find_source(path, sources):
+    """Returns the member of sources that path was found in: either
+    path itself, or the zip archive containing it. Returns None if path
+    came from none of them."""
+    while path not in sources:
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+    return path
+
 def is_mediafile(fname):
     """Returns True if a filename matches an indexable MXF filename."""
     if fname.startswith('__MACOSX'):
@@ -75,22 +310,102 @@ def is_mediafile(fname):
         return False
     return fname.endswith('.mxf')
 
-# pylint: disable=R0903
-class Probe:
+# file extensions and the suffixes Avid adds to copied clips, which
+# differ between EDL reels and material package names
+MEDIA_EXTENSIONS = ('mov', 'mxf', 'mp4', 'm4v', 'avi', 'mkv', 'mts', 'r3d',
+                    'ari', 'arx', 'braw', 'crm', 'dng', 'dpx', 'exr', 'tif',
+                    'tiff', 'wav', 'aif', 'aiff', 'bwf', 'mp3')
+NAME_SUFFIX = re.compile(r'(\.(new|sub|copy|dup|exported)(\.\d+)?|' +
+                         r'\.(' + '|'.join(MEDIA_EXTENSIONS) + r')|' +
+                         r' ?\(\d+\))$')
+MEDIA_EXTENSION = re.compile(r'\.(' + '|'.join(MEDIA_EXTENSIONS) + r')$')
+
+def normalize_name(name):
+    """Returns the form of a reel or clip name used to match names that
+    differ only in case, file extension, or suffixes such as .new.01."""
+    name = name.strip().casefold()
+    stripped = NAME_SUFFIX.sub('', name).rstrip()
+    while stripped != name:
+        name = stripped
+        stripped = NAME_SUFFIX.sub('', name).rstrip()
+    return name
+
+def match_rank(reel, name):
+    """Returns how closely a clip name matched by normalize_name
+    matches reel: 0 if exactly, 1 if but for case, 2 if but for case
+    and a media file extension, and 3 otherwise."""
+    if name == reel:
+        return 0
+    reel, name = reel.casefold(), name.casefold()
+    if name == reel:
+        return 1
+    if MEDIA_EXTENSION.sub('', name) == MEDIA_EXTENSION.sub('', reel):
+        return 2
+    return 3
+
+def best_matches(reel, mediafiles):
+    """Returns the first MediaFile of each clip among the best ranked
+    of mediafiles matching reel, sorted as resolve_reels sorts them. A
+    clip is told by its material package umid, or by its umid if it was
+    indexed without one. More than one clip means reel is ambiguous.
+    Clips named exactly reel, such as media imported twice, are never
+    ambiguous: only the first of them is returned."""
+    if not mediafiles:
+        return []
+    best = min(match_rank(reel, media.name) for media in mediafiles)
+    if best == 0:
+        return [next(media for media in mediafiles if media.name == reel)]
+    clips = dict()
+    for media in mediafiles:
+        if match_rank(reel, media.name) == best:
+            clips.setdefault(media.material or media.umid, media)
+    return list(clips.values())
+
+def ffprobe(filepath, data=None):
+    """Runs ffprobe on filepath, returning its parsed output. If data is
+    given, it is piped to ffprobe instead of reading filepath. Raises
+    subprocess.TimeoutExpired if ffprobe runs for FFPROBE_TIMEOUT
+    seconds."""
+    source = filepath if data is None else 'pipe:0'
+    args = ['ffprobe', '-of', 'json', '-show_format', '-show_streams', source]
+    probe = subprocess.run(args, input=data, capture_output=True, check=False,
+                           timeout=FFPROBE_TIMEOUT)
+    return json.loads(probe.stdout.decode('utf8'))
+
+class Probe:  # pylint: disable=R0903
     """Probes a mediafile and presents common metadata as attributes."""
 
-    def __init__(self, filepath):
-        """Runs ffprobe on filepath at instantiation."""
-        args = ['ffprobe', '-of', 'json', '-show_format', '-show_streams', filepath]
-        probe = subprocess.run(args, capture_output=True, check=False)
-        self.data = json.loads(probe.stdout.decode('utf8'))
+    def __init__(self, filepath, data=None):
+        """Runs ffprobe on filepath at instantiation, unless a file with
+        the same contents is in the probe cache. If data is given, it
+        is piped to ffprobe instead of reading filepath."""
+        if data is None:
+            self.data = probecache.probe(filepath, ffprobe)
+        else:
+            self.data = ffprobe(filepath, data)
         self.stream = get_media_stream(self.data['streams'])
         self.umid = self.stream['tags']['file_package_umid'].lower()
         self.type = self.stream['codec_type']
         self.name = self.data['format']['tags']['material_package_name']
+        self.material = self.data['format']['tags'].get('material_package_umid')
+        if self.material is not None:
+            self.material = self.material.lower()
+        self.tracks = get_clip_tracks(self.data['streams'])
         self.mediatype = self.type
         self.path = filepath
         self.file = os.path.basename(filepath)
+        metadata = probe_metadata(self.data, self.stream)
+        self.technical = dict((field, metadata[field]) for field in TECHNICAL_FIELDS)
+        for field in ('bitrate', 'size'):
+            if self.technical[field] is not None:
+                self.technical[field] = int(self.technical[field])
+
+    def set_size(self, size):
+        """Sets the size of the probed file, and the bitrate calculated
+        from it, for files probed from their leading bytes only."""
+        self.technical['size'] = size
+        duration = self.technical['duration']
+        self.technical['bitrate'] = int(size * 8 / duration) if duration else None
 
     def set_altpath(self, altpath):
         """Change filename and path based on a path other than one used
@@ -99,16 +414,669 @@ class Probe:
         self.path = altpath
 
 
+# SMPTE 377 keys and local tags read by MXFHeader
+SMPTE_KEY_PREFIX = bytes.fromhex('060e2b34')
+PARTITION_PACK_KEY = bytes.fromhex('060e2b34020501010d01020101')
+LOCAL_SET_KEY = bytes.fromhex('060e2b34025301010d0101010101')
+FILL_KEY = (bytes.fromhex('060e2b34010101'), bytes.fromhex('0301021001000000'))
+HEADER_PARTITION = 0x02
+MAX_HEADER_BYTES = 16 * 1024 * 1024
+# leading bytes of a zipped file piped to ffprobe if its header can't be parsed
+ZIP_PROBE_BYTES = 4 * 1024 * 1024
+ZIP_LOCAL_HEADER = struct.Struct('<4s22xHH')
+
+MATERIAL_PACKAGE = 0x36
+SOURCE_PACKAGE = 0x37
+ESSENCE_CONTAINER_DATA = 0x23
+PICTURE_DESCRIPTORS = (0x27, 0x28, 0x29, 0x51)
+SOUND_DESCRIPTORS = (0x42, 0x47, 0x48)
+
+TAG_INSTANCE_UID = 0x3c0a
+TAG_PACKAGE_UID = 0x4401
+TAG_PACKAGE_NAME = 0x4402
+TAG_PACKAGE_TRACKS = 0x4403
+TAG_DESCRIPTOR = 0x4701
+TAG_TRACK_ID = 0x4801
+TAG_TRACK_NAME = 0x4802
+TAG_TRACK_SEQUENCE = 0x4803
+TAG_DATA_DEFINITION = 0x0201
+TAG_LINKED_PACKAGE_UID = 0x2701
+TAG_TRACK_EDIT_RATE = 0x4b01
+TAG_COMPONENT_DURATION = 0x0202
+TAG_SEQUENCE_COMPONENTS = 0x1001
+TAG_SOURCE_PACKAGE_ID = 0x1101
+TAG_START_TIMECODE = 0x1501
+TAG_TIMECODE_BASE = 0x1502
+TAG_DROP_FRAME = 0x1503
+TAG_SAMPLE_RATE = 0x3001
+TAG_CONTAINER_DURATION = 0x3002
+TAG_PICTURE_CODING = 0x3201
+TAG_STORED_HEIGHT = 0x3202
+TAG_STORED_WIDTH = 0x3203
+TAG_FRAME_LAYOUT = 0x320c
+TAG_COMPONENT_DEPTH = 0x3301
+TAG_HORIZONTAL_SUBSAMPLING = 0x3302
+TAG_VERTICAL_SUBSAMPLING = 0x3308
+TAG_QUANTIZATION_BITS = 0x3d01
+
+SEQUENCE = 0x0f
+SOURCE_CLIP = 0x11
+TIMECODE_COMPONENT = 0x14
+CDCI_DESCRIPTOR = 0x28
+# frame layouts whose stored height is the height of one field
+FIELD_LAYOUTS = (1, 3)
+
+# data definitions, by bytes 8-12 of the UL, mapped to ffprobe codec_type
+DATA_DEFINITIONS = {bytes.fromhex('0103020201'): 'video',
+                    bytes.fromhex('0103020202'): 'audio'}
+# picture essence codings, by the leading bytes of the UL from byte 8,
+# mapped to ffprobe codec_name
+PICTURE_CODINGS = ((bytes.fromhex('0401020271'), 'dnxhd'),
+                   (bytes.fromhex('040102020306'), 'prores'),
+                   (bytes.fromhex('040102020301'), 'jpeg2000'),
+                   (bytes.fromhex('040102020132'), 'h264'),
+                   (bytes.fromhex('040102020101'), 'mpeg2video'),
+                   (bytes.fromhex('040102020201'), 'dvvideo'),
+                   (bytes.fromhex('04010201'), 'rawvideo'))
+# CDCI subsampling, as (horizontal, vertical), mapped to ffprobe pix_fmt
+CHROMA_FORMATS = {(2, 1): 'yuv422p', (2, 2): 'yuv420p', (1, 1): 'yuv444p'}
+
+class MXFHeaderError(ValueError):
+    """Raised when the header partition of a file cannot be read as
+    OP-Atom MXF header metadata."""
+
+def read_ber_length(fh):
+    """Reads a BER encoded length from a binary file object. Returns the
+    length and the encoded bytes."""
+    first = fh.read(1)
+    if not first:
+        raise MXFHeaderError('Unexpected end of file reading KLV length.')
+    if first[0] < 0x80:
+        return first[0], first
+    size = first[0] & 0x7f
+    data = fh.read(size)
+    if size == 0 or size > 8 or len(data) < size:
+        raise MXFHeaderError('Invalid KLV length.')
+    return int.from_bytes(data, 'big'), first + data
+
+def read_klv_header(fh):
+    """Reads the key and length of the next KLV packet in fh, leaving
+    fh positioned at the start of the value. Returns the key, the
+    length of the value and the raw bytes read."""
+    key = fh.read(16)
+    if len(key) < 16 or not key.startswith(SMPTE_KEY_PREFIX):
+        raise MXFHeaderError('Expected a SMPTE KLV key.')
+    length, encoded = read_ber_length(fh)
+    return key, length, key + encoded
+
+def is_fill(key):
+    """Returns True if key is a KLV fill item key, of any version."""
+    return key[:7] == FILL_KEY[0] and key[8:] == FILL_KEY[1]
+
+def read_header_partition(fh):
+    """Reads the header partition pack and header metadata from the
+    start of a binary file object, reading no further than the end of
+    the header metadata. Returns the header metadata as bytes."""
+    key, length, _ = read_klv_header(fh)
+    if not key.startswith(PARTITION_PACK_KEY) or key[13] != HEADER_PARTITION:
+        raise MXFHeaderError('File does not begin with an MXF header partition.')
+    pack = fh.read(length)
+    if len(pack) < 40:
+        raise MXFHeaderError('Truncated partition pack.')
+    header_byte_count = int.from_bytes(pack[32:40], 'big')
+    if not 0 < header_byte_count <= MAX_HEADER_BYTES:
+        raise MXFHeaderError('Header partition contains no header metadata.')
+    # skip any fill between the partition pack and the primer pack
+    key, length, raw = read_klv_header(fh)
+    while is_fill(key):
+        fh.read(length)
+        key, length, raw = read_klv_header(fh)
+    data = raw + fh.read(header_byte_count - len(raw))
+    if len(data) < header_byte_count:
+        raise MXFHeaderError('Truncated header metadata.')
+    return data
+
+def parse_local_sets(data):
+    """Parses header metadata into a dictionary of local sets, keyed by
+    InstanceUID. Each set is a tuple of the set type (byte 14 of its
+    key) and a dictionary of values keyed by local tag."""
+    sets = dict()
+    stream = io.BytesIO(data)
+    while stream.tell() < len(data):
+        try:
+            key, length, _ = read_klv_header(stream)
+        except MXFHeaderError:
+            break                       # trailing fill or padding
+        value = stream.read(length)
+        if not key.startswith(LOCAL_SET_KEY):
+            continue
+        items = dict()
+        pos = 0
+        while pos + 4 <= len(value):
+            tag = int.from_bytes(value[pos:pos+2], 'big')
+            size = int.from_bytes(value[pos+2:pos+4], 'big')
+            items[tag] = value[pos+4:pos+4+size]
+            pos += 4 + size
+        if TAG_INSTANCE_UID in items:
+            sets[items[TAG_INSTANCE_UID]] = (key[14], items)
+    return sets
+
+def unpack_batch(value):
+    """Splits an MXF array or batch value into its items."""
+    if len(value) < 8:
+        return []
+    count = int.from_bytes(value[:4], 'big')
+    size = int.from_bytes(value[4:8], 'big')
+    return [value[8+i*size:8+(i+1)*size] for i in range(count)]
+
+def unpack_int(value):
+    """Unpacks a big endian unsigned integer of any size."""
+    return int.from_bytes(value, 'big')
+
+def unpack_rational(value):
+    """Unpacks an MXF rational, returning numerator and denominator."""
+    return (int.from_bytes(value[:4], 'big', signed=True),
+            int.from_bytes(value[4:8], 'big', signed=True))
+
+def format_timecode(frames, base, drop_frame=False):
+    """Formats a frame count as a timecode string, the way ffprobe
+    does, with a semicolon before the frames of drop frame timecode."""
+    if drop_frame and base in (30, 60):
+        drop = base // 15
+        per_ten_minutes = base * 600 - drop * 9
+        tens, remainder = divmod(frames, per_ten_minutes)
+        frames += 9 * drop * tens + drop * (
+            max(remainder - drop, 0) // (per_ten_minutes // 10))
+    seconds, frame = divmod(frames, base)
+    minutes, second = divmod(seconds, 60)
+    hour, minute = divmod(minutes, 60)
+    separator = ';' if drop_frame else ':'
+    return f'{hour % 24:02}:{minute:02}:{second:02}{separator}{frame:02}'
+
+def format_umid(umid):
+    """Formats a binary UMID in the same lowercase hex notation
+    produced by Probe."""
+    return '0x' + umid.hex()
+
+def encode_umid(umid):
+    """Returns a umid in the notation produced by Probe as the 32 bytes
+    it is stored as in the database. Anything that isn't a umid in that
+    notation is stored as given."""
+    if isinstance(umid, str) and len(umid) == 66 and umid[:2] in ('0x', '0X'):
+        try:
+            return bytes.fromhex(umid[2:])
+        except ValueError:
+            pass
+    return umid
+
+def decode_umid(value):
+    """Returns a umid as stored in the database in the notation produced
+    by Probe."""
+    return format_umid(value) if isinstance(value, bytes) else value
+
+def create_function(conn, name, narg, func):
+    """Registers func with conn as a deterministic SQL function, or
+    as a plain one where Python or SQLite are too old for that."""
+    try:
+        conn.create_function(name, narg, func, deterministic=True)
+    except (TypeError, sqlite3.NotSupportedError):
+        conn.create_function(name, narg, func)
+
+def decode_name(name):
+    """Decodes a UTF-16 package name, or returns None if it is missing."""
+    if name is None:
+        return None
+    return name.decode('utf-16-be', errors='replace').rstrip('\x00')
+
+class MXFHeader:
+    """Header metadata of an OP-Atom MXF file, parsed directly from the
+    file's header partition."""
+
+    def __init__(self, sets):
+        self.sets = sets
+        self.material_package = self._find_package(MATERIAL_PACKAGE)
+        self.file_package = self._find_file_package()
+
+    @classmethod
+    def read(cls, fh):
+        """Reads and parses the header partition of a binary file
+        object."""
+        return cls(parse_local_sets(read_header_partition(fh)))
+
+    def _find_package(self, settype, umid=None):
+        for kind, items in self.sets.values():
+            if kind != settype:
+                continue
+            if umid is None or items.get(TAG_PACKAGE_UID) == umid:
+                return items
+        raise MXFHeaderError('Could not find package in header metadata.')
+
+    def _find_file_package(self):
+        """The file package is the source package linked to the file's
+        essence container, or failing that, the source package with an
+        essence descriptor."""
+        for kind, items in self.sets.values():
+            if kind == ESSENCE_CONTAINER_DATA and TAG_LINKED_PACKAGE_UID in items:
+                return self._find_package(SOURCE_PACKAGE,
+                                          items[TAG_LINKED_PACKAGE_UID])
+        for kind, items in self.sets.values():
+            if kind == SOURCE_PACKAGE and self._descriptor_type(items):
+                return items
+        raise MXFHeaderError('Could not find file package in header metadata.')
+
+    def _descriptor_type(self, package):
+        kind, _ = self.sets.get(package.get(TAG_DESCRIPTOR), (None, None))
+        if kind in PICTURE_DESCRIPTORS:
+            return 'video'
+        if kind in SOUND_DESCRIPTORS:
+            return 'audio'
+        return None
+
+    def _tracks(self, package):
+        for ref in unpack_batch(package.get(TAG_PACKAGE_TRACKS, b'')):
+            if ref in self.sets:
+                yield self.sets[ref][1]
+
+    def _track_type(self, track):
+        _, sequence = self.sets.get(track.get(TAG_TRACK_SEQUENCE), (None, {}))
+        data_definition = sequence.get(TAG_DATA_DEFINITION, b'')
+        return DATA_DEFINITIONS.get(data_definition[8:13])
+
+    def _components(self, track):
+        """Yields the structural components of a track's sequence,
+        which may itself be a single component."""
+        kind, sequence = self.sets.get(track.get(TAG_TRACK_SEQUENCE), (None, {}))
+        if kind != SEQUENCE:
+            yield kind, sequence
+            return
+        for ref in unpack_batch(sequence.get(TAG_SEQUENCE_COMPONENTS, b'')):
+            if ref in self.sets:
+                yield self.sets[ref]
+
+    def _track_duration(self):
+        """The duration in seconds of the file package's essence track,
+        for files whose descriptor has no ContainerDuration."""
+        for track in self._tracks(self.file_package):
+            if self._track_type(track) is None:
+                continue
+            numerator, denominator = unpack_rational(
+                track.get(TAG_TRACK_EDIT_RATE, bytes(8)))
+            _, sequence = self.sets.get(track.get(TAG_TRACK_SEQUENCE), (None, {}))
+            if numerator > 0 and denominator > 0 and \
+               TAG_COMPONENT_DURATION in sequence:
+                frames = int.from_bytes(sequence[TAG_COMPONENT_DURATION], 'big',
+                                        signed=True)
+                if frames > 0:
+                    return frames * denominator / numerator
+        return None
+
+    def _start_timecode(self):
+        """The start timecode of the file package's timecode track,
+        which ffprobe reports as the stream's timecode."""
+        for track in self._tracks(self.file_package):
+            for kind, component in self._components(track):
+                if kind != TIMECODE_COMPONENT:
+                    continue
+                base = unpack_int(component.get(TAG_TIMECODE_BASE, b''))
+                if not base or TAG_START_TIMECODE not in component:
+                    continue
+                return format_timecode(
+                    unpack_int(component[TAG_START_TIMECODE]), base,
+                    component.get(TAG_DROP_FRAME, b'\x00') != b'\x00')
+        return None
+
+    def _reel_package(self):
+        """The package the file package was made from, whose name and
+        umid ffprobe reports as the stream's reel_name and reel_umid,
+        or None."""
+        for track in self._tracks(self.file_package):
+            if self._track_type(track) is None:
+                continue
+            for kind, component in self._components(track):
+                source = component.get(TAG_SOURCE_PACKAGE_ID)
+                if kind != SOURCE_CLIP or not source or not source.strip(b'\x00'):
+                    continue
+                try:
+                    return self._find_package(SOURCE_PACKAGE, source)
+                except MXFHeaderError:
+                    return None
+        return None
+
+    def _track_name(self):
+        """The name of the material package track made from the file
+        package, which ffprobe reports as the stream's track_name, or
+        None."""
+        umid = self.file_package.get(TAG_PACKAGE_UID)
+        for track in self._tracks(self.material_package):
+            for kind, component in self._components(track):
+                if kind == SOURCE_CLIP and \
+                   component.get(TAG_SOURCE_PACKAGE_ID) == umid:
+                    return decode_name(track.get(TAG_TRACK_NAME)) or None
+        return None
+
+    def technical(self, size=None):
+        """Returns the technical metadata of the essence as stored in
+        the Media table, with the same values ffprobe would report
+        where the header has them. As ffprobe does, sound essence
+        reports a framerate of '0/0', its sample rate only giving its
+        duration. size is the size of the whole file, used to calculate
+        its bitrate."""
+        kind, descriptor = self.sets.get(self.file_package.get(TAG_DESCRIPTOR),
+                                         (None, {}))
+        metadata = dict.fromkeys(TECHNICAL_FIELDS)
+        metadata['size'] = size
+        metadata['start_tc'] = self._start_timecode()
+        reel = self._reel_package()
+        if reel is not None:
+            metadata['reel_name'] = decode_name(reel.get(TAG_PACKAGE_NAME)) or None
+            metadata['reel_umid'] = format_umid(reel[TAG_PACKAGE_UID])
+        metadata['track_name'] = self._track_name()
+        metadata['format_name'] = 'mxf'
+        if TAG_SAMPLE_RATE in descriptor:
+            numerator, denominator = unpack_rational(descriptor[TAG_SAMPLE_RATE])
+            if numerator > 0 and denominator > 0:
+                metadata['framerate'] = '0/0' if kind in SOUND_DESCRIPTORS \
+                    else f'{numerator}/{denominator}'
+                frames = unpack_int(descriptor.get(TAG_CONTAINER_DURATION, b''))
+                if frames:
+                    metadata['duration'] = frames * denominator / numerator
+        if metadata['duration'] is None:
+            metadata['duration'] = self._track_duration()
+        if metadata['duration'] and size:
+            metadata['bitrate'] = int(size * 8 / metadata['duration'])
+        if kind in PICTURE_DESCRIPTORS:
+            if TAG_STORED_WIDTH in descriptor:
+                metadata['width'] = unpack_int(descriptor[TAG_STORED_WIDTH])
+            if TAG_STORED_HEIGHT in descriptor:
+                height = unpack_int(descriptor[TAG_STORED_HEIGHT])
+                layout = unpack_int(descriptor.get(TAG_FRAME_LAYOUT, b'\x00'))
+                metadata['height'] = height * 2 if layout in FIELD_LAYOUTS else height
+            coding = descriptor.get(TAG_PICTURE_CODING, b'')[8:]
+            metadata['codec'] = next((codec for prefix, codec in PICTURE_CODINGS
+                                      if coding.startswith(prefix)), None)
+            if kind == CDCI_DESCRIPTOR:
+                metadata['pix_fmt'] = self._pix_fmt(descriptor)
+        elif kind in SOUND_DESCRIPTORS and TAG_QUANTIZATION_BITS in descriptor:
+            bits = unpack_int(descriptor[TAG_QUANTIZATION_BITS])
+            metadata['codec'] = f'pcm_s{bits}le'
+        return metadata
+
+    @staticmethod
+    def _pix_fmt(descriptor):
+        """The ffprobe pix_fmt of a CDCI descriptor, or None."""
+        subsampling = (unpack_int(descriptor.get(TAG_HORIZONTAL_SUBSAMPLING, b'')),
+                       unpack_int(descriptor.get(TAG_VERTICAL_SUBSAMPLING, b'\x01')))
+        depth = unpack_int(descriptor.get(TAG_COMPONENT_DEPTH, b''))
+        pix_fmt = CHROMA_FORMATS.get(subsampling)
+        if pix_fmt is None or depth not in (8, 10, 12):
+            return None
+        return pix_fmt if depth == 8 else f'{pix_fmt}{depth}le'
+
+    @property
+    def umid(self):
+        """The file package umid of the essence in this file."""
+        return format_umid(self.file_package[TAG_PACKAGE_UID])
+
+    @property
+    def material(self):
+        """The material package umid of the clip this file belongs to."""
+        return format_umid(self.material_package[TAG_PACKAGE_UID])
+
+    @property
+    def tracks(self):
+        """The file package umid, mediatype and track id of every track
+        of the material package, whose files are this file and its
+        siblings."""
+        tracks = list()
+        for track in self._tracks(self.material_package):
+            mediatype = self._track_type(track)
+            if mediatype is None:
+                continue
+            track_id = unpack_int(track.get(TAG_TRACK_ID, b'')) or None
+            for kind, component in self._components(track):
+                source = component.get(TAG_SOURCE_PACKAGE_ID)
+                if kind == SOURCE_CLIP and source and source.strip(b'\x00'):
+                    tracks.append((format_umid(source), mediatype, track_id))
+                    break
+        return tracks
+
+    @property
+    def name(self):
+        """The material package name, or None if it has no name."""
+        return decode_name(self.material_package.get(TAG_PACKAGE_NAME))
+
+    @property
+    def mediatype(self):
+        """The ffprobe codec_type of the essence in this file."""
+        mediatypes = list(filter(None, (self._track_type(track) for track
+                                        in self._tracks(self.file_package))))
+        if len(mediatypes) > 1:
+            raise MXFHeaderError('Expected only one media track per MXF.')
+        if mediatypes:
+            return mediatypes[0]
+        mediatype = self._descriptor_type(self.file_package)
+        if mediatype:
+            return mediatype
+        raise MXFHeaderError('Could not find a media track in file package.')
+
+
+class HeaderProbe(Probe):
+    """Presents the same metadata as Probe, read directly from the
+    header partition of an OP-Atom MXF file instead of running ffprobe.
+    Raises MXFHeaderError if the file cannot be parsed."""
+
+    # pylint: disable=W0231
+    def __init__(self, filepath, header=None, size=None):
+        """Reads the header of filepath, unless an already parsed
+        MXFHeader is given with the size of its file."""
+        if header is None:
+            with io.open(filepath, 'rb') as fh:
+                header = MXFHeader.read(fh)
+                size = os.fstat(fh.fileno()).st_size
+        self.data = header
+        self.stream = None
+        self.umid = header.umid
+        self.type = header.mediatype
+        self.name = header.name
+        if self.name is None:
+            raise MXFHeaderError('Material package has no name.')
+        self.material = header.material
+        self.tracks = header.tracks
+        self.mediatype = self.type
+        self.path = filepath
+        self.file = os.path.basename(filepath)
+        self.technical = header.technical(size)
+
+class RecordingReader:
+    """Wraps a binary file object, keeping a copy of everything read
+    from it."""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.data = bytearray()
+
+    def read(self, size=-1):
+        """Reads from the wrapped file object and records the result."""
+        chunk = self.fh.read(size)
+        self.data += chunk
+        return chunk
+
+class ZippedMember:
+    """The leading bytes of an MXF file stored in a zip archive. Only
+    the header partition is read, parsed in memory if possible, or else
+    the first ZIP_PROBE_BYTES are kept to be piped to ffprobe."""
+
+    def __init__(self, path, fh, size):
+        self.path = path
+        self.size = size
+        reader = RecordingReader(fh)
+        try:
+            self.header = MXFHeader.read(reader)
+        except MXFHeaderError:
+            self.header = None
+            limit = min(ZIP_PROBE_BYTES, size)
+            reader.read(max(limit - len(reader.data), 0))
+        self.data = bytes(reader.data)
+
+    def __str__(self):
+        return self.path
+
+    def probe(self):
+        """Returns a HeaderProbe or Probe of the member's data."""
+        if self.header is not None:
+            try:
+                return HeaderProbe(self.path, self.header, self.size)
+            except MXFHeaderError:
+                pass
+        probe = Probe(self.path, self.data)
+        probe.set_size(self.size)
+        return probe
+
+class StoredMember:
+    """Reads a stored (uncompressed) zip member directly from its
+    offset in an open binary file object of the archive."""
+
+    def __init__(self, rawhandle, offset, size):
+        self.rawhandle = rawhandle
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def read(self, size=-1):
+        """Reads up to size bytes, stopping at the end of the member."""
+        remaining = self.size - self.pos
+        if size < 0 or size > remaining:
+            size = remaining
+        self.rawhandle.seek(self.offset + self.pos)
+        chunk = self.rawhandle.read(size)
+        self.pos += len(chunk)
+        return chunk
+
+def open_zip_member(ziphandle, rawhandle, info):
+    """Opens a member of a zip archive for reading. Stored members are
+    read directly from their offset in rawhandle, an open binary file
+    object of the archive itself; others are decompressed as read."""
+    if info.compress_type != ZIP_STORED or info.flag_bits & 0x1:
+        return ziphandle.open(info)
+    rawhandle.seek(info.header_offset)
+    signature, name_length, extra_length = ZIP_LOCAL_HEADER.unpack(
+        rawhandle.read(ZIP_LOCAL_HEADER.size))
+    if signature != b'PK\x03\x04':
+        raise BadZipFile(f'Bad local file header for {info.filename}')
+    offset = info.header_offset + ZIP_LOCAL_HEADER.size + name_length + extra_length
+    return StoredMember(rawhandle, offset, info.file_size)
+
+def probe_mediafile(file):
+    """Returns a HeaderProbe for file, falling back on running ffprobe
+    if the header cannot be read or parsed. file is either a path or a
+    ZippedMember."""
+    if isinstance(file, ZippedMember):
+        return file.probe()
+    try:
+        return HeaderProbe(file)
+    except (MXFHeaderError, OSError):
+        return Probe(file)
+
+def try_probe(file, altpath=None):
+    """Probes file, renaming the result to altpath if given. Returns the
+    Probe object, or the error raised when file has no valid media
+    stream, one of PROBE_ERRORS."""
+    try:
+        mediafile = probe_mediafile(file)
+    except PROBE_ERRORS as e:
+        return e
+    if altpath:
+        mediafile.set_altpath(altpath)
+    return mediafile
+
+def timed_probe(file, altpath=None):
+    """Returns the result of try_probe and the seconds it took."""
+    started = time.perf_counter()
+    result = try_probe(file, altpath)
+    return result, time.perf_counter() - started
+
+def probe_kind(result):
+    """Returns how a result of try_probe was probed, one of
+    mxfmetrics.PROBE_KINDS."""
+    if isinstance(result, PROBE_ERRORS):
+        return 'failed'
+    if isinstance(result, HeaderProbe):
+        return 'header'
+    return 'ffprobe'
+
+def probe_files(files, workers=1):
+    """Probes an iterator of (file, altpath) pairs, yielding (file,
+    result, seconds) tuples as each probe completes, where result is as
+    returned by try_probe and seconds is how long the probe took. With
+    more than one worker, probes run concurrently in a thread pool,
+    with no more than twice as many files in flight as there are
+    workers."""
+    if workers <= 1:
+        for file, altpath in files:
+            yield (file,) + timed_probe(file, altpath)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = dict()
+        for file, altpath in files:
+            pending[pool.submit(timed_probe, file, altpath)] = file
+            if len(pending) >= workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield (pending.pop(future),) + future.result()
+        for future in as_completed(pending):
+            yield (pending[future],) + future.result()
+
+
 class MediaFile:
-    """Metadata for an Avid MediaFile."""
+    """Metadata for an Avid MediaFile, including any technical metadata
+    stored when it was indexed."""
 
+    # pylint: disable=R0913,R0914
     def __init__(self, umid=None, file=None, path=None, name=None,
-                 mediatype=None):
+                 mediatype=None, framerate=None, start_tc=None,
+                 duration=None, width=None, height=None, pix_fmt=None,
+                 codec=None, bitrate=None, size=None, reel_name=None,
+                 material=None, reel_umid=None, track_name=None,
+                 format_name=None):
         self.umid = umid
         self.file = file
         self.path = path
         self.name = name
         self.mediatype = mediatype
+        self.framerate = framerate
+        self.start_tc = start_tc
+        self.duration = duration
+        self.width = width
+        self.height = height
+        self.pix_fmt = pix_fmt
+        self.codec = codec
+        self.bitrate = bitrate
+        self.size = size
+        self.reel_name = reel_name
+        self.material = material
+        self.reel_umid = reel_umid
+        self.track_name = track_name
+        self.format_name = format_name
+
+    def to_mob(self):
+        """Returns a mobs.MediaFile built from the stored metadata, the
+        same as mobs.MediaFile.probe would return for the file, or
+        None if the file was indexed without the framerate, duration,
+        bitrate and size needed, in which case it must be probed, or is
+        sound essence, with no framerate."""
+        if None in (self.framerate, self.duration, self.bitrate, self.size) or \
+           self.framerate == '0/0':
+            return None
+        return mobs.MediaFile.from_metadata(
+            self.path, mediatype=self.mediatype, name=self.name,
+            file_package_umid=self.umid, material_package_umid=self.material,
+            **dict((field, getattr(self, field)) for field in TECHNICAL_FIELDS))
 
 
 class Progress:
@@ -124,6 +1092,7 @@ class Progress:
         self.progress_per_file = 0
         self.accumulated = 0
         self.progress = 0
+        self.remaining = 0
 
     @classmethod
     def set_quiet(cls, quiet=True):
@@ -139,20 +1108,30 @@ class Progress:
         """Configures the progress object based on the number of objects
         needing to be processed."""
         self.progress = 0
+        self.remaining = length
         if length == 0:
             self.progress_per_file = self.progress_bar_length
             self.increment()
             return
         self.progress_per_file = self.progress_bar_length / length
 
+    def add_length(self, length):
+        """Adds units of work to a progress bar that may already be
+        under way, spreading its unfilled length over all of the
+        remaining work."""
+        self.remaining += length
+        if self.remaining > 0:
+            unfilled = self.progress_bar_length - self.progress - self.accumulated
+            self.progress_per_file = max(unfilled, 0) / self.remaining
+
     def increment(self, units=1):
         """Increments the progress counter by one or more units of work,
         and updates the displayed progress bar if appropriate."""
+        self.remaining = max(self.remaining - units, 0)
         self.accumulated += units * self.progress_per_file
-        accumulated = self.accumulated + units * self.progress_per_file
-        if accumulated >= 1:
-            display_units = int(accumulated)
-            self.accumulated = accumulated - display_units
+        if self.accumulated >= 1:
+            display_units = int(self.accumulated)
+            self.accumulated -= display_units
             self.progress += display_units
             self.display(display_units)
 
@@ -177,132 +1156,333 @@ class MediaDatabase:
     ffmpeg suite. The string is uppercase, apart from the hexadecimal
     prefix '0x'. See
     https://en.wikipedia.org/wiki/Unique_Material_Identifier for
-    further details."""
-
-    def __init__(self, conn=None, volumes=None, repo_volumes=None, quiet=False):
+    further details.
+
+    If shard_dir is given, each volume is indexed into a shard database
+    of its own in shard_dir, which is ATTACHed to conn while the volume
+    is mounted, and queried through temporary views named for the
+    tables of the main database. Shards can be indexed by separate
+    processes, up to processes at once, without contending for one
+    writer.
+
+    If lazy is True, lookups are answered from the index as it is, and
+    only a lookup that finds nothing indexes folders, as index_on_miss
+    does.
+
+    Indexing a database stored in a file holds its
+    mxflease.WriterLease, so only one process indexes it at a time;
+    others go on reading the index as it is."""
+
+    def __init__(self, conn=None, volumes=None, repo_volumes=None, quiet=False,
+                 workers=None, metrics=None, shard_dir=None, processes=1,
+                 lazy=False):
         self.conn = conn
         self.volumes = volumes
         self.repo_volumes = repo_volumes
         self.quiet = quiet
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+        if metrics is None:
+            metrics = mxfmetrics.IndexMetrics()
+        self.metrics = metrics
+        self.shard_dir = shard_dir
+        self.processes = processes
+        self.lazy = lazy
+        self.identified = False
+        self.shards = dict()
+        self.shard_dbs = dict()
         Progress.base_quiet = quiet
-        self.mxf_tables = list()
         self.directory = DirectoryTable(conn)
+        self.volume_ids = VolumeTable(conn)
+        db_file = database_file(conn)
+        self.lease = None if db_file is None else \
+            mxflease.WriterLease.for_database(db_file)
+        self.configure()
         self.create_directory()
+        if shard_dir is not None:
+            os.makedirs(shard_dir, exist_ok=True)
+            self.attach_shards()
 
     def close(self):
         """Closes the connection to the database."""
+        for shard in self.shard_dbs.values():
+            shard.close()
+        self.shard_dbs = dict()
         self.conn.commit()
         self.conn.close()
 
+    @contextmanager
+    def writing(self, blocking=True):
+        """Holds the writer lease on the database for the body of a
+        with statement, yielding whether it was acquired. A database
+        in memory has no lease, and is always writable."""
+        if self.lease is None:
+            yield True
+            return
+        with self.lease.holding(blocking) as acquired:
+            yield acquired
+
+    def shard_file(self, volname):
+        """Returns the path of the shard database for a volume."""
+        return os.path.join(self.shard_dir, volname + SHARD_SUFFIX)
+
+    def open_shard(self, volname):
+        """Returns the MediaDatabase of a volume's shard, creating the
+        shard if needed. Rows indexed for the volume in the main
+        database are moved into a new shard, so they aren't probed
+        again."""
+        if volname not in self.shard_dbs:
+            validate_table(volname)
+            shard_file = self.shard_file(volname)
+            new = not os.path.exists(shard_file)
+            self.shard_dbs[volname] = MediaDatabase(
+                sqlite3.connect(shard_file), quiet=self.quiet,
+                workers=self.workers, metrics=self.metrics)
+            if new:
+                self.attach(volname)
+                self._move_to_shard(volname)
+        return self.shard_dbs[volname]
+
+    def _move_to_shard(self, volname):
+        schema = self.shards.get(volname)
+        if schema is None:
+            return
+        media = ', '.join(field for field, _ in MXFTable.FIELDS)
+        directory = 'mxftable, mtime, path, volume, getter, indexed'
+        with self.conn as c:
+            folders = list(row[0] for row in c.execute(
+                'SELECT DISTINCT folder FROM main.Media WHERE volume=?',
+                (volname,)))
+            c.execute(f'INSERT OR REPLACE INTO "{schema}".Media ({media}) ' +
+                      f'SELECT {media} FROM main.Media WHERE volume=?',
+                      (volname,))
+            c.execute(f'INSERT OR REPLACE INTO "{schema}".Tracks SELECT * ' +
+                      'FROM main.Tracks WHERE material IN (SELECT material ' +
+                      'FROM main.Media WHERE volume=?)', (volname,))
+            for folder in folders:
+                c.execute(f'INSERT OR REPLACE INTO "{schema}".Sources SELECT * ' +
+                          'FROM main.Sources WHERE folder=?', (folder,))
+                c.execute(f'INSERT OR REPLACE INTO "{schema}".Quarantine ' +
+                          'SELECT * FROM main.Quarantine WHERE folder=?', (folder,))
+                c.execute(f'INSERT OR REPLACE INTO "{schema}".Directory ' +
+                          f'({directory}) SELECT {directory} FROM main.Directory ' +
+                          'WHERE mxftable=?', (folder,))
+                c.execute('DELETE FROM main.Sources WHERE folder=?', (folder,))
+                c.execute('DELETE FROM main.Quarantine WHERE folder=?', (folder,))
+                c.execute('DELETE FROM main.Directory WHERE mxftable=?', (folder,))
+            c.execute(f'INSERT OR REPLACE INTO "{schema}".Directory ({directory}) ' +
+                      f'SELECT {directory} FROM main.Directory WHERE volume=?',
+                      (volname,))
+            c.execute('DELETE FROM main.Directory WHERE volume=?', (volname,))
+            c.execute('DELETE FROM main.Media WHERE volume=?', (volname,))
+        MXFTable.prune_search(self.conn)
+
+    def attach(self, volname):
+        """ATTACHes the shard of a volume, so that its media are found
+        by lookups. Returns False if SQLite cannot attach any more
+        databases."""
+        if volname in self.shards:
+            return True
+        validate_table(volname)
+        schema = f'shard_{volname}'
+        try:
+            self.conn.execute(f'ATTACH DATABASE ? AS "{schema}"',
+                              (self.shard_file(volname),))
+        except sqlite3.OperationalError as err:
+            warnings.warn(f'Could not attach shard for {volname}: {err}')
+            return False
+        self.shards[volname] = schema
+        self._create_views()
+        return True
+
+    def detach(self, volname):
+        """DETACHes the shard of a volume, leaving its media out of
+        lookups."""
+        schema = self.shards.pop(volname, None)
+        if schema is None:
+            return
+        shard = self.shard_dbs.pop(volname, None)
+        if shard is not None:
+            shard.close()
+        self._create_views()
+        self.conn.execute(f'DETACH DATABASE "{schema}"')
+
+    def attach_shards(self):
+        """Attaches the shard of every mounted volume in shard_dir, and
+        detaches the shards of volumes no longer mounted. A volume is
+        mounted if any folder indexed in its shard exists."""
+        for filename in sorted(os.listdir(self.shard_dir)):
+            if not filename.endswith(SHARD_SUFFIX):
+                continue
+            volname = filename[:-len(SHARD_SUFFIX)]
+            if not self.attach(volname):
+                continue
+            schema = self.shards[volname]
+            paths = list(row[0] for row in self.conn.execute(
+                f'SELECT path FROM "{schema}".Directory WHERE path IS NOT NULL'))
+            if not any(os.path.isdir(path) for path in paths):
+                self.detach(volname)
+        return list(self.shards)
+
+    def _create_views(self):
+        """Creates temporary views of the Media, SearchNames, Sources,
+        Quarantine, Directory and Tracks tables of the main database and every attached
+        shard, which shadow the tables of the main database for
+        lookups."""
+        schemas = self.schemas()
+        tables = (('Media', ', '.join(field for field, _ in MXFTable.FIELDS)),
+                  ('SearchNames', 'normname'),
+                  ('Sources', 'source, folder, size, mtime_ns, inode'),
+                  ('Quarantine', 'source, folder, volume, size, mtime_ns, ' +
+                   'inode, error, failed'),
+                  ('Directory', 'mxftable, mtime, path, volume, getter, indexed'),
+                  ('Tracks', 'material, umid, mediatype, track'))
+        with self.conn as c:
+            for table, columns in tables:
+                c.execute(f'DROP VIEW IF EXISTS temp.{table}')
+                if len(schemas) == 1:
+                    continue
+                union = ' UNION ALL '.join(f'SELECT {columns} FROM "{schema}".{table}'
+                                           for schema in schemas)
+                c.execute(f'CREATE TEMP VIEW {table} AS {union}')
+
+    def schemas(self):
+        """Returns the names of the main database and attached shards."""
+        return ['main'] + list(self.shards.values())
+
+    def configure(self):
+        """Applies PRAGMAS to the connection."""
+        for pragma in PRAGMAS:
+            self.conn.execute(pragma)
+
     def create_directory(self):
         """Creates required database tables, if they don't already
-        exist."""
+        exist, and migrates any per-folder tables from earlier versions
+        into the Media table."""
         self.directory.create_table()
+        self.volume_ids.create_table()
+        MXFTable.create_table(self.conn)
+        self.migrate_tables()
+
+    def migrate_tables(self):
+        """Moves the rows of each per-folder MXF table, as created by
+        earlier versions, into the Media table and drops the old
+        table. The folder keeps its table name, so its Directory entry
+        still applies."""
+        with self.conn as c:
+            tables = [row[0] for row in c.execute(
+                "SELECT name FROM sqlite_master WHERE type='table'")]
+        self.conn.create_function('normalize_name', 1, lambda name: None if
+                                  name is None else normalize_name(name))
+        self.conn.create_function('encode_umid', 1, encode_umid)
+        for table in tables:
+            with self.conn as c:
+                columns = [row[1] for row in
+                           c.execute(f'PRAGMA table_info("{table}")')]
+                if columns != list(MXFTable.LEGACY_COLUMNS):
+                    continue
+                first = c.execute(f'SELECT path FROM "{table}" LIMIT 1').fetchone()
+                volume = volume_from_tablename(table, first[0]) if first else None
+                c.execute('INSERT OR REPLACE INTO Media ' +
+                          '(umid, file, path, name, mediatype, volume, folder, ' +
+                          'normname) SELECT encode_umid(umid), file, path, name, ' +
+                          'mediatype, ' +
+                          f'?, ?, normalize_name(name) FROM "{table}"',
+                          (volume, table))
+                c.execute(f'DROP TABLE "{table}"')
 
     @staticmethod
-    def index_files(files, progress=None):    # files is an iterator
-        """Iterates over files and returns an indexed dictionary.
-        Optionally triggers a pre-initialized Progress object."""
-        mediafiles = dict()
-        for file, altpath in files:
+    def index_files(files, progress=None, workers=1, stats=None):    # files is an iterator
+        """Iterates over files and returns an indexed dictionary, in the
+        order that probes complete. Probes up to workers files at once.
+        Optionally triggers a pre-initialized Progress object, and
+        records each probe in an mxfmetrics.IndexStats."""
+        return dict((mediafile.umid, mediafile) for mediafile in
+                    MediaDatabase.iter_index_files(files, progress, workers,
+                                                   stats))
+
+    @staticmethod
+    def iter_index_files(files, progress=None, workers=1, stats=None,
+                         failures=None):
+        """Yields the Probe of each of files as index_files would index
+        it, as soon as its probe completes, warning of files that
+        could not be probed and appending them to failures, if given,
+        with the error raised."""
+        for file, mediafile, seconds in probe_files(files, workers):
             if progress:
                 progress.increment()
-            try:
-                mediafile = Probe(file)
-            except TypeError as e:
-                msg = (f'{e}: Could not find valid media stream for {file}')
+            if stats is not None:
+                stats.add_probe(probe_kind(mediafile), seconds)
+            if isinstance(mediafile, PROBE_ERRORS):
+                msg = (f'{mediafile}: Could not find valid media stream for {file}')
                 warnings.warn(msg, UserWarning)
+                if failures is not None:
+                    failures.append((file, mediafile))
                 continue
-            if altpath:
-                mediafile.set_altpath(altpath)
-            mediafiles[mediafile.umid] = mediafile
-        return mediafiles
+            yield mediafile
 
     @staticmethod
-    def get_dir(path, progress=None):
-        """Yields all .mxf files in the top-level of a directory and
-        optionally initializes a progress bar."""
-        files = os.listdir(path)
-        mxf = list(os.path.join(path, fname) for fname in files
-                   if is_mediafile(fname))
-        if progress:
-            progress.set_length(len(mxf))
-        for file in mxf:
-            yield file, None
+    def get_dir(path):
+        """Yields the path and FileStat of all .mxf files in the
+        top-level of a directory, using the stat data gathered by
+        os.scandir."""
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if is_mediafile(entry.name) and entry.is_file():
+                    yield entry.path, file_signature(entry)
 
     @staticmethod
-    def get_dir_recursive(path, progress=None, index_zips=True):
-        """Recursively yeilds all .mxf files in a directory and optionally
-        initializes a progress bar."""
-        mxf = list()
-        for dirpath, _, fnames in os.walk(path):
-            for fname in fnames:
-                if is_mediafile(fname):
-                    mxf.append(os.path.join(dirpath, fname))
-                if fname.endswith('.zip') and index_zips:
-                    yield from MediaDatabase.get_zipped(os.path.join(dirpath, fname),
-                                                        progress=progress)
-                    progress.flush()
-        if progress:
-            progress.set_length(len(mxf))
-        for file in mxf:
-            yield file, None
+    def get_dir_recursive(path, index_zips=True, workers=SCAN_WORKERS):
+        """Recursively yields the path and FileStat of all .mxf files in
+        a directory, and of any zip archives that may contain them, as
+        they are found by scan_tree, along with any directories that
+        couldn't be listed."""
+        def accept(name):
+            return is_mediafile(name) or (index_zips and is_zipfile(name))
+        yield from scan_tree(path, accept, workers)
+
+    @staticmethod
+    def get_files(sources, progress=None):
+        """Yields (file, altpath) pairs to be probed for an iterable of
+        sources, expanding zip archives into their MXF members."""
+        for source in sources:
+            if is_zipfile(source):
+                yield from MediaDatabase.get_zipped(source, progress)
+            else:
+                yield source, None
 
     @staticmethod
     def get_zipped(path, progress=None):
-        """Yields all .mxf files in a zipfile by extracting them to a
-        tempfile. Optionally initializes a progress bar."""
-        #breakpoint()
-        with ZipFile(path) as ziphandle:
-            zipped_mxf = list(file for file in ziphandle.namelist()
-                              if is_mediafile(file))
+        """Yields all .mxf files in a zipfile as ZippedMember objects,
+        reading only as much of each as is needed to identify its
+        media. Optionally adds the members to a progress bar."""
+        with ZipFile(path) as ziphandle, io.open(path, 'rb') as rawhandle:
+            zipped_mxf = list(info for info in ziphandle.infolist()
+                              if is_mediafile(info.filename))
             if progress:
-                progress.set_length(len(zipped_mxf))
-            for entry in zipped_mxf:
+                progress.add_length(len(zipped_mxf))
+            for info in zipped_mxf:
+                altpath = os.path.join(path, info.filename)
                 try:
-                    mxf = ziphandle.open(entry)
-                except BadZipFile as e:
-                    msg = f'Could not open {entry} in {path}'
-                    warnings.warn(msg, e)
+                    with open_zip_member(ziphandle, rawhandle, info) as mxf:
+                        member = ZippedMember(altpath, mxf, info.file_size)
+                except (BadZipFile, zlib.error):
+                    msg = f'Could not open {info.filename} in {path}'
+                    warnings.warn(msg)
                     continue
-                with tempfile.NamedTemporaryFile(suffix='.mxf') as file:
-                    file.write(mxf.read())
-                    yield file.name, os.path.join(path, entry)
-                mxf.close()
-
-    def get_repo(self, path, progress=None):
-        """Evaluates path and either gets files from zip or recursively
-        from directory."""
-        if path.endswith('.zip'):
-            yield from self.get_zipped(path, progress)
-        yield from self.get_dir_recursive(path, progress)
+                yield member, altpath
+
+    def get_repo(self, path):
+        """Evaluates path and either yields the zip itself or recursively
+        yields files from a directory."""
+        if is_zipfile(path):
+            yield path, path_signature(path)
+        else:
+            yield from self.get_dir_recursive(path)
 
     def _index_zip(self, zippath, quiet=None):
-        umids = dict()
-        with ZipFile(zippath) as zipped:
-            for file in (file for file in zipped.namelist()
-                         if file.endswith('.mxf')):
-                if os.path.basename(file).startswith('.'):
-                    continue
-                try:
-                    zmxf = zipped.open(file)
-                except BadZipFile:
-                    msg = f'Could not open {file} in {zippath}'
-                    warnings.warn(msg)
-                    continue
-                with tempfile.NamedTemporaryFile(suffix='.mxf') as mxf:
-                    mxf.write(zmxf.read())
-                    #print(mxf.name, '--', file, sep='\n')
-                    #breakpoint()
-                    try:
-                        mediafile = Probe(mxf.name)
-                    except:
-                        warnings.warn(f'Could not find valid media stream for {mxf}', RuntimeWarning)
-                    mediafile.file = file
-                    mediafile.path = os.path.join(zippath, file)
-                    umids[mediafile.umid] = mediafile
-                zmxf.close()
-        return umids
+        return self.index_files(self.get_zipped(zippath), workers=self.workers)
 
     @staticmethod
     def __path_to_tablename(mxfdir):
@@ -318,49 +1498,143 @@ class MediaDatabase:
     ####
 
     def drop(self, table):
-        """Drops the table 'table'. Suppresses exception if table does
-        not exist."""
+        """Removes every row indexed for the folder 'table'."""
         validate_table(table)
-        with self.conn as c:
-            try:
-                c.execute(f'DROP TABLE {table}')
-            except sqlite3.OperationalError:
-                c.rollback()
-        # remove table from mxf_tables
+        MXFTable(table, self.conn).drop()
 
     def index_volume(self, volname, topdir, file_getter, index_zips=False):
-        """Indexes a volume, creating a new table for each top-level
-        subdirectory, and skipping those which have not changed since
-        their last indexing. Topdir does not have to be the root of the
-        volume."""
-        #breakpoint()
+        """Indexes a volume, keeping a folder in the index for each
+        top-level subdirectory. Only files added or changed since the
+        last indexing are probed. Topdir does not have to be the root
+        of the volume."""
         if not os.path.isdir(topdir):
             return  # skip if there is no media dir on the volume
         volname = clean_tablename(volname)
-        subdirs = get_subdirs(topdir, index_zips)
-        for subdir in subdirs:
-            progress = Progress()
-            table = get_tablename(volname, subdir)
-            mxftable = MXFTable(table, self.conn)
-            self.mxf_tables.append(mxftable)
-
-            modified_time = os.stat(subdir).st_mtime_ns
-            # skip subdir if it hasn't been modified since last index
-            print
-            if table in self.directory and int(self.directory[table]) >= modified_time:
-                progress.message(f'{subdir} up to date. Skipping.')
-                continue
+        with self.metrics.volume(volname, topdir):
+            for subdir in get_subdirs(topdir, index_zips):
+                self.index_folder(volname, subdir, file_getter)
+        if self.shard_dir is not None:
+            MXFTable.prune_search(self.open_shard(volname).conn)
+            self.attach(volname)
+
+    def index_folder(self, volname, subdir, file_getter):
+        """Brings the index of a single subdirectory up to date.
+        file_getter yields the path and FileStat of every MXF file or
+        zip archive in subdir; files whose FileStat matches the one
+        recorded at their last indexing are skipped, new or changed
+        files are probed as they are listed, and rows for missing files
+        are deleted. A directory yielded with a FileStat of None couldn't
+        be listed, and the rows of files in it are kept.
+        Counters and probe latencies are recorded in self.metrics.
+        With a shard_dir, the folder is indexed in its volume's shard.
+        Waits for the writer lease if another process holds it."""
+        if self.shard_dir is not None:
+            return self.open_shard(volname).index_folder(volname, subdir,
+                                                         file_getter)
+        table = get_tablename(volname, subdir)
+        with self.writing(), self.metrics.folder(volname, table, subdir) as stats:
+            self._index_folder(volname, subdir, file_getter, table, stats)
+
+    def _index_folder(self, volname, subdir, file_getter, table, stats):
+        progress = Progress()
+        mxftable = MXFTable(table, self.conn, volname)
+        started = time.perf_counter()
+        modified_time = os.stat(subdir).st_mtime_ns
+        found = dict()
+        changed = list()
+        known = mxftable.sources()
+        quarantined = mxftable.quarantined()
+        # directories that couldn't be listed, whose files are kept
+        unlisted = set()
+        if not known and table in self.directory and \
+           self.directory[table] >= modified_time:
+            listing = list(file_getter(subdir))
+            found.update((source, stat) for source, stat in listing
+                         if stat is not None)
+            known = mxftable.adopt(found)
+            stats.adopted = len(known)
+        else:
+            listing = file_getter(subdir)
+
+        def candidates():
+            """Streams new or changed files to be probed as the folder
+            is listed, growing the progress bar to match."""
+            for source, stat in listing:
+                if stat is None:
+                    unlisted.add(source)
+                    continue
+                found[source] = stat
+                if known.get(source) == stat:
+                    continue
+                if quarantined.get(source) == stat:
+                    stats.quarantined += 1
+                    continue
+                if not changed:
+                    progress.message(f'Indexing {subdir} ({table})')
+                changed.append(source)
+                if not is_zipfile(source):
+                    progress.add_length(1)
+                yield source
+            stats.scan_seconds = time.perf_counter() - started
+
+        batch = dict()
+        cleared = set()
+        failures = list()
+
+        def flush():
+            """Replaces the rows of the sources probed in batch and
+            records them as indexed, committing them, so an interrupted
+            run resumes after the last batch."""
+            sources = set(mediafile.source for mediafile in batch.values())
+            mxftable.remove(list(sources - cleared))
+            cleared.update(sources)
+            mxftable.create_with(batch)
+            # zip archives are recorded once all of their members are in
+            mxftable.add_sources((source, found[source]) for source in sources
+                                 if not is_zipfile(source))
+            batch.clear()
+
+        for mediafile in self.iter_index_files(
+                self.get_files(candidates(), progress), progress,
+                self.workers, stats, failures):
+            mediafile.source = find_source(mediafile.path, found)
+            # keyed by path, so copies of the same media each keep a row
+            batch[mediafile.path] = mediafile
+            if len(batch) >= INSERT_BATCH:
+                flush()
+        flush()
+        removed = list(source for source in list(known) + list(quarantined)
+                       if source not in found and
+                       find_source(source, unlisted) is None)
+        stats.files = len(found)
+        stats.unchanged = len(found) - len(changed) - stats.quarantined
+        stats.changed = len(changed)
+        stats.removed = len(removed)
+        stats.bytes = sum(found[source].size for source in changed)
+        stats.changed_sample = list(
+            dict(source=source, now=found[source]._asdict(),
+                 was=known[source]._asdict() if source in known else None)
+            for source in changed[:mxfmetrics.CHANGED_SAMPLE])
+        if not removed and not changed:
+            progress.message(f'{subdir} up to date. Skipping.')
+            self.directory.register(table, modified_time, subdir, volname,
+                                    file_getter.__name__)
+            return
 
-            # drop old version of subdir table, if it exists
-            self.drop(table)
+        if not changed:
             progress.message(f'Indexing {subdir} ({table})')
-            # get files to index with file_getter provided by caller
-            files = file_getter(subdir, progress)
-            # create a new table and register it with the current modified_time
-            mxftable.create_with(self.index_files(files))
-            progress.flush()
-            self.directory[table] = modified_time
-
+        # files that failed to probe are not recorded, so will be retried
+        mxftable.remove(removed + list(source for source in changed
+                                       if source not in cleared))
+        mxftable.add_sources((source, found[source]) for source in changed
+                             if is_zipfile(source))
+        # members of zip archives are retried with their archive
+        mxftable.quarantine((file, found[file], f'{type(err).__name__}: {err}')
+                            for file, err in failures if file in found)
+        progress.flush()
+        progress.message(f'{len(changed)} new or changed, {len(removed)} removed')
+        self.directory.register(table, modified_time, subdir, volname,
+                                file_getter.__name__)
 
     # this method needs major cleanup!
     def _index_repo_volume(self, vol):
@@ -373,7 +1647,6 @@ class MediaDatabase:
             table = f'{os.path.basename(vol)}_{os.path.basename(mxfdir)}'.replace(' ', '_')
             table = table.replace('-', '_')
             mxftable = MXFTable(table, self.conn)
-            self.mxf_tables.append(mxftable)
 
             mtime = os.stat(mxfdir).st_mtime_ns
             if table in self.directory and self.directory[table] == mtime:
@@ -394,7 +1667,6 @@ class MediaDatabase:
             table = table.replace('-', '_')
             print(table)
             mxftable = MXFTable(table, self.conn)
-            self.mxf_tables.append(mxftable)
             mtime = os.stat(mxfdir).st_mtime_ns
             if table in self.directory and self.directory[table] == mtime:
                 if not self.quiet:
@@ -406,43 +1678,242 @@ class MediaDatabase:
             mxftable.create_with(self.index_zip(mxfdir))
             self.directory[table] = mtime
 
-    def index_all(self, volumes=None):
+    def index_all(self, volumes=None, wait=False):
         """Index a list of volumes. If none are specified, indexes all
         volumes specified at object instantiation. If that value is None,
-        uses contents of '/Volumes' directory."""
+        uses contents of '/Volumes' directory. If another process holds
+        the writer lease, returns False without indexing, leaving
+        lookups to the index as it is, unless wait is True."""
+        with self.writing(wait) as acquired:
+            if not acquired:
+                Progress().message('Another process is indexing ' +
+                                   f'(pid {self.lease.holder()}); ' +
+                                   'using the index as it is')
+                return False
+            jobs = self.identify_volumes(volumes)
+            with self.metrics.run():
+                if self.shard_dir is not None and self.processes > 1:
+                    self._index_shards(jobs)
+                else:
+                    for volname, topdir, getter, index_zips in jobs:
+                        self.index_volume(volname, topdir, getattr(self, getter),
+                                          index_zips)
+            MXFTable.prune_search(self.conn)
+        if self.shard_dir is not None:
+            self.attach_shards()
+        return True
+
+    def volume_jobs(self, volumes=None):
+        """Returns the name, media directory, file getter name and
+        whether to index zip archives of volumes, or of the volumes
+        specified at object instantiation. If that value is None, uses
+        contents of '/Volumes' directory."""
         if volumes is None:
             volumes = self.volumes
         if volumes is None and self.repo_volumes is None:
             volumes = (os.path.join('/Volumes', vol) for vol in os.listdir('/Volumes'))
-        if volumes:
-            for vol in volumes:
-                self.index_volume(os.path.basename(vol), get_mxfdir(vol),
-                                  self.get_dir)
-        if self.repo_volumes:
-            for vol in self.repo_volumes:
-                self.index_volume(os.path.basename(vol),
-                                  vol, self.get_repo, index_zips=True)
-
-    def _query_mxf_tables(self, umid):
-        union_buffer = list()
+        jobs = list((os.path.basename(vol), get_mxfdir(vol), 'get_dir', False)
+                    for vol in volumes or ())
+        jobs.extend((os.path.basename(vol), vol, 'get_repo', True)
+                    for vol in self.repo_volumes or ())
+        return jobs
+
+    def identify_volumes(self, volumes=None):
+        """Identifies every volume with media, as identify_volume does,
+        and returns their volume_jobs. The id of each volume is worked
+        out once. Volumes sharing an id, as a mirror copied file by file
+        or a cloned filesystem do, are given new ids first, apart from
+        the one the id was registered to, or else the first of them."""
+        jobs = self.volume_jobs(volumes)
+        # volumes without media are left alone, rather than marked
+        mounted = list((volname, topdir if getter == 'get_repo' else
+                        updir(topdir, 2))
+                       for volname, topdir, getter, _ in jobs
+                       if os.path.isdir(topdir))
+        ids = dict((vol, volume_id(vol)) for _, vol in mounted)
+        sharing = dict()
+        for vol, found in ids.items():
+            if found is not None:
+                sharing.setdefault(found, list()).append(vol)
+        for found, vols in sharing.items():
+            if len(vols) < 2:
+                continue
+            known = self.volume_ids.get(found)
+            keep = known[1] if known is not None and known[1] in vols else vols[0]
+            for vol in vols:
+                if vol != keep:
+                    ids[vol] = new_volume_id(vol)
+        for volname, vol in mounted:
+            if ids[vol] is not None:
+                self.identify_volume(volname, vol, ids[vol], ids)
+        return jobs
+
+    def lazy_folders(self):
+        """Yields the volume name, path and file getter of every folder
+        that hasn't been indexed within LAZY_REFRESH seconds, those
+        changed or added since they were last indexed first, and the
+        most recently modified first among them, as new media is most
+        likely to be found there."""
+        cutoff = time.time() - LAZY_REFRESH
+        folders = list()
+        for volname, topdir, getter, index_zips in self.volume_jobs():
+            if not os.path.isdir(topdir):
+                continue
+            volname = clean_tablename(volname)
+            for subdir in get_subdirs(topdir, index_zips):
+                indexed, mtime = self.directory.indexed(get_tablename(volname, subdir))
+                if indexed is not None and indexed >= cutoff:
+                    continue
+                current = os.stat(subdir).st_mtime_ns
+                changed = mtime is None or current > mtime
+                folders.append((not changed, -current, volname, subdir, getter))
+        for _, _, volname, subdir, getter in sorted(folders):
+            yield volname, subdir, getattr(self, getter)
+
+    def index_on_miss(self, resolved):
+        """In lazy mode, indexes the folders returned by lazy_folders
+        one at a time until resolved returns True, after a lookup
+        found nothing. Returns True if any folder was indexed. Does
+        nothing while another process holds the writer lease. Volumes
+        are identified the first time, rather than when opened."""
+        if not self.lazy:
+            return False
+        indexed = False
+        with self.writing(blocking=False) as acquired:
+            if not acquired:
+                return False
+            if not self.identified:
+                self.identify_volumes()
+                self.identified = True
+            for volname, subdir, getter in self.lazy_folders():
+                self.index_folder(volname, subdir, getter)
+                indexed = True
+                if resolved():
+                    break
+            if indexed:
+                MXFTable.prune_search(self.conn)
+                for shard in self.shard_dbs.values():
+                    MXFTable.prune_search(shard.conn)
+        if indexed and self.shard_dir is not None:
+            self.attach_shards()
+        return indexed
+
+    def identify_volume(self, volname, vol, found=None, ids=None):
+        """Looks up the volume mounted at vol by its volume_id, moving
+        its index onto volname and vol if it was indexed under another
+        name or mount point, so that it isn't probed again. If the
+        volume it was indexed as is still mounted with the same id,
+        vol is a copy of it, and is given a new id instead. found is
+        the id of vol, and ids maps other mount points to their ids,
+        if already known."""
+        if found is None:
+            found = volume_id(vol)
+        if found is None:
+            return
+        if ids is None:
+            ids = dict()
+        volname = clean_tablename(volname)
+        known = self.volume_ids.get(found)
+        if known is not None and known[1] != vol and os.path.isdir(known[1]) and \
+           (ids[known[1]] if known[1] in ids else
+            volume_id(known[1], create=False)) == found:
+            found = new_volume_id(vol)
+            if found is None:
+                return
+            known = None
+        if known is not None and known != (volname, vol):
+            self.rename_volume(known[0], volname, known[1], vol)
+        self.volume_ids.register(found, volname, vol)
+
+    def rename_volume(self, old, new, old_root, new_root):
+        """Moves the index of volume old, mounted at old_root, onto
+        volume new mounted at new_root, renaming its folders and the
+        paths of its files."""
+        validate_table(new)
+        params = dict(old=old, new=new, old_root=old_root, new_root=new_root,
+                      name_length=len(old), root_length=len(old_root))
+        remount = lambda column: (
+            f'{column}=CASE WHEN substr({column}, 1, :root_length)=:old_root ' +
+            f'THEN :new_root || substr({column}, :root_length + 1) ' +
+            f'ELSE {column} END')
+        rename = 'folder=:new || substr(folder, :name_length + 1)'
+        with self.conn as c:
+            folders = ('(SELECT folder FROM main.Media WHERE volume=:old UNION ' +
+                       'SELECT mxftable FROM main.Directory WHERE volume=:old)')
+            c.execute(f'UPDATE OR REPLACE main.Sources SET {rename}, ' +
+                      f'{remount("source")} WHERE folder IN {folders}', params)
+            c.execute('UPDATE OR REPLACE main.Quarantine SET volume=:new, ' +
+                      f'{rename}, {remount("source")} WHERE volume=:old', params)
+            c.execute('UPDATE OR REPLACE main.Directory SET volume=:new, ' +
+                      'mxftable=:new || substr(mxftable, :name_length + 1), ' +
+                      f'{remount("path")} WHERE volume=:old', params)
+            c.execute(f'UPDATE OR REPLACE main.Media SET volume=:new, {rename}, ' +
+                      f'{remount("path")}, {remount("source")} ' +
+                      'WHERE volume=:old', params)
+        if self.shard_dir is None or old == new:
+            return
+        self.detach(old)
+        shard = self.shard_dbs.pop(old, None)
+        if shard is not None:
+            shard.close()
+        if os.path.exists(self.shard_file(old)) and \
+           not os.path.exists(self.shard_file(new)):
+            os.replace(self.shard_file(old), self.shard_file(new))
+            self.open_shard(new).rename_volume(old, new, old_root, new_root)
+            self.attach(new)
+
+    def _index_shards(self, jobs):
+        """Indexes each volume into its shard in a separate process,
+        passing on their metrics."""
+        jobs = list((clean_tablename(volname), topdir, getter, index_zips)
+                    for volname, topdir, getter, index_zips in jobs
+                    if os.path.isdir(topdir))
+        for volname, _, _, _ in jobs:
+            # creates the shard, moving any rows from the main database
+            self.open_shard(volname)
+        with ProcessPoolExecutor(max_workers=self.processes) as pool:
+            futures = list(pool.submit(index_shard, self.shard_file(volname),
+                                       volname, topdir, getter, index_zips,
+                                       self.workers, database_file(self.conn))
+                           for volname, topdir, getter, index_zips in jobs)
+            for future in futures:
+                records, stats = future.result()
+                for record in records:
+                    self.metrics.send(record)
+                self.metrics.add_run(stats)
+        for volname, _, _, _ in jobs:
+            self.attach(volname)
+
+    def quarantined(self, volumes=None):
+        """Returns the path, volume, error and time of failure of every
+        file that failed to probe and won't be probed again until it
+        changes, optionally only those on volumes."""
+        query = 'SELECT source, volume, error, failed FROM Quarantine'
         params = list()
-        for table in (mxftable.table for mxftable in self.mxf_tables):
-            union_buffer.append(f'SELECT * FROM {table} WHERE umid=?')
-            params.append(umid)
-        query = ' UNION '.join(union_buffer)
-        with self.conn as c:
-            result = c.execute(query, params).fetchone()
-        if result:
-            return result
-        return None
+        if volumes is not None:
+            query += f' WHERE volume IN ({", ".join("?" * len(volumes))})'
+            params.extend(volumes)
+        with self.conn as c:
+            return c.execute(query + ' ORDER BY source', params).fetchall()
 
-    def _query_mxf_tables_by_name(self, name):
-        union_buffer = list()
-        params = list()
-        for table in (mxftable.table for mxftable in self.mxf_tables):
-            union_buffer.append(f'SELECT * FROM {table} WHERE name=?')
-            params.append(name)
-        query = ' UNION '.join(union_buffer)
+    def _query_media(self, umid):
+        with self.conn as c:
+            return c.execute(f'SELECT {MXFTable.COLUMNS} FROM Media ' +
+                             'WHERE umid=? LIMIT 1', (encode_umid(umid),)).fetchone()
+
+    def _query_media_lazily(self, umid):
+        result = self._query_media(umid)
+        if result is None and self.index_on_miss(
+                lambda: self._query_media(umid) is not None):
+            result = self._query_media(umid)
+        return result
+
+    def _query_media_by_name(self, name, mediatype=None):
+        query = f'SELECT {MXFTable.COLUMNS} FROM Media WHERE name=?'
+        params = [name]
+        if mediatype is not None:
+            query += ' AND mediatype=?'
+            params.append(mediatype)
         with self.conn as c:
             return c.execute(query, params).fetchall()
 
@@ -450,63 +1921,512 @@ class MediaDatabase:
         """Returns all umids with the given reelname, optionally filtering
         by mediatype."""
         seen = dict()
-        rows = self._query_mxf_tables_by_name(reel)
+        rows = self._query_media_by_name(reel, mediatype)
+        if not rows and self.index_on_miss(
+                lambda: self._query_media_by_name(reel, mediatype)):
+            rows = self._query_media_by_name(reel, mediatype)
         for media in (MediaFile(**self._columns_to_dict(row)) for row in rows):
             if media.umid in seen:
                 continue
-            if mediatype is not None and media.mediatype != mediatype:
-                continue
             seen[media.umid] = True
             yield media
 
+    def get_clip(self, reel):
+        """Returns every indexed track file of the clips with the given
+        reelname, video before audio, found through the file packages
+        of the clips' material packages with a single query. Files
+        indexed without their clip's tracks are returned as get_umids
+        would return them."""
+        query = (f'SELECT {MXFTable.COLUMNS} FROM Media WHERE name=? OR ' +
+                 'umid IN (SELECT Tracks.umid FROM Media AS Reel JOIN Tracks ' +
+                 'ON Tracks.material=Reel.material WHERE Reel.name=?) ' +
+                 'ORDER BY mediatype DESC, file')
+        with self.conn as c:
+            rows = c.execute(query, (reel, reel)).fetchall()
+        if not rows and self.index_on_miss(lambda: self._query_media_by_name(reel)):
+            with self.conn as c:
+                rows = c.execute(query, (reel, reel)).fetchall()
+        seen = set()
+        results = list()
+        for media in (MediaFile(**self._columns_to_dict(row)) for row in rows):
+            if media.umid in seen:
+                continue
+            seen.add(media.umid)
+            results.append(media)
+        return results
+
+    def _query_many(self, column, keys, mediatype=None, transform=None):
+        """Resolves many keys against an indexed column of the Media
+        table with a single join against a temporary table of keys,
+        optionally transforming each key into the value to look up.
+        Returns a dictionary mapping every key to a list of MediaFile
+        objects, with no umid repeated for the same key."""
+        results = dict((key, list()) for key in keys)
+        columns = ', '.join(f'Media.{column}' for column in
+                            MXFTable.COLUMNS.split(', '))
+        query = (f'SELECT LookupKeys.key, {columns} FROM LookupKeys ' +
+                 f'JOIN Media ON Media.{column}=LookupKeys.value')
+        params = list()
+        if mediatype is not None:
+            query += ' WHERE Media.mediatype=?'
+            params.append(mediatype)
+        if transform is None:
+            transform = lambda key: key
+        with self.conn as c:
+            c.execute('CREATE TEMP TABLE IF NOT EXISTS LookupKeys ' +
+                      '(key TEXT PRIMARY KEY, value TEXT)')
+            c.executemany('INSERT OR IGNORE INTO LookupKeys VALUES (?, ?)',
+                          ((key, transform(key)) for key in results))
+            rows = c.execute(query, params).fetchall()
+            c.execute('DELETE FROM LookupKeys')
+        seen = set()
+        for key, *row in rows:
+            media = MediaFile(**self._columns_to_dict(row))
+            if (key, media.umid) in seen:
+                continue
+            seen.add((key, media.umid))
+            results[key].append(media)
+        return results
+
+    def _query_many_lazily(self, column, keys, mediatype=None, transform=None):
+        """Resolves keys as _query_many does, indexing with
+        index_on_miss until every key is found if any are missing."""
+        results = self._query_many(column, keys, mediatype, transform)
+        missing = list(key for key, found in results.items() if not found)
+        if missing and self.index_on_miss(lambda: all(self._query_many(
+                column, missing, mediatype, transform).values())):
+            results.update(self._query_many(column, missing, mediatype, transform))
+        return results
+
+    def lookup_many(self, umids):
+        """Returns a dictionary mapping each of umids to a list of the
+        MediaFile objects indexed with that umid, which is empty if the
+        umid is not in the database."""
+        return self._query_many_lazily('umid', umids, transform=encode_umid)
+
+    def get_umids_many(self, reels, mediatype=None):
+        """Returns a dictionary mapping each of reels to a list of the
+        MediaFile objects with that reelname, as get_umids would return
+        them, optionally filtering by mediatype."""
+        return self._query_many_lazily('name', reels, mediatype)
+
+    def resolve_reels(self, reels, mediatype=None):
+        """Returns a dictionary mapping each of reels to a list of the
+        MediaFile objects it names, matching names that differ only in
+        case, extension or clip suffixes with one indexed query. Where
+        a reel matches some names exactly, only those are returned.
+        Matches are sorted by match_rank, then name and path, so the
+        order doesn't depend on the index; best_matches picks out the
+        clips ranked best."""
+        found = self._query_many_lazily('normname', reels, mediatype,
+                                        normalize_name)
+        for reel, mediafiles in found.items():
+            exact = list(media for media in mediafiles if media.name == reel)
+            found[reel] = sorted(exact or mediafiles, key=lambda media: (
+                match_rank(reel, media.name), media.name, media.path or ''))
+        return found
+
+    def search(self, text, mediatype=None, limit=10, cutoff=0.6):
+        """Returns up to limit MediaFile objects whose names best match
+        text, ranking exact and prefix matches of the normalized name
+        ahead of fuzzy matches, which must have a similarity of at
+        least cutoff."""
+        norm = normalize_name(text)
+        if not norm:
+            return list()
+        candidates = set(self._prefix_names(norm, limit))
+        candidates.update(self._fuzzy_names(norm))
+        def rank(name):
+            prefix = name.startswith(norm)
+            return (name != norm, not prefix,
+                    -difflib.SequenceMatcher(None, norm, name).ratio(), name)
+        names = sorted((name for name in candidates if name.startswith(norm) or
+                        difflib.SequenceMatcher(None, norm, name).ratio() >= cutoff),
+                       key=rank)
+        found = self._query_many('normname', names, mediatype)
+        results = list()
+        for name in names:
+            results.extend(found[name])
+        return results[:limit]
+
+    def _prefix_names(self, norm, limit):
+        """Yields normalized names beginning with norm, using the
+        primary key index of SearchNames."""
+        upper = norm[:-1] + chr(ord(norm[-1]) + 1)
+        with self.conn as c:
+            rows = c.execute('SELECT normname FROM SearchNames WHERE ' +
+                             'normname>=? AND normname<? LIMIT ?',
+                             (norm, upper, limit * 10)).fetchall()
+        return (row[0] for row in rows)
+
+    def _fuzzy_names(self, norm, candidates=200):
+        """Returns normalized names sharing trigrams with norm, found
+        with the FTS5 trigram index if SQLite has one, or else by
+        scanning every name."""
+        schemas = self.schemas()
+        rows = list()
+        with self.conn as c:
+            if len(norm) >= 3 and all(MXFTable.has_fts(c, schema)
+                                      for schema in schemas):
+                trigrams = set(norm[i:i+3] for i in range(len(norm) - 2))
+                match = ' OR '.join('"' + gram.replace('"', '""') + '"'
+                                    for gram in trigrams)
+                for schema in schemas:
+                    rows += c.execute(f'SELECT normname FROM "{schema}".SearchIndex ' +
+                                      'WHERE SearchIndex MATCH ? ORDER BY rank ' +
+                                      'LIMIT ?', (match, candidates)).fetchall()
+            else:
+                rows = c.execute('SELECT normname FROM SearchNames').fetchall()
+        return list(row[0] for row in rows)
+
     def __getitem__(self, key):
-        result = self._query_mxf_tables(key)
+        result = self._query_media_lazily(key)
         if result is None:
             raise KeyError
         return MediaFile(**self._columns_to_dict(result))
 
     def __contains__(self, key):
-        if self._query_mxf_tables(key):
+        if self._query_media_lazily(key):
             return True
         return False
 
     @staticmethod
     def _columns_to_dict(sequence):
         """Converts a sequence of values, ordered in table order, to
-        a dictionary matching column names."""
-        umid, file, path, name, mediatype = sequence
-        row = dict(umid=umid, file=file, path=path, name=name,
-                   mediatype=mediatype)
-        return row
+        a dictionary matching column names, with umids in the notation
+        produced by Probe."""
+        columns = dict(zip(MXFTable.COLUMNS.split(', '), sequence))
+        for field in MXFTable.UMID_FIELDS:
+            columns[field] = decode_umid(columns[field])
+        return columns
 
 class MXFTable():
-    """An SQL table containing metadata, indexed by umid."""
-    SCHEMA = '''CREATE TABLE IF NOT EXISTS {}
-    ( umid TEXT PRIMARY KEY, file TEXT, path TEXT,
-    name TEXT, mediatype TEXT );'''
-
-    #def __init__(self, conn=None):
-    def __init__(self, table, conn):
+    """The rows of a single MXF folder in the Media table. Every indexed
+    file lives in the one Media table, indexed by umid, name and
+    mediatype, and keyed by the folder it was found in. Folders keep
+    the Volume_Subfolder names used for the per-folder tables of
+    earlier versions."""
+    FIELDS = (('umid', 'BLOB'), ('file', 'TEXT'), ('path', 'TEXT'),
+              ('name', 'TEXT'), ('mediatype', 'TEXT'), ('volume', 'TEXT'),
+              ('folder', 'TEXT'), ('source', 'TEXT'), ('framerate', 'TEXT'),
+              ('start_tc', 'TEXT'), ('duration', 'REAL'), ('width', 'INT'),
+              ('height', 'INT'), ('pix_fmt', 'TEXT'), ('codec', 'TEXT'),
+              ('bitrate', 'INT'), ('size', 'INT'), ('reel_name', 'TEXT'),
+              ('normname', 'TEXT'), ('material', 'BLOB'),
+              ('reel_umid', 'BLOB'), ('track_name', 'TEXT'),
+              ('format_name', 'TEXT'))
+    # fields holding umids, which are stored as 32 byte BLOBs and
+    # converted to and from the notation produced by Probe at the API
+    # boundary
+    UMID_FIELDS = ('umid', 'material', 'reel_umid')
+    # Media keeps its rowid, which is all its secondary indexes need to
+    # point to a row; in a WITHOUT ROWID table, each would hold the
+    # whole primary key. Copies of the same media in one folder, as on
+    # repository volumes, each keep a row, keyed by their paths.
+    KEY = ('folder', 'umid', 'path')
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS Media
+    ( {}, PRIMARY KEY ({}) );'''.format(
+        ', '.join(' '.join(field) for field in FIELDS), ', '.join(KEY))
+    SOURCES_SCHEMA = '''CREATE TABLE IF NOT EXISTS Sources
+    ( source TEXT PRIMARY KEY, folder TEXT, size INT, mtime_ns INT,
+    inode INT );'''
+    # files that failed to probe, with the FileStat they had, so that
+    # they aren't probed again until they change
+    QUARANTINE_SCHEMA = '''CREATE TABLE IF NOT EXISTS Quarantine
+    ( source TEXT PRIMARY KEY, folder TEXT, volume TEXT, size INT,
+    mtime_ns INT, inode INT, error TEXT, failed REAL );'''
+    # the file package of every track of each clip, by the material
+    # package umid shared by the clip's files. Tracks of clips no longer
+    # indexed are pruned after indexing. The primary key is the whole
+    # row, so it is stored as a WITHOUT ROWID table.
+    TRACKS_SCHEMA = '''CREATE TABLE IF NOT EXISTS Tracks
+    ( material BLOB, umid BLOB, mediatype TEXT, track INT,
+    PRIMARY KEY (material, umid) ) WITHOUT ROWID;'''
+    INDEXES = ('CREATE INDEX IF NOT EXISTS Media_umid ON Media (umid);',
+               'CREATE INDEX IF NOT EXISTS Media_name ON Media (name, mediatype);',
+               'CREATE INDEX IF NOT EXISTS Media_volume ON Media (volume);',
+               'CREATE INDEX IF NOT EXISTS Media_source ON Media (source);',
+               'CREATE INDEX IF NOT EXISTS Media_normname ON Media (normname, mediatype);',
+               'CREATE INDEX IF NOT EXISTS Sources_folder ON Sources (folder);',
+               'CREATE INDEX IF NOT EXISTS Quarantine_folder ON Quarantine (folder);')
+    # distinct normalized names, with a trigram index kept in sync by
+    # triggers for fuzzy search. Names of removed media are pruned after
+    # indexing.
+    SEARCH_SCHEMA = ('CREATE TABLE IF NOT EXISTS SearchNames (normname TEXT PRIMARY KEY);',
+                     '''CREATE TRIGGER IF NOT EXISTS Media_search AFTER INSERT ON Media
+    WHEN new.normname IS NOT NULL BEGIN
+    INSERT INTO SearchNames SELECT new.normname WHERE NOT EXISTS
+    (SELECT 1 FROM SearchNames WHERE normname=new.normname); END;''')
+    FTS_SCHEMA = ('''CREATE VIRTUAL TABLE IF NOT EXISTS SearchIndex USING fts5
+    (normname, content='SearchNames', tokenize='trigram');''',
+                  '''CREATE TRIGGER IF NOT EXISTS SearchNames_insert AFTER INSERT
+    ON SearchNames BEGIN INSERT INTO SearchIndex (rowid, normname)
+    VALUES (new.rowid, new.normname); END;''',
+                  '''CREATE TRIGGER IF NOT EXISTS SearchNames_delete AFTER DELETE
+    ON SearchNames BEGIN INSERT INTO SearchIndex (SearchIndex, rowid, normname)
+    VALUES ('delete', old.rowid, old.normname); END;''')
+    COLUMNS = ', '.join(('umid', 'file', 'path', 'name', 'mediatype') +
+                        TECHNICAL_FIELDS + ('material',))
+    LEGACY_COLUMNS = ('umid', 'file', 'path', 'name', 'mediatype')
+
+    def __init__(self, table, conn, volume=None):
         validate_table(table)
         self.table = table
         self.conn = conn
+        self.volume = volume
+
+    @classmethod
+    def create_table(cls, conn):
+        """Creates the Media, Sources, Quarantine and Tracks tables and
+        their indexes if they do not exist, adding any columns missing
+        from a Media table created by an earlier version."""
+        with conn as c:
+            c.execute(cls.SCHEMA)
+            c.execute(cls.SOURCES_SCHEMA)
+            c.execute(cls.QUARANTINE_SCHEMA)
+            c.execute(cls.TRACKS_SCHEMA)
+            columns = set(row[1] for row in c.execute('PRAGMA table_info(Media)'))
+            for column, kind in cls.FIELDS:
+                if column not in columns:
+                    c.execute(f'ALTER TABLE Media ADD COLUMN {column} {kind}')
+        cls.migrate_umids(conn)
+        with conn as c:
+            for index in cls.INDEXES:
+                c.execute(index)
+            searchable = c.execute("SELECT 1 FROM sqlite_master WHERE " +
+                                   "name='SearchNames'").fetchone()
+            for statement in cls.SEARCH_SCHEMA:
+                c.execute(statement)
+            try:
+                for statement in cls.FTS_SCHEMA:
+                    c.execute(statement)
+            except sqlite3.OperationalError:
+                pass                    # no FTS5, search scans names instead
+            # normalize names indexed by earlier versions
+            if 'normname' not in columns or not searchable:
+                conn.create_function('normalize_name', 1, normalize_name)
+                c.execute('UPDATE Media SET normname=normalize_name(name) ' +
+                          'WHERE normname IS NULL AND name IS NOT NULL')
+                c.execute('INSERT OR IGNORE INTO SearchNames SELECT DISTINCT ' +
+                          'normname FROM Media WHERE normname IS NOT NULL')
+            # marks the connection, so create doesn't migrate it again
+            c.execute('CREATE TEMP TABLE IF NOT EXISTS MediaCreated (created)')
+
+    @classmethod
+    def migrate_umids(cls, conn):
+        """Rebuilds the Media and Tracks tables of earlier versions,
+        which kept umids as hex TEXT, to keep them as BLOBs, and a Media
+        table keyed by folder and umid alone to be keyed by KEY."""
+        tables = (('Media', cls.SCHEMA, list(field for field, _ in cls.FIELDS)),
+                  ('Tracks', cls.TRACKS_SCHEMA,
+                   ['material', 'umid', 'mediatype', 'track']))
+        create_function(conn, 'encode_umid', 1, encode_umid)
+        with conn as c:
+            for table, schema, fields in tables:
+                info = c.execute(f'PRAGMA table_info({table})').fetchall()
+                kinds = dict((row[1], row[2]) for row in info)
+                key = tuple(row[1] for row in sorted(info, key=lambda row: row[5])
+                            if row[5])
+                if kinds['umid'].upper() == 'BLOB' and \
+                   (table != 'Media' or key == cls.KEY):
+                    continue
+                if not conn.in_transaction:
+                    c.execute('BEGIN')
+                columns = ', '.join(fields)
+                values = ', '.join(f'encode_umid({field})' if field in
+                                   cls.UMID_FIELDS else field for field in fields)
+                # indexes and triggers follow the old table and are
+                # dropped with it, to be created again for the new one
+                c.execute(f'ALTER TABLE {table} RENAME TO {table}_text')
+                c.execute(schema)
+                # rowid tables allowed NULL keys, which can't be looked up
+                c.execute(f'INSERT OR REPLACE INTO {table} ({columns}) ' +
+                          f'SELECT {values} FROM {table}_text WHERE umid IS ' +
+                          f'NOT NULL AND {fields[0]} IS NOT NULL')
+                c.execute(f'DROP TABLE {table}_text')
+
+    @staticmethod
+    def has_fts(conn, schema='main'):
+        """Returns True if the database has the FTS5 name index."""
+        return conn.execute(f'SELECT 1 FROM "{schema}".sqlite_master WHERE ' +
+                            "name='SearchIndex'").fetchone() is not None
+
+    @staticmethod
+    def prune_search(conn):
+        """Forgets the normalized names and clip tracks of media no
+        longer indexed in the main database of conn."""
+        with conn as c:
+            c.execute('DELETE FROM main.SearchNames WHERE normname NOT IN ' +
+                      '(SELECT normname FROM main.Media WHERE normname IS NOT NULL)')
+            c.execute('DELETE FROM main.Tracks WHERE material NOT IN ' +
+                      '(SELECT material FROM main.Media WHERE material IS NOT NULL)')
 
     def create(self):
-        """Validates and then creates the table."""
+        """Validates the folder name and then creates the Media table,
+        unless it was already created on this connection."""
         validate_table(self.table)
         with self.conn as c:
-            c.execute(self.SCHEMA.format(self.table))
+            created = c.execute("SELECT 1 FROM temp.sqlite_master WHERE " +
+                                "name='MediaCreated'").fetchone()
+        if created is None:
+            self.create_table(self.conn)
 
     def create_with(self, umids):
-        """Creates the table and then inserts a collection of metadata
-        into it. umids should be a dictionary of Probe objects or
-        dictionaries."""
+        """Inserts a collection of metadata into the folder. umids
+        should be a dictionary of Probe objects, keyed by umid or, to
+        keep copies of the same media, by path, whose technical
+        metadata is stored if they have any."""
         self.create()
+        columns = ('umid, file, path, name, mediatype, volume, folder, source, ' +
+                   'normname, material, ' + ', '.join(TECHNICAL_FIELDS))
+        values = ', '.join('?' * (10 + len(TECHNICAL_FIELDS)))
         with self.conn as c:
-            for umid, metadata in umids.items():
-                c.execute(f'INSERT INTO {self.table} VALUES (?, ?, ?, ?, ?)',
-                          (umid, metadata.file, metadata.path, metadata.name,
-                           metadata.type))
+            c.executemany(f'INSERT OR REPLACE INTO Media ({columns}) ' +
+                          f'VALUES ({values})',
+                          ((encode_umid(metadata.umid), metadata.file, metadata.path,
+                            metadata.name,
+                            metadata.type, self.volume, self.table,
+                            getattr(metadata, 'source', metadata.path),
+                            None if metadata.name is None else
+                            normalize_name(metadata.name),
+                            encode_umid(getattr(metadata, 'material', None))) +
+                           self._technical(metadata)
+                           for metadata in umids.values()))
+        self.add_tracks((metadata.material, *track)
+                        for metadata in umids.values()
+                        if getattr(metadata, 'material', None) is not None
+                        for track in metadata.tracks)
+
+    def tracks(self):
+        """Returns the material, file package umid, mediatype and track
+        id of every track of the clips with files in the folder."""
+        with self.conn as c:
+            rows = c.execute('SELECT material, umid, mediatype, track FROM ' +
+                             'Tracks WHERE material IN (SELECT material FROM ' +
+                             'Media WHERE folder=?)', (self.table,)).fetchall()
+        return list((decode_umid(material), decode_umid(umid), *track)
+                    for material, umid, *track in rows)
+
+    def add_tracks(self, tracks):
+        """Records an iterable of clip tracks, as returned by tracks.
+        A track id of None, as ffprobe can report, doesn't replace one
+        already read from the header of another file of the clip."""
+        with self.conn as c:
+            c.executemany('INSERT INTO Tracks VALUES (?, ?, ?, ?) ' +
+                          'ON CONFLICT (material, umid) DO UPDATE SET ' +
+                          'mediatype=excluded.mediatype, ' +
+                          'track=COALESCE(excluded.track, track)',
+                          ((encode_umid(material), encode_umid(umid), *track)
+                           for material, umid, *track in tracks))
+
+    def rows(self):
+        """Returns every row in the folder, as tuples of the values of
+        FIELDS."""
+        fields = list(field for field, _ in self.FIELDS)
+        with self.conn as c:
+            rows = c.execute(f'SELECT {", ".join(fields)} FROM Media ' +
+                             'WHERE folder=?', (self.table,)).fetchall()
+        return list(self._convert_umids(fields, rows, decode_umid))
+
+    def insert_rows(self, fields, rows):
+        """Inserts rows as returned by rows, of the values of fields,
+        into the folder."""
+        self.create()
+        columns = ', '.join(fields)
+        values = ', '.join('?' * len(fields))
+        with self.conn as c:
+            c.executemany(f'INSERT OR REPLACE INTO Media ({columns}) ' +
+                          f'VALUES ({values})',
+                          self._convert_umids(fields, rows, encode_umid))
+
+    @classmethod
+    def _convert_umids(cls, fields, rows, convert):
+        """Yields rows of the values of fields with convert applied to
+        the values of UMID_FIELDS."""
+        umids = set(i for i, field in enumerate(fields) if field in cls.UMID_FIELDS)
+        for row in rows:
+            yield tuple(convert(value) if i in umids else value
+                        for i, value in enumerate(row))
+
+    @classmethod
+    def _technical(cls, metadata):
+        technical = getattr(metadata, 'technical', None) or dict()
+        return tuple(encode_umid(technical.get(field)) if field in
+                     cls.UMID_FIELDS else technical.get(field)
+                     for field in TECHNICAL_FIELDS)
+
+    def drop(self):
+        """Deletes every row in the folder."""
+        with self.conn as c:
+            c.execute('DELETE FROM Media WHERE folder=?', (self.table,))
+            c.execute('DELETE FROM Sources WHERE folder=?', (self.table,))
+            c.execute('DELETE FROM Quarantine WHERE folder=?', (self.table,))
+
+    def sources(self):
+        """Returns a dictionary of the FileStat recorded for every file
+        or zip archive indexed in the folder, keyed by path."""
+        with self.conn as c:
+            rows = c.execute('SELECT source, size, mtime_ns, inode FROM Sources ' +
+                             'WHERE folder=?', (self.table,)).fetchall()
+        return dict((row[0], FileStat(*row[1:])) for row in rows)
+
+    def add_sources(self, sources):
+        """Records the FileStat of an iterable of (source, FileStat)
+        pairs that have been indexed."""
+        with self.conn as c:
+            c.executemany('INSERT OR REPLACE INTO Sources VALUES (?, ?, ?, ?, ?)',
+                          ((source, self.table, *stat) for source, stat in sources))
+
+    def quarantined(self):
+        """Returns a dictionary of the FileStat every file in the folder
+        that failed to probe had when it failed, keyed by path."""
+        with self.conn as c:
+            rows = c.execute('SELECT source, size, mtime_ns, inode FROM ' +
+                             'Quarantine WHERE folder=?', (self.table,)).fetchall()
+        return dict((row[0], FileStat(*row[1:])) for row in rows)
+
+    def quarantine(self, failures):
+        """Records an iterable of (source, FileStat, error) for files
+        that failed to probe."""
+        failed = time.time()
+        with self.conn as c:
+            c.executemany('INSERT OR REPLACE INTO Quarantine VALUES ' +
+                          '(?, ?, ?, ?, ?, ?, ?, ?)',
+                          ((source, self.table, self.volume, *stat, error, failed)
+                           for source, stat, error in failures))
+
+    def remove(self, sources):
+        """Deletes the rows, recorded FileStat and any quarantine of a
+        list of sources."""
+        sources = list(sources)
+        with self.conn as c:
+            c.executemany('DELETE FROM Media WHERE source=?',
+                          ((source,) for source in sources))
+            c.executemany('DELETE FROM Sources WHERE source=?',
+                          ((source,) for source in sources))
+            c.executemany('DELETE FROM Quarantine WHERE source=?',
+                          ((source,) for source in sources))
+
+    def adopt(self, found):
+        """Records the current FileStat of files indexed by an earlier
+        version, which only tracked changes by folder, so that they
+        aren't probed again. Should only be called when the folder is
+        known not to have changed since it was indexed. Returns the
+        adopted sources, as returned by sources."""
+        with self.conn as c:
+            paths = list(row[0] for row in c.execute(
+                'SELECT path FROM Media WHERE folder=?', (self.table,)))
+        adopted = dict()
+        with self.conn as c:
+            for path in paths:
+                source = find_source(path, found)
+                if source is None:
+                    continue
+                c.execute('UPDATE Media SET source=? WHERE folder=? AND path=?',
+                          (source, self.table, path))
+                adopted[source] = found[source]
+        self.add_sources(adopted.items())
+        return adopted
 
 #    @staticmethod
 #    def _path_to_tablename(mxfdir):
@@ -535,7 +2455,8 @@ class MXFTable():
 
     def __getitem__(self, key):
         with self.conn as c:
-            r = c.execute('SELECT filename, path FROM Mxf WHERE umid=?;', (key,)).fetchone()
+            r = c.execute('SELECT file, path FROM Media WHERE folder=? AND umid=?;',
+                          (self.table, encode_umid(key))).fetchone()
         if r is None:
             raise KeyError
         return r
@@ -544,15 +2465,19 @@ class MXFTable():
         filename, path = val
         if key in self:
             with self.conn as c:
-                c.execute('UPDATE f{self.table} SET filename=?, path=? WHERE umid = ?;',
-                          (filename, path, key))
+                c.execute('UPDATE Media SET file=?, path=? WHERE folder=? AND umid=?;',
+                          (filename, path, self.table, encode_umid(key)))
         else:
             with self.conn as c:
-                c.execute('INSERT INTO f{self.table} VALUES (?, ?, ?);', (key, filename, path))
+                c.execute('INSERT INTO Media (umid, file, path, volume, folder) ' +
+                          'VALUES (?, ?, ?, ?, ?);',
+                          (encode_umid(key), filename, path, self.volume,
+                           self.table))
 
     def __contains__(self, key):
         with self.conn as c:
-            if c.execute(f'SELECT umid from {self.table} WHERE umid=?;', (key,)).fetchone():
+            if c.execute('SELECT umid FROM Media WHERE folder=? AND umid=?;',
+                         (self.table, encode_umid(key))).fetchone():
                 return True
         return False
 
@@ -561,16 +2486,56 @@ class MXFTable():
 
 class DirectoryTable:
     """Access class for SQL table that tracks the modification time of
-    every MXFTable ever seen in the database."""
+    every MXFTable ever seen in the database, along with the path and
+    volume of its folder and the name of the MediaDatabase method that
+    lists its files, so that folders can be watched for changes."""
     SCHEMA = '''CREATE TABLE IF NOT EXISTS Directory (mxftable TEXT PRIMARY KEY, mtime INT);'''
+    FIELDS = (('path', 'TEXT'), ('volume', 'TEXT'), ('getter', 'TEXT'),
+              ('indexed', 'REAL'))
 
     def __init__(self, conn=None):
         self.conn = conn
 
     def create_table(self):
-        """Creates the table if it does not exist."""
+        """Creates the table if it does not exist, adding the folder
+        columns missing from tables created by earlier versions."""
         with self.conn as c:
             c.execute(self.SCHEMA)
+            columns = set(row[1] for row in c.execute('PRAGMA table_info(Directory)'))
+            for column, kind in self.FIELDS:
+                if column not in columns:
+                    c.execute(f'ALTER TABLE Directory ADD COLUMN {column} {kind}')
+
+    def register(self, mxftable, mtime, path, volume, getter):
+        """Records the modification time of an indexed folder, with its
+        path, volume, the name of its file getter and the time it was
+        indexed."""
+        with self.conn as c:
+            c.execute('INSERT OR REPLACE INTO Directory ' +
+                      '(mxftable, mtime, path, volume, getter, indexed) ' +
+                      'VALUES (?, ?, ?, ?, ?, ?);',
+                      (mxftable, mtime, path, volume, getter, time.time()))
+
+    def indexed(self, mxftable):
+        """Returns the time mxftable was last indexed and its
+        modification time then, or None for either if unknown."""
+        with self.conn as c:
+            row = c.execute('SELECT indexed, mtime FROM Directory WHERE ' +
+                            'mxftable=?;', (mxftable,)).fetchone()
+        return tuple(row) if row is not None else (None, None)
+
+    def folders(self, getter=None):
+        """Yields the mxftable, path, volume and getter of every folder
+        registered with a path, optionally only those listed by getter."""
+        query = 'SELECT mxftable, path, volume, getter FROM Directory ' + \
+            'WHERE path IS NOT NULL'
+        params = list()
+        if getter is not None:
+            query += ' AND getter=?'
+            params.append(getter)
+        with self.conn as c:
+            rows = c.execute(query, params).fetchall()
+        yield from rows
 
     def update(self, items):
         """Updates the table with new values."""
@@ -608,18 +2573,49 @@ class DirectoryTable:
 
     def _update(self, key, val):
         with self.conn as c:
-            c.execute('UPDATE Directory SET mtime=? WHERE mxftable=?;', (key, val))
+            c.execute('UPDATE Directory SET mtime=? WHERE mxftable=?;', (val, key))
 
     def _insert(self, key, val):
         with self.conn as c:
-            c.execute('INSERT INTO Directory VALUES (?, ?);', (key, val))
+            c.execute('INSERT INTO Directory (mxftable, mtime) VALUES (?, ?);',
+                      (key, val))
+
+
+class VolumeTable:
+    """Access class for SQL table that records the name and mount point
+    each volume was last indexed under, by its volume_id."""
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS Volumes
+    (id TEXT PRIMARY KEY, volume TEXT, path TEXT);'''
+
+    def __init__(self, conn=None):
+        self.conn = conn
+
+    def create_table(self):
+        """Creates the table if it does not exist."""
+        with self.conn as c:
+            c.execute(self.SCHEMA)
+
+    def get(self, key):
+        """Returns the volume name and path recorded for a volume_id, or
+        None."""
+        with self.conn as c:
+            row = c.execute('SELECT volume, path FROM main.Volumes WHERE id=?',
+                            (key,)).fetchone()
+        return None if row is None else tuple(row)
+
+    def register(self, key, volume, path):
+        """Records the volume name and path of a volume_id."""
+        with self.conn as c:
+            c.execute('INSERT OR REPLACE INTO main.Volumes VALUES (?, ?, ?)',
+                      (key, volume, path))
 
 
 def probe_umid(fname):
     """Probes a file with ffprobe and returns the file_package_umid
     for the active media stream."""
     args = ['ffprobe', '-of', 'json', '-show_format', '-show_streams', fname]
-    probe = subprocess.run(args, capture_output=True, check=False)
+    probe = subprocess.run(args, capture_output=True, check=False,
+                           timeout=FFPROBE_TIMEOUT)
     data = json.loads(probe.stdout.decode('utf8'))
     streams = data['streams']
     # each mxf file contains data streams describing related mxf files,
@@ -630,12 +2626,139 @@ def probe_umid(fname):
             continue
         return stream['tags']['file_package_umid'].lower()
 
-def open(db_file, volumes=None, repo_volumes=None, quiet=False):
-    """Opens a new MediaDatabase stored in db_file."""
+def index_shard(shard_file, volname, topdir, getter, index_zips=False,
+                workers=None, cache_file=None):
+    """Indexes a volume into its shard database, as a job for a process
+    pool. getter names the MediaDatabase method listing its files, and
+    cache_file the index whose probe cache is used, if not the
+    default. Returns the metrics records of the volume and its run
+    totals."""
+    if cache_file is not None:
+        probecache.bind(cache_file)
+    records = list()
+    metrics = mxfmetrics.IndexMetrics(callback=records.append)
+    db = MediaDatabase(sqlite3.connect(shard_file), quiet=True,
+                       workers=workers, metrics=metrics)
+    try:
+        with metrics.run():
+            db.index_volume(volname, topdir, getattr(db, getter), index_zips)
+        MXFTable.prune_search(db.conn)
+    finally:
+        db.close()
+    return ([record for record in records if record['event'] != 'run'],
+            metrics.last_run)
+
+def database_file(conn):
+    """Returns the path of the main database of conn, or None if it is
+    held in memory."""
+    for _, name, path in conn.execute('PRAGMA database_list'):
+        if name == 'main':
+            return path or None
+    return None
+
+class ConnectionManager:
+    """Gives out MediaDatabases on db_file for lookups, each on a
+    connection of its own in WAL mode and used by one thread at a time,
+    so that threads read concurrently with each other and with
+    indexing. Indexing goes through writer, which holds the writer
+    lease on db_file, so that only one process indexes at a time.
+    options are passed on to every MediaDatabase. Probes and
+    thumbnails are cached in db_file."""
+
+    def __init__(self, db_file, **options):
+        probecache.bind(db_file)
+        thumbnailcache.bind(db_file)
+        self.db_file = db_file
+        self.options = options
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.readers = list()
+        self.idle = list()
+        self.generation = 0
+
+    @contextmanager
+    def reader(self):
+        """Yields a MediaDatabase for the calling thread alone, reusing
+        one left idle by another thread if there is one. A reader
+        yielded after a writer has indexed shards attaches them
+        first."""
+        current = getattr(self.local, 'db', None)
+        if current is not None:
+            yield current
+            return
+        with self.lock:
+            db, generation = self.idle.pop() if self.idle else (None, None)
+            current_generation = self.generation
+        if db is None:
+            # connections are handed between threads, though only ever
+            # used by one at a time
+            db = MediaDatabase(sqlite3.connect(self.db_file,
+                                               check_same_thread=False),
+                               **self.options)
+            with self.lock:
+                self.readers.append(db)
+        elif generation != current_generation and db.shard_dir is not None:
+            db.attach_shards()
+        self.local.db = db
+        try:
+            yield db
+        finally:
+            self.local.db = None
+            with self.lock:
+                self.idle.append((db, current_generation))
+
+    @contextmanager
+    def writer(self, blocking=False):
+        """Holds the writer lease on db_file and yields a MediaDatabase
+        on a new connection to index with, or None if another process
+        holds the lease and blocking is False."""
+        lease = mxflease.WriterLease.for_database(self.db_file)
+        with lease.holding(blocking) as acquired:
+            if not acquired:
+                yield None
+                return
+            db = MediaDatabase(sqlite3.connect(self.db_file), **self.options)
+            try:
+                yield db
+            finally:
+                db.close()
+                with self.lock:
+                    self.generation += 1
+
+    def close(self):
+        """Closes every reader's connection."""
+        with self.lock:
+            readers, self.readers, self.idle = self.readers, list(), list()
+        for db in readers:
+            db.close()
+
+def open(db_file, volumes=None, repo_volumes=None, quiet=False, workers=None,
+         service=True, metrics=None, shard_dir=None, processes=1, lazy=False):
+    """Opens a new MediaDatabase stored in db_file. workers sets the
+    number of files probed at once while indexing, defaulting to the
+    number of CPUs, and metrics is an optional mxfmetrics.IndexMetrics
+    to record indexing in. With a shard_dir, each volume is indexed
+    into a shard of its own, up to processes volumes at once. If lazy
+    is True, nothing is indexed until a lookup misses, and then only
+    folders not indexed recently, as MediaDatabase.index_on_miss does.
+    If lazy, volumes are identified on the first lookup that misses.
+    If service is True and a media index service is running on db_file,
+    returns a client for it instead, skipping indexing, which the
+    service keeps up to date. Probes and thumbnails are cached in
+    db_file."""
+    if service:
+        from turnovertools import mxfdbservice
+        client = mxfdbservice.connect(db_file)
+        if client is not None:
+            return client
+    probecache.bind(db_file)
+    thumbnailcache.bind(db_file)
     connection = sqlite3.connect(db_file)
     db = MediaDatabase(connection, volumes=volumes, repo_volumes=repo_volumes,
-                       quiet=quiet)
-    db.index_all()
+                       quiet=quiet, workers=workers, metrics=metrics,
+                       shard_dir=shard_dir, processes=processes, lazy=lazy)
+    if not lazy:
+        db.index_all()
     return db
 
 if __name__ == '__main__':
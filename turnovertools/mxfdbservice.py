@@ -0,0 +1,315 @@
+"""Resident media index service, keeping an mxfdb database warm and
+reindexed in the background, and answering lookups over a local Unix
+socket so that scripts don't index every volume on launch."""
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import sqlite3
+import threading
+
+from turnovertools import mxfdb
+from turnovertools import mxfwatch
+
+# methods of MediaDatabase a client may call through the service
+LOOKUPS = ('get_umids', 'get_umids_many', 'lookup_many', 'resolve_reels',
+           'get_clip', 'search', 'getitem', 'contains', 'ping')
+
+logger = logging.getLogger(__name__)
+
+def socket_path(db_file):
+    """Returns the path of the socket served for db_file."""
+    return os.path.abspath(db_file) + '.sock'
+
+def to_json(result):
+    """Converts the result of a MediaDatabase lookup to values that can
+    be sent as JSON."""
+    if isinstance(result, mxfdb.MediaFile):
+        return vars(result)
+    if isinstance(result, dict):
+        return dict((key, to_json(value)) for key, value in result.items())
+    if isinstance(result, (list, tuple)):
+        return list(to_json(value) for value in result)
+    return result
+
+def to_mediafiles(rows):
+    """Rebuilds a list of MediaFile tuples sent as JSON."""
+    return list(mxfdb.MediaFile(**row) for row in rows)
+
+class ServiceUnavailable(ConnectionError):
+    """Raised when no service answers on a socket."""
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Answers requests sent as one JSON object per line, each with a
+    method from LOOKUPS and a list of args, with a JSON line holding
+    either the result or an error."""
+
+    def handle(self):
+        """Answers each request line sent on the connection."""
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                result = self.server.service.call(request['method'],
+                                                  *request.get('args', ()))
+                response = dict(result=to_json(result))
+            except KeyError as err:
+                response = dict(error='KeyError', message=str(err))
+            except Exception as err:
+                response = dict(error=type(err).__name__, message=str(err))
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves each connection on the socket in a thread of its own,
+    with the service answering its requests."""
+    daemon_threads = True
+
+class MediaIndexService:
+    """Serves lookups on the mxfdb database in db_file while reindexing
+    volumes in a background thread every interval seconds, or, with
+    watch, indexing once and then following changes to the indexed
+    MXF folders. Each lookup is answered on a reader connection of its
+    own from an mxfdb.ConnectionManager, so lookups run concurrently
+    with each other and with indexing. Reindexing is skipped while
+    another process holds the writer lease on db_file.
+    Indexing is recorded in metrics, an optional
+    mxfmetrics.IndexMetrics. With a shard_dir, volumes are indexed
+    into shards, up to processes at once, as for mxfdb.open."""
+
+    def __init__(self, db_file, volumes=None, repo_volumes=None,
+                 interval=300, workers=None, path=None, watch=False,
+                 metrics=None, shard_dir=None, processes=1):
+        self.db_file = db_file
+        self.metrics = metrics
+        self.shard_dir = shard_dir
+        self.processes = processes
+        self.watch = watch
+        self.volumes = volumes
+        self.repo_volumes = repo_volumes
+        self.interval = interval
+        self.workers = workers
+        self.path = path or socket_path(db_file)
+        self.connections = mxfdb.ConnectionManager(
+            db_file, volumes=volumes, repo_volumes=repo_volumes, quiet=True,
+            workers=workers, metrics=metrics, shard_dir=shard_dir,
+            processes=processes)
+        self.stopped = threading.Event()
+        self.indexed = threading.Event()
+        self.server = None
+        self.indexer = None
+
+    def call(self, method, *args):
+        """Runs a lookup on the database."""
+        if method not in LOOKUPS:
+            raise ValueError(f'Unknown method {method}')
+        if method == 'ping':
+            return dict(db_file=os.path.abspath(self.db_file),
+                        indexed=self.indexed.is_set())
+        with self.connections.reader() as db:
+            if method == 'getitem':
+                return db[args[0]]
+            if method == 'contains':
+                return args[0] in db
+            if method == 'get_umids':
+                return list(db.get_umids(*args))
+            return getattr(db, method)(*args)
+
+    def reindex(self):
+        """Indexes all volumes on a connection of its own, unless
+        another process holds the writer lease."""
+        with self.connections.writer() as db:
+            if db is None:
+                return
+            db.index_all()
+        self.indexed.set()
+
+    def _index_loop(self):
+        """Reindexes every interval seconds until stopped, or watches
+        folders instead, falling back to reindexing if the watcher
+        fails. Failures are logged with their traceback, and the next
+        round tried as usual."""
+        if self.watch:
+            self._watch()
+        while not self.stopped.is_set():
+            try:
+                self.reindex()
+            except Exception:
+                logger.exception('Reindexing %s failed', self.db_file)
+            self.stopped.wait(self.interval)
+
+    def _watch(self):
+        """Indexes all volumes once, then keeps their MXF folders
+        current with a MediaWatcher instead of reindexing, until
+        stopped or the watcher fails, which is logged."""
+        try:
+            self.reindex()
+        except Exception:
+            logger.exception('Reindexing %s failed', self.db_file)
+        db = mxfdb.MediaDatabase(sqlite3.connect(self.db_file), quiet=True,
+                                 workers=self.workers, metrics=self.metrics,
+                                 shard_dir=self.shard_dir)
+        try:
+            mxfwatch.MediaWatcher(db).run(self.stopped)
+        except Exception:
+            logger.exception('Watching %s failed; reindexing every %s seconds',
+                             self.db_file, self.interval)
+        finally:
+            db.close()
+
+    def start(self):
+        """Binds the socket and starts the indexing and serving
+        threads."""
+        if os.path.exists(self.path):
+            if is_running(self.path):
+                raise OSError(f'A service is already running on {self.path}')
+            os.remove(self.path)
+        self.server = UnixServer(self.path, RequestHandler)
+        self.server.service = self
+        self.indexer = threading.Thread(target=self._index_loop, daemon=True)
+        self.indexer.start()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        """Stops serving and removes the socket."""
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.connections.close()
+
+    def serve_forever(self):
+        """Starts the service and blocks until interrupted."""
+        self.start()
+        try:
+            self.stopped.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+class MediaIndexClient:
+    """Looks up media through a running MediaIndexService, with the
+    lookup methods of MediaDatabase."""
+
+    def __init__(self, path, timeout=10):
+        self.path = path
+        try:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(path)
+        except OSError as err:
+            self.sock.close()
+            raise ServiceUnavailable(f'No service on {path}') from err
+        self.stream = self.sock.makefile('rwb')
+
+    def _call(self, method, *args):
+        """Sends a request for method with args to the service and
+        returns its result. Raises KeyError for keys that aren't
+        found, RuntimeError for other errors raised by the service and
+        ServiceUnavailable if it doesn't answer."""
+        request = dict(method=method, args=list(args))
+        try:
+            self.stream.write(json.dumps(request).encode() + b'\n')
+            self.stream.flush()
+            line = self.stream.readline()
+        except OSError as err:
+            raise ServiceUnavailable(f'Lost service on {self.path}') from err
+        if not line:
+            raise ServiceUnavailable(f'Lost service on {self.path}')
+        response = json.loads(line)
+        if 'error' in response:
+            if response['error'] == 'KeyError':
+                raise KeyError(args[0] if args else response['message'])
+            raise RuntimeError(f"{response['error']}: {response['message']}")
+        return response['result']
+
+    def ping(self):
+        """Returns the database the service indexes and whether it
+        has finished indexing it."""
+        return self._call('ping')
+
+    def get_umids(self, reel, mediatype=None):
+        """Returns all umids with the given reelname, optionally filtering
+        by mediatype."""
+        yield from to_mediafiles(self._call('get_umids', reel, mediatype))
+
+    def get_umids_many(self, reels, mediatype=None):
+        """Returns a dictionary mapping each reel to the media with that
+        name, optionally filtered by mediatype."""
+        found = self._call('get_umids_many', list(reels), mediatype)
+        return dict((reel, to_mediafiles(rows)) for reel, rows in found.items())
+
+    def lookup_many(self, umids):
+        """Returns a dictionary mapping each umid to the media indexed
+        with it."""
+        found = self._call('lookup_many', list(umids))
+        return dict((umid, to_mediafiles(rows)) for umid, rows in found.items())
+
+    def resolve_reels(self, reels, mediatype=None):
+        """Returns a dictionary mapping each reel to its media, matched
+        exactly or else by normalized name."""
+        found = self._call('resolve_reels', list(reels), mediatype)
+        return dict((reel, to_mediafiles(rows)) for reel, rows in found.items())
+
+    def get_clip(self, reel):
+        """Returns the media of every track of the clip named reel."""
+        return to_mediafiles(self._call('get_clip', reel))
+
+    def search(self, text, mediatype=None, limit=10, cutoff=0.6):
+        """Returns up to limit media whose names best match text."""
+        return to_mediafiles(self._call('search', text, mediatype, limit, cutoff))
+
+    def __getitem__(self, key):
+        """Returns the media indexed with umid key, raising KeyError if
+        there is none."""
+        return mxfdb.MediaFile(**self._call('getitem', key))
+
+    def __contains__(self, key):
+        """Returns True if media is indexed with umid key."""
+        return self._call('contains', key)
+
+    def close(self):
+        """Closes the connection to the service."""
+        self.stream.close()
+        self.sock.close()
+
+def is_running(path):
+    """Returns True if a service answers on the socket at path."""
+    try:
+        client = MediaIndexClient(path, timeout=1)
+    except ServiceUnavailable:
+        return False
+    try:
+        client.ping()
+        return True
+    except (ServiceUnavailable, ValueError):
+        return False
+    finally:
+        client.close()
+
+def connect(db_file, timeout=10):
+    """Returns a MediaIndexClient for the service running on db_file,
+    or None if there isn't one."""
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    path = socket_path(db_file)
+    if not os.path.exists(path):
+        return None
+    try:
+        client = MediaIndexClient(path, timeout=timeout)
+    except ServiceUnavailable:
+        return None
+    try:
+        status = client.ping()
+    except (ServiceUnavailable, ValueError):
+        client.close()
+        return None
+    if status['db_file'] != os.path.abspath(db_file):
+        client.close()
+        return None
+    return client
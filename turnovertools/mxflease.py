@@ -0,0 +1,129 @@
+"""A writer lease on an mxfdb database, held by one process at a time,
+so that scripts started at once don't all index the same volumes and
+fight over writes. The lease is an advisory lock on a file next to the
+database, which the operating system releases if its holder dies, so
+a crashed indexer never leaves the database locked."""
+
+from contextlib import contextmanager
+import fcntl
+import os
+import threading
+import time
+
+# appended to the path of a database for the path of its lease file
+LEASE_SUFFIX = '.lease'
+
+_leases = dict()
+_leases_lock = threading.Lock()
+
+class WriterLease:
+    """The writer lease on the database a lease file at path belongs
+    to. Within a process the lease is shared between threads, held by
+    one thread at a time, and reentrant: acquiring it while the same
+    thread holds it succeeds at once, and it is released when every
+    acquire has been matched by a release. Other threads wait for it,
+    or fail to acquire it without blocking, as other processes do."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Condition()
+        self.owner = None
+        self.count = 0
+        self.filehandle = None
+
+    @classmethod
+    def for_database(cls, db_file):
+        """Returns this process's lease on db_file."""
+        path = os.path.realpath(db_file) + LEASE_SUFFIX
+        with _leases_lock:
+            return _leases.setdefault(path, cls(path))
+
+    @property
+    def held(self):
+        """True if the calling thread holds the lease."""
+        return self.owner == threading.get_ident() and self.count > 0
+
+    def acquire(self, blocking=True):
+        """Acquires the lease, waiting for another thread or process to
+        release it if blocking is True. Returns True if the lease was
+        acquired."""
+        me = threading.get_ident()
+        with self.lock:
+            if self.owner == me:
+                self.count += 1
+                return True
+            while self.owner is not None:
+                if not blocking:
+                    return False
+                self.lock.wait()
+            # claimed before locking the file, which may wait for
+            # another process, so other threads don't wait on self.lock
+            self.owner = me
+        filehandle = None
+        try:
+            filehandle = open(self.path, 'a+')
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            fcntl.flock(filehandle, flags)
+            filehandle.truncate(0)
+            filehandle.write(f'{os.getpid()} {time.time()}\n')
+            filehandle.flush()
+        except BaseException as err:
+            if filehandle is not None:
+                filehandle.close()
+            self._unclaim()
+            if isinstance(err, BlockingIOError):
+                return False
+            raise
+        with self.lock:
+            self.filehandle = filehandle
+            self.count = 1
+        return True
+
+    def _unclaim(self):
+        with self.lock:
+            self.owner = None
+            self.lock.notify_all()
+
+    def release(self):
+        """Releases one acquire of the lease by the calling thread,
+        letting other threads and processes acquire it once every
+        acquire has been released."""
+        with self.lock:
+            if not self.held:
+                raise RuntimeError(f'{self.path} is not held by this thread')
+            self.count -= 1
+            if self.count:
+                return
+            fcntl.flock(self.filehandle, fcntl.LOCK_UN)
+            self.filehandle.close()
+            self.filehandle = None
+            self.owner = None
+            self.lock.notify_all()
+
+    @contextmanager
+    def holding(self, blocking=True):
+        """Holds the lease for the body of a with statement, yielding
+        whether it was acquired."""
+        acquired = self.acquire(blocking)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.release()
+
+    def holder(self):
+        """Returns the process id of the process holding the lease, or
+        None if it isn't held."""
+        if self.count:
+            return os.getpid()
+        try:
+            with open(self.path) as filehandle:
+                try:
+                    fcntl.flock(filehandle, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    fields = filehandle.readline().split()
+                    return int(fields[0]) if fields else None
+                fcntl.flock(filehandle, fcntl.LOCK_UN)
+        except (OSError, ValueError):
+            pass
+        return None
@@ -0,0 +1,211 @@
+"""Structured metrics for indexing mxfdb databases: per-folder and
+per-volume counters and probe latency histograms, written as JSON
+lines or passed to a callback, so slow volumes and folders that keep
+being reindexed can be found without guessing."""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+# upper bounds, in milliseconds, of the probe latency histogram buckets
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# how files were probed: by reading the MXF header, by running
+# ffprobe, or not at all because no valid media stream was found
+PROBE_KINDS = ('header', 'ffprobe', 'failed')
+
+# number of new or changed files described in each folder record
+CHANGED_SAMPLE = 5
+
+class LatencyHistogram:
+    """Counts probe latencies in logarithmic buckets."""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """Records one probe taking seconds."""
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds * 1000)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        """Adds the counts of another histogram to this one."""
+        self.counts = list(a + b for a, b in zip(self.counts, other.counts))
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction):
+        """Returns the upper bound in milliseconds of the bucket holding
+        the given fraction of probes, or the slowest probe if that is
+        past the last bucket."""
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return round(self.max * 1000, 3)
+
+    def as_dict(self):
+        """Returns the histogram as values that can be sent as JSON."""
+        buckets = dict((f'<={bound}', count) for bound, count in
+                       zip(LATENCY_BUCKETS, self.counts) if count)
+        if self.counts[-1]:
+            buckets[f'>{LATENCY_BUCKETS[-1]}'] = self.counts[-1]
+        mean = self.total / self.count * 1000 if self.count else None
+        return dict(count=self.count,
+                    mean_ms=None if mean is None else round(mean, 3),
+                    max_ms=round(self.max * 1000, 3),
+                    p50_ms=self.percentile(0.5),
+                    p90_ms=self.percentile(0.9),
+                    p99_ms=self.percentile(0.99),
+                    buckets=buckets)
+
+class IndexStats:
+    """Counters for indexing a folder, a volume or a whole run. files
+    were found on disk, of which unchanged were skipped and changed
+    were probed, along with any members of changed zip archives;
+    bytes is the size of the changed files. quarantined files failed to probe on an earlier
+    run and are skipped until they change. header, ffprobe and failed
+    count probes of each kind."""
+    COUNTERS = ('files', 'unchanged', 'changed', 'removed', 'adopted',
+                'quarantined', 'probed', 'bytes') + PROBE_KINDS
+
+    def __init__(self, **labels):
+        self.labels = labels
+        for counter in self.COUNTERS:
+            setattr(self, counter, 0)
+        self.folders = 0
+        self.scan_seconds = 0.0
+        self.seconds = 0.0
+        self.latency = dict((kind, LatencyHistogram()) for kind in PROBE_KINDS)
+        self.changed_sample = list()
+
+    def add_probe(self, kind, seconds):
+        """Records one probe of kind taking seconds."""
+        self.probed += 1
+        setattr(self, kind, getattr(self, kind) + 1)
+        self.latency[kind].add(seconds)
+
+    def merge(self, other):
+        """Adds the counters of another IndexStats to these."""
+        for counter in self.COUNTERS:
+            setattr(self, counter, getattr(self, counter) + getattr(other, counter))
+        self.folders += other.folders
+        self.scan_seconds += other.scan_seconds
+        for kind, histogram in other.latency.items():
+            self.latency[kind].merge(histogram)
+
+    @property
+    def files_per_second(self):
+        """Files probed per second of wall time."""
+        if not self.seconds:
+            return None
+        return round(self.probed / self.seconds, 3)
+
+    def as_dict(self):
+        """Returns the counters as values that can be sent as JSON."""
+        record = dict(self.labels)
+        record.update((counter, getattr(self, counter))
+                      for counter in self.COUNTERS)
+        record.update(folders=self.folders,
+                      scan_seconds=round(self.scan_seconds, 6),
+                      seconds=round(self.seconds, 6),
+                      files_per_second=self.files_per_second,
+                      latency=dict((kind, histogram.as_dict()) for
+                                   kind, histogram in self.latency.items()))
+        if self.changed_sample:
+            record['changed_sample'] = self.changed_sample
+        return record
+
+class IndexMetrics:
+    """Collects IndexStats while a MediaDatabase indexes, emitting a
+    record for each folder, volume and run as it finishes. Records are
+    appended as JSON lines to path and passed to callback, if given.
+    The totals of the last run are kept in last_run."""
+
+    def __init__(self, path=None, callback=None):
+        self.path = path
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.volume_stats = None
+        self.run_stats = None
+        self.last_run = None
+
+    def emit(self, event, stats):
+        """Sends the record of an event to the metrics file and
+        callback."""
+        if self.path is None and self.callback is None:
+            return
+        record = dict(event=event, time=time.time())
+        record.update(stats.as_dict())
+        self.send(record)
+
+    def send(self, record):
+        """Writes a record to the metrics file and passes it to the
+        callback."""
+        with self.lock:
+            if self.path is not None:
+                with open(self.path, 'a') as filehandle:
+                    filehandle.write(json.dumps(record) + '\n')
+            if self.callback is not None:
+                self.callback(record)
+
+    @contextmanager
+    def _measure(self, event, stats):
+        started = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats.seconds = time.perf_counter() - started
+            self.emit(event, stats)
+
+    @contextmanager
+    def run(self):
+        """Collects the totals of indexing every volume."""
+        self.run_stats = IndexStats()
+        try:
+            with self._measure('run', self.run_stats) as stats:
+                yield stats
+        finally:
+            self.last_run, self.run_stats = self.run_stats, None
+
+    @contextmanager
+    def volume(self, volume, path):
+        """Collects the totals of indexing the folders of a volume."""
+        self.volume_stats = IndexStats(volume=volume, path=path)
+        try:
+            with self._measure('volume', self.volume_stats) as stats:
+                yield stats
+        finally:
+            self.volume_stats = None
+
+    def add_run(self, stats):
+        """Adds the totals of a run made elsewhere, such as in another
+        process, to the current run."""
+        if self.run_stats is not None:
+            self.run_stats.merge(stats)
+
+    @contextmanager
+    def folder(self, volume, table, path):
+        """Collects the counters for indexing a single folder, adding
+        them to the totals of its volume and run."""
+        stats = IndexStats(volume=volume, table=table, path=path)
+        stats.folders = 1
+        try:
+            with self._measure('folder', stats):
+                yield stats
+        finally:
+            for totals in (self.volume_stats, self.run_stats):
+                if totals is not None:
+                    totals.merge(stats)
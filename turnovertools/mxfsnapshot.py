@@ -0,0 +1,157 @@
+"""Snapshots of an mxfdb index, exported by one workstation and
+imported by others sharing the same storage, so that only media whose
+stat data has changed since the snapshot was taken is probed again.
+
+A snapshot is a gzipped JSON lines file. The first line describes the
+snapshot, including its format version and the Media fields its rows
+hold; each following line holds one indexed folder, with its Directory
+entry, the FileStat of every source, the rows indexed from them and
+the tracks of their clips."""
+
+import gzip
+import json
+import os
+import time
+
+from turnovertools import mxfdb
+
+FORMAT = 'mxfdb-snapshot'
+VERSION = 1
+
+def export_snapshot(db, path, volumes=None):
+    """Writes the folders indexed in db for volumes, or for every
+    volume, to a snapshot at path. Returns the number of folders
+    written."""
+    fields = list(field for field, _ in mxfdb.MXFTable.FIELDS)
+    folders = list(_indexed_folders(db, volumes))
+    header = dict(format=FORMAT, version=VERSION, created=time.time(),
+                  fields=fields,
+                  volumes=sorted(set(volume for _, volume, _ in folders)))
+    with gzip.open(path, 'wt', encoding='utf-8') as filehandle:
+        filehandle.write(json.dumps(header) + '\n')
+        for folder, volume, entry in folders:
+            mxftable = mxfdb.MXFTable(folder, db.conn, volume)
+            record = dict(folder=folder, volume=volume,
+                          sources=list([source, *stat] for source, stat in
+                                       mxftable.sources().items()),
+                          media=list(list(row) for row in mxftable.rows()),
+                          tracks=list(list(row) for row in mxftable.tracks()))
+            record.update(entry)
+            filehandle.write(json.dumps(record) + '\n')
+    return len(folders)
+
+def _indexed_folders(db, volumes):
+    """Yields the folder, volume and Directory entry of every folder
+    with indexed media."""
+    with db.conn as c:
+        rows = c.execute('SELECT DISTINCT folder, volume FROM Media ' +
+                         'ORDER BY folder').fetchall()
+        for folder, volume in rows:
+            if volumes is not None and volume not in volumes:
+                continue
+            entry = c.execute('SELECT mtime, path, getter FROM Directory ' +
+                              'WHERE mxftable=?', (folder,)).fetchone()
+            mtime, path, getter = entry or (None, None, None)
+            yield folder, volume, dict(mtime=mtime, path=path, getter=getter)
+
+def read_snapshot(path):
+    """Returns the header of a snapshot and an iterator of its folder
+    records. Raises ValueError if path is not a snapshot this version
+    can read."""
+    filehandle = gzip.open(path, 'rt', encoding='utf-8')
+    try:
+        header = json.loads(filehandle.readline())
+    except (OSError, ValueError) as err:
+        filehandle.close()
+        raise ValueError(f'{path} is not an mxfdb snapshot') from err
+    if header.get('format') != FORMAT:
+        filehandle.close()
+        raise ValueError(f'{path} is not an mxfdb snapshot')
+    if header.get('version', 0) > VERSION:
+        filehandle.close()
+        raise ValueError(f'{path} is a version {header["version"]} snapshot, ' +
+                         f'newer than version {VERSION}')
+    def records():
+        with filehandle:
+            for line in filehandle:
+                yield json.loads(line)
+    return header, records()
+
+def current_stat(source):
+    """Returns the FileStat of a source on this machine, or None if it
+    is missing."""
+    try:
+        return mxfdb.path_signature(source)
+    except OSError:
+        return None
+
+def matches(recorded, stat):
+    """Returns True if a FileStat recorded on another machine matches a
+    file on this one. Inodes are not compared, since they can differ
+    between machines mounting the same share."""
+    return stat is not None and tuple(recorded[:2]) == tuple(stat[:2])
+
+def import_snapshot(db, path, volumes=None, reindex=True):
+    """Merges the folders of a snapshot at path into db, optionally
+    only those of volumes. Sources whose size and modification time
+    still match the snapshot are imported as they were indexed, unless
+    db already has an up to date index of them; then, if reindex is
+    True, each folder is brought up to date with index_folder, which
+    probes only new or changed files. Returns a dictionary counting
+    the folders, the sources imported, those already current in db and
+    those left stale because they have changed since the snapshot.
+    Waits for the writer lease if another process holds it."""
+    header, records = read_snapshot(path)
+    with db.writing():
+        return _import_snapshot(db, header, records, volumes, reindex)
+
+def _import_snapshot(db, header, records, volumes, reindex):
+    fields = header['fields']
+    known_fields = set(field for field, _ in mxfdb.MXFTable.FIELDS)
+    keep = list(i for i, field in enumerate(fields) if field in known_fields)
+    columns = list(fields[i] for i in keep)
+    source_column = fields.index('source')
+    counts = dict(folders=0, imported=0, current=0, stale=0)
+    reindexing = list()
+    for record in records:
+        volume = record['volume']
+        if volumes is not None and volume not in volumes:
+            continue
+        counts['folders'] += 1
+        target = db.open_shard(volume) if db.shard_dir is not None else db
+        mxftable = mxfdb.MXFTable(record['folder'], target.conn, volume)
+        known = mxftable.sources()
+        fresh = dict()
+        for source, *recorded in record['sources']:
+            stat = current_stat(source)
+            if not matches(recorded, stat):
+                counts['stale'] += 1
+            elif known.get(source) == stat:
+                counts['current'] += 1
+            else:
+                fresh[source] = stat
+        mxftable.remove(list(fresh))
+        mxftable.insert_rows(columns, (
+            list(row[i] for i in keep) for row in record['media']
+            if row[source_column] in fresh))
+        mxftable.add_sources(fresh.items())
+        mxftable.add_tracks(record.get('tracks', ()))
+        counts['imported'] += len(fresh)
+        if record.get('path') is not None:
+            mtime = record['mtime']
+            if os.path.isdir(record['path']):
+                mtime = os.stat(record['path']).st_mtime_ns
+            target.directory.register(record['folder'], mtime, record['path'],
+                                      volume, record['getter'])
+            if record['getter'] is not None:
+                reindexing.append((volume, record['path'], record['getter']))
+    mxfdb.MXFTable.prune_search(db.conn)
+    if db.shard_dir is not None:
+        for shard in db.shard_dbs.values():
+            mxfdb.MXFTable.prune_search(shard.conn)
+        db.attach_shards()
+    if reindex:
+        for volume, folder, getter in reindexing:
+            if os.path.exists(folder):
+                db.index_folder(volume, folder, getattr(db, getter))
+    return counts
@@ -0,0 +1,215 @@
+"""Watches the Avid MediaFiles/MXF folders registered in an mxfdb
+database, keeping the index current as media lands or is deleted.
+Uses inotify where the platform has it, and polls otherwise."""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+# inotify event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# files are only probed once closed, so partly copied media is skipped
+FOLDER_EVENTS = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE |
+                 IN_DELETE_SELF | IN_MOVE_SELF)
+PARENT_EVENTS = IN_CREATE | IN_MOVED_TO
+GONE_EVENTS = IN_DELETE_SELF | IN_MOVE_SELF | IN_UNMOUNT | IN_IGNORED
+EVENT_HEADER = struct.Struct('iIII')
+
+logger = logging.getLogger(__name__)
+
+class Inotify:
+    """Minimal ctypes wrapper around the Linux inotify calls. Raises
+    OSError where inotify is not available."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available on this platform')
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add_watch(self, path, mask):
+        """Watches path for events in mask, returning the watch
+        descriptor."""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'Cannot watch {path}')
+        return wd
+
+    def rm_watch(self, wd):
+        """Stops watching the watch descriptor wd."""
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """Waits up to timeout seconds for events, returning a list of
+        (wd, mask, name) tuples, or an empty list if none arrived."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = list()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        """Closes the inotify descriptor, removing every watch."""
+        os.close(self.fd)
+
+class MediaWatcher:
+    """Keeps the index of every registered MXF folder current. Changes
+    in a folder are reindexed file by file with index_folder once the
+    folder has been quiet for settle seconds, so only new or changed
+    files are probed and deleted files are removed. New numbered
+    folders created alongside a watched one are indexed and watched
+    too. Without inotify, every folder is rescanned each interval
+    seconds instead. A folder that fails to index is logged and tried
+    again on its next change or rescan, without stopping the others."""
+
+    def __init__(self, db, interval=10, settle=2, use_inotify=True):
+        self.db = db
+        self.interval = interval
+        self.settle = settle
+        self.use_inotify = use_inotify
+        self.folders = dict()
+        self.inotify = None
+        self.watches = dict()
+
+    def load_folders(self):
+        """Reads the MXF folders registered in the database, keeping
+        those whose volumes are mounted."""
+        self.folders = dict(
+            (path, volume) for _, path, volume, _ in
+            self.db.directory.folders(getter='get_dir')
+            if os.path.isdir(path))
+        return self.folders
+
+    def index(self, path):
+        """Brings the index of a single folder up to date, logging
+        any failure."""
+        if path not in self.folders or not os.path.isdir(path):
+            return
+        try:
+            self.db.index_folder(self.folders[path], path, self.db.get_dir)
+        except Exception:
+            logger.exception('Indexing %s failed', path)
+
+    def poll(self):
+        """Rescans every registered folder once."""
+        for path in list(self.load_folders()):
+            self.index(path)
+
+    def watch(self, path):
+        """Adds inotify watches for a folder and its parent MXF
+        folder."""
+        wd = self.inotify.add_watch(path, FOLDER_EVENTS)
+        self.watches[wd] = path
+        parent = os.path.dirname(path)
+        if parent not in self.watches.values():
+            wd = self.inotify.add_watch(parent, PARENT_EVENTS)
+            self.watches[wd] = parent
+
+    def handle(self, wd, mask, name, dirty):
+        """Marks the folders touched by an event as dirty."""
+        path = self.watches.get(wd)
+        if path is None:
+            return
+        if mask & GONE_EVENTS:
+            self.watches.pop(wd, None)
+            return
+        if path in self.folders:
+            dirty[path] = time.monotonic()
+        elif mask & IN_ISDIR:
+            # a new numbered folder in a watched MXF folder
+            subdir = os.path.join(path, name)
+            volume = next(volume for folder, volume in self.folders.items()
+                          if os.path.dirname(folder) == path)
+            self.folders[subdir] = volume
+            try:
+                self.watch(subdir)
+            except OSError as err:
+                logger.warning('Could not watch %s: %s', subdir, err)
+            dirty[subdir] = time.monotonic()
+
+    def start_inotify(self):
+        """Watches every registered folder with inotify. Returns False,
+        watching nothing, if inotify isn't available or a folder can't
+        be watched."""
+        try:
+            self.inotify = Inotify()
+        except OSError as err:
+            logger.info('Polling for changes: %s', err)
+            return False
+        try:
+            for path in self.load_folders():
+                self.watch(path)
+        except OSError as err:
+            logger.warning('Polling for changes: %s', err)
+            self.stop_inotify()
+            return False
+        return True
+
+    def stop_inotify(self):
+        """Closes inotify, removing every watch."""
+        self.inotify.close()
+        self.inotify = None
+        self.watches = dict()
+
+    def run_inotify(self, stopped):
+        """Indexes folders as inotify reports changes, until stopped.
+        Expects start_inotify to have succeeded."""
+        try:
+            dirty = dict()
+            while not stopped.is_set():
+                timeout = self.settle if dirty else self.interval
+                for wd, mask, name in self.inotify.read(timeout):
+                    self.handle(wd, mask, name, dirty)
+                now = time.monotonic()
+                for path, changed in list(dirty.items()):
+                    if now - changed >= self.settle:
+                        del dirty[path]
+                        self.index(path)
+        finally:
+            self.stop_inotify()
+
+    def run_polling(self, stopped):
+        """Rescans every folder each interval seconds, until stopped."""
+        while not stopped.is_set():
+            self.poll()
+            stopped.wait(self.interval)
+
+    def run(self, stopped=None):
+        """Watches folders until stopped, a threading.Event, is set,
+        using inotify if possible and polling otherwise."""
+        if stopped is None:
+            stopped = threading.Event()
+        if self.use_inotify and self.start_inotify():
+            return self.run_inotify(stopped)
+        return self.run_polling(stopped)
@@ -0,0 +1,110 @@
+"""Persistent cache of ffprobe results, keyed on a fingerprint of file
+contents, so that copies of the same media on other volumes, or media
+in renamed folders, are not probed again."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from turnovertools import sharedcache
+
+# bytes hashed from each end of a file for its fingerprint
+FINGERPRINT_BYTES = 64 * 1024
+# cache hits whose times of use are held back and then written at once,
+# so that hits are reads
+TOUCH_BATCH = 256
+
+def fingerprint(filepath):
+    """Returns a fingerprint for the contents of filepath, made of its
+    size and a hash of its first and last 64 KB."""
+    size = os.stat(filepath).st_size
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as filehandle:
+        digest.update(filehandle.read(FINGERPRINT_BYTES))
+        if size > FINGERPRINT_BYTES:
+            filehandle.seek(max(FINGERPRINT_BYTES, size - FINGERPRINT_BYTES))
+            digest.update(filehandle.read(FINGERPRINT_BYTES))
+    return f'{size}:{digest.hexdigest()}'
+
+class ProbeCache:
+    """ffprobe output stored in the ProbeCache table of an SQLite
+    database, by default the mxfdb index. The time each result was last
+    used is recorded in batches, when TOUCH_BATCH hits have built up or
+    a result is stored or pruned. Safe to share between threads."""
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS ProbeCache
+    ( fingerprint TEXT PRIMARY KEY, data TEXT, used INT );'''
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.touched = dict()
+        with self.lock, self.conn as c:
+            c.execute(self.SCHEMA)
+
+    def __getitem__(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM ProbeCache WHERE ' +
+                                    'fingerprint=?', (key,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            self.touched[key] = int(time.time())
+            if len(self.touched) >= TOUCH_BATCH:
+                with self.conn as c:
+                    self._write_touched(c)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, data):
+        with self.lock, self.conn as c:
+            self._write_touched(c)
+            c.execute('INSERT OR REPLACE INTO ProbeCache VALUES (?, ?, ?)',
+                      (key, json.dumps(data), int(time.time())))
+
+    def _write_touched(self, c):
+        c.executemany('UPDATE ProbeCache SET used=? WHERE fingerprint=?',
+                      list((used, key) for key, used in self.touched.items()))
+        self.touched = dict()
+
+    def __contains__(self, key):
+        with self.lock, self.conn as c:
+            return c.execute('SELECT 1 FROM ProbeCache WHERE fingerprint=?',
+                             (key,)).fetchone() is not None
+
+    def prune(self, before):
+        """Forgets results not used since before, a Unix timestamp."""
+        with self.lock, self.conn as c:
+            self._write_touched(c)
+            c.execute('DELETE FROM ProbeCache WHERE used<?', (before,))
+
+    def probe(self, filepath, run):
+        """Returns run(filepath), the parsed ffprobe output for
+        filepath, from the cache if a file with the same fingerprint
+        has been probed before. Only output with streams is cached."""
+        try:
+            key = fingerprint(filepath)
+        except OSError:
+            return run(filepath)
+        try:
+            return self[key]
+        except KeyError:
+            pass
+        data = run(filepath)
+        if data.get('streams'):
+            self[key] = data
+        return data
+
+# the ProbeCache used by probe, bound to the index by mxfdb.open
+_shared = sharedcache.SharedCache(ProbeCache)
+get_cache = _shared.get
+set_cache = _shared.set
+bind = _shared.bind
+
+def probe(filepath, run):
+    """Returns run(filepath) through the shared ProbeCache."""
+    cache = get_cache()
+    if cache is None:
+        return run(filepath)
+    return cache.probe(filepath, run)
@@ -0,0 +1,36 @@
+"""The shared instance of a cache stored in the mxfdb index, as used by
+probecache and thumbnailcache."""
+
+from turnovertools.config import Config
+
+class SharedCache:
+    """Holds the cache made by calling factory with a database file,
+    by default Config.MXFDB. A cache set with set takes precedence over
+    one bound to an index."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.cache = None
+        # True while the cache is one set with set
+        self.explicit = False
+
+    def get(self):
+        """Returns the shared cache, or None if caching is disabled.
+        Unless an index has been bound, it is stored in Config.MXFDB."""
+        if self.cache is None:
+            self.cache = self.factory(Config.MXFDB)
+        return self.cache or None
+
+    def set(self, cache):
+        """Replaces the shared cache. Passing False disables caching;
+        passing None restores the default."""
+        self.cache = cache
+        self.explicit = cache is not None
+
+    def bind(self, db_file):
+        """Stores the shared cache alongside the mxfdb index in db_file,
+        unless a cache has been set, or caching disabled, with set."""
+        if self.explicit:
+            return
+        if self.cache is None or self.cache.db_file != db_file:
+            self.cache = self.factory(db_file)
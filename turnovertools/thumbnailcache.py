@@ -0,0 +1,112 @@
+"""Persistent cache of thumbnails extracted from media, stored in the
+mxfdb index so that repeat turnovers reuse stills instead of decoding
+the same frames again."""
+
+import sqlite3
+import threading
+import time
+
+from turnovertools.config import Config
+from turnovertools import sharedcache
+
+# cache hits whose times of use are held back and then written at once,
+# so that hits are reads
+TOUCH_BATCH = 256
+
+class ThumbnailCache:
+    """JPEG thumbnails stored as BLOBs in the Thumbnails table of an
+    SQLite database, by default the mxfdb index, keyed by umid, frame,
+    scale and the interval searched for a representative frame. Once
+    the stored images exceed max_bytes, the least recently used are
+    evicted. Times of use are recorded in batches, when TOUCH_BATCH
+    hits have built up or a thumbnail is stored, before anything is
+    evicted. Safe to share between threads."""
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS Thumbnails
+    ( umid TEXT, frame INT, scale TEXT, interval INT, image BLOB, bytes INT,
+    used REAL, PRIMARY KEY (umid, frame, scale, interval) );'''
+    INDEXES = ('CREATE INDEX IF NOT EXISTS Thumbnails_used ON Thumbnails (used);',)
+
+    def __init__(self, db_file, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = Config.THUMBNAIL_CACHE_BYTES
+        self.max_bytes = max_bytes
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.touched = dict()
+        with self.lock, self.conn as c:
+            c.execute(self.SCHEMA)
+            for index in self.INDEXES:
+                c.execute(index)
+
+    @staticmethod
+    def _key(umid, frame, scale, interval):
+        return (umid, frame, f'{scale[0]}x{scale[1]}', interval)
+
+    def get(self, umid, frame, scale, interval=1):
+        """Returns the cached thumbnail, or None, marking it as used."""
+        key = self._key(umid, frame, scale, interval)
+        with self.lock:
+            row = self.conn.execute('SELECT image FROM Thumbnails WHERE ' +
+                                    'umid=? AND frame=? AND scale=? AND ' +
+                                    'interval=?', key).fetchone()
+            if row is None:
+                return None
+            self.touched[key] = time.time()
+            if len(self.touched) >= TOUCH_BATCH:
+                with self.conn as c:
+                    self._write_touched(c)
+        return bytes(row[0])
+
+    def put(self, umid, frame, scale, interval, image):
+        """Stores a thumbnail, then evicts the least recently used
+        thumbnails until the cache is no larger than max_bytes."""
+        key = self._key(umid, frame, scale, interval)
+        with self.lock, self.conn as c:
+            self._write_touched(c)
+            c.execute('INSERT OR REPLACE INTO Thumbnails VALUES ' +
+                      '(?, ?, ?, ?, ?, ?, ?)',
+                      key + (image, len(image), time.time()))
+            self._evict(c)
+
+    def _write_touched(self, c):
+        c.executemany('UPDATE Thumbnails SET used=? WHERE umid=? AND ' +
+                      'frame=? AND scale=? AND interval=?',
+                      list((used,) + key for key, used in self.touched.items()))
+        self.touched = dict()
+
+    def _evict(self, c):
+        total = c.execute('SELECT TOTAL(bytes) FROM Thumbnails').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = list()
+        for rowid, size in c.execute('SELECT rowid, bytes FROM Thumbnails ' +
+                                     'ORDER BY used'):
+            if total <= self.max_bytes:
+                break
+            evicted.append((rowid,))
+            total -= size
+        c.executemany('DELETE FROM Thumbnails WHERE rowid=?', evicted)
+
+    def thumbnail(self, umid, frame, scale, interval, make):
+        """Returns the cached thumbnail, or else calls make() to extract
+        it and stores the result."""
+        image = self.get(umid, frame, scale, interval)
+        if image is None:
+            image = make()
+            self.put(umid, frame, scale, interval, image)
+        return image
+
+# the ThumbnailCache used by thumbnail, bound to the index by mxfdb.open
+_shared = sharedcache.SharedCache(ThumbnailCache)
+get_cache = _shared.get
+set_cache = _shared.set
+bind = _shared.bind
+
+def thumbnail(umid, frame, scale, interval, make):
+    """Returns make(), the thumbnail for umid, through the shared
+    ThumbnailCache."""
+    cache = get_cache()
+    if cache is None or umid is None:
+        return make()
+    return cache.thumbnail(umid, frame, scale, interval, make)